@@ -5,15 +5,16 @@ from consumers.rabbitmq import RabbitMQConsumer
 import requests
 from setup import creds
 
-from setup.error_handler import ProcessInErrorHandler, ProcessOutErrorHandler, LeadFormErrorHandler
+from setup.error_handler import ProcessInErrorHandler, ProcessOutErrorHandler, LeadFormErrorHandler, Logger
 from traceback import format_exc as tb
 from datetime import datetime
 from integration.orders import Order
+from integration.shopify_api import Shopify
 from integration.draft_orders import on_draft_created, on_draft_updated
 from customer_tools.customers import add_new_customer
 import threading
 from setup.sms_engine import SMSEngine
-from setup.utilities import PhoneNumber
+from setup.utilities import PhoneNumber, convert_utc_to_local
 from setup.email_engine import Email
 from database import Database
 from docxtpl import DocxTemplate
@@ -228,8 +229,248 @@ def process_shopify_order(order_id, eh=ProcessInErrorHandler):
     Order(order_id).process()
 
 
+def process_product_update(payload: dict, eh=ProcessInErrorHandler):
+    """Copies a Shopify product update, with its SEO, metafields and image alt text, to Counterpoint"""
+    logger = Logger(creds.Logs.webhooks_product_update)
+    product_id = payload['id']
+    title = payload['title']
+    description = payload['body_html']
+    status = payload['status']
+    tags = payload['tags']
+    item_no = Database.Shopify.Product.get_parent_item_no(product_id)
+
+    logger.log(f'Webhook: Product Update, SKU:{item_no}, Product ID: {product_id}, Web Title: {title}')
+
+    if item_no and description:
+        Database.CP.Product.HTMLDescription.update(
+            item_no=item_no, html_descr=description, update_timestamp=False, eh=eh
+        )
+
+    # Get SEO data
+    seo_data = Shopify.Product.SEO.get(product_id)
+    if seo_data:
+        meta_title = seo_data['title']
+        meta_description = seo_data['description']
+    else:
+        meta_title = None
+        meta_description = None
+
+    # Get product Metafields
+    metafields = Shopify.Product.Metafield.get(product_id)
+    features = None
+    botanical_name = None
+    plant_type = None
+    light_requirements = None
+    size = None
+    bloom_season = None
+    bloom_color = None
+    color = None
+    is_featured = None
+    is_in_store_only = None
+    is_preorder_item = None
+    preorder_message = None
+    preorder_release_date = None
+    is_new = None
+    is_back_in_stock = None
+
+    for i in metafields['product_specifications']:
+        if i['key'] == 'botanical_name':
+            botanical_name = i['value']
+
+        if i['key'] == 'plant_type':
+            plant_type = i['value']
+
+        if i['key'] == 'light_requirements':
+            light_requirements = i['value']
+
+        if i['key'] == 'size':
+            size = i['value']
+
+        if i['key'] == 'features':
+            features = i['value']
+
+        if i['key'] == 'bloom_season':
+            bloom_season = i['value']
+
+        if i['key'] == 'bloom_color':
+            bloom_color = i['value']
+
+        if i['key'] == 'color':
+            color = i['value']
+
+    # Product Status Metafields
+    is_featured = {'id': None, 'value': None}
+    is_in_store_only = {'id': None, 'value': None}
+    is_new = {'id': None, 'value': None}
+    is_back_in_stock = {'id': None, 'value': None}
+    is_preorder_item = {'id': None, 'value': None}
+    preorder_release_date = {'id': None, 'value': None}
+    preorder_message = {'id': None, 'value': None}
+    is_on_sale = {'id': None, 'value': None}
+    sale_description = {'id': None, 'value': None}
+
+    for i in metafields['product_status']:
+        if i['key'] == 'featured':  # never null boolean
+            is_featured = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
+
+        if i['key'] == 'in_store_only':  # never null boolean
+            is_in_store_only = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
+
+        if i['key'] == 'new':
+            is_new = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
+
+        if i['key'] == 'back_in_stock':
+            is_back_in_stock = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
+
+        if i['key'] == 'preorder_item':  # never null boolean
+            is_preorder_item = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
+
+        if i['key'] == 'preorder_message':
+            preorder_message = {'id': i['id'], 'value': i['value']}
+
+        if i['key'] == 'preorder_release_date':
+            preorder_release_dt = convert_utc_to_local(datetime.strptime(i['value'], '%Y-%m-%dT%H:%M:%S%z'))
+            preorder_release_date = {'id': i['id'], 'value': preorder_release_dt}
+
+        if i['key'] == 'on_sale':  # never null boolean
+            is_on_sale = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
+
+        if i['key'] == 'on_sale_description':
+            sale_description = {'id': i['id'], 'value': i['value']}
+
+    # Get media data
+    media_payload = []
+    media = payload['media']
+
+    if media:
+        for m in media:
+            id = m['id']
+            position = m['position']
+            alt_text = m['alt']
+            if alt_text and position < 4:  # First 4 images only at this time.
+                media_payload.append({'position': position, 'id': id, 'alt_text': alt_text})
+
+    if item_no:
+        update_payload = {'product_id': product_id, 'item_no': item_no}
+
+        if status:
+            update_payload['status'] = status
+        if title:
+            update_payload['title'] = title
+        if meta_title:
+            update_payload['meta_title'] = meta_title
+        if meta_description:
+            update_payload['meta_description'] = meta_description
+
+        if tags:
+            update_payload['tags'] = tags
+
+        if botanical_name:
+            update_payload['botanical_name'] = botanical_name
+        if plant_type:
+            update_payload['plant_type'] = plant_type
+        if light_requirements:
+            update_payload['light_requirements'] = light_requirements
+        if size:
+            update_payload['size'] = size
+        if features:
+            update_payload['features'] = features
+        if bloom_season:
+            update_payload['bloom_season'] = bloom_season
+        if bloom_color:
+            update_payload['bloom_color'] = bloom_color
+        if color:
+            update_payload['color'] = color
+        # Product Status
+        update_payload['is_featured'] = is_featured
+        update_payload['is_in_store_only'] = is_in_store_only
+        update_payload['is_preorder_item'] = is_preorder_item
+        update_payload['preorder_message'] = preorder_message
+        update_payload['preorder_release_date'] = preorder_release_date
+        update_payload['is_new'] = is_new
+        update_payload['is_back_in_stock'] = is_back_in_stock
+        update_payload['is_on_sale'] = is_on_sale
+        update_payload['sale_description'] = sale_description
+
+        if media_payload:
+            for m in media_payload:
+                position = m['position']
+                update_payload[f'alt_text_{position}'] = m['alt_text']
+        try:
+            Database.CP.Product.update(update_payload, eh=eh)
+        except Exception as e:
+            eh.error_handler.add_error_v(
+                error=f'Error updating product {item_no}: {e}',
+                origin='product_update',
+                traceback=tb(),
+            )
+
+
+class ProductUpdateQueue:
+    """Coalesces product update webhooks. One edit in the Shopify admin sends several webhooks, and a bulk edit
+    sends hundreds. A product is processed once, with its latest payload, window seconds after its first event.
+    Deliveries are acked only after their product is processed, so updates still waiting when the consumer dies
+    are redelivered by RabbitMQ."""
+
+    def __init__(self, window: int = creds.Consumer.product_update_window, eh=ProcessInErrorHandler):
+        self.window = window
+        self.eh = eh
+        self.pending: dict[int, dict] = {}
+        self.acks: dict[int, list] = {}
+        self.due: dict[int, float] = {}
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, body, ack, eh=ProcessInErrorHandler):
+        """Consumer callback. Replaces the pending payload for the product without moving its due time.
+        ack is called once the product has been processed."""
+        payload = json.loads(body)
+        product_id = payload['id']
+        with self.condition:
+            if product_id not in self.due:
+                self.due[product_id] = time.monotonic() + self.window
+            self.pending[product_id] = payload
+            self.acks.setdefault(product_id, []).append(ack)
+            self.condition.notify()
+
+    def take(self, ready_only=True) -> list[tuple[dict, list]]:
+        with self.condition:
+            now = time.monotonic()
+            ready = [pid for pid, due in self.due.items() if not ready_only or due <= now]
+            for product_id in ready:
+                del self.due[product_id]
+            return [(self.pending.pop(product_id), self.acks.pop(product_id)) for product_id in ready]
+
+    def process(self, updates: list[tuple[dict, list]]):
+        for payload, acks in updates:
+            try:
+                process_product_update(payload, eh=self.eh)
+            except Exception as e:
+                self.eh.error_handler.add_error_v(
+                    error=f'Error updating product {payload["id"]}: {e}', origin='product_update', traceback=tb()
+                )
+            finally:
+                # Failed updates are acked too, like every other consumer, rather than redelivered forever
+                for ack in acks:
+                    ack()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.due:
+                    self.condition.wait()
+                self.condition.wait(timeout=max(0.0, min(self.due.values()) - time.monotonic()))
+            self.process(self.take())
+
+    def flush(self):
+        self.process(self.take(ready_only=False))
+
+
 def shutdown_handler(signum, frame):
     print('Received shutdown signal, stopping consumers...')
+    # Process pending product updates while their deliveries can still be acked
+    product_updates.flush()
     for consumer in consumers:
         consumer.stop_consuming()
     for thread in threads:
@@ -244,6 +485,7 @@ if __name__ == '__main__':
 
         threads = []
         consumers = []
+        product_updates = ProductUpdateQueue()
 
         queues = [
             {
@@ -261,6 +503,12 @@ if __name__ == '__main__':
                 'callback': process_shopify_order,
                 'error_handler': ProcessInErrorHandler,
             },
+            {
+                'queue_name': creds.Consumer.product_update,
+                'callback': product_updates.add,
+                'error_handler': ProcessInErrorHandler,
+                'manual_ack': True,
+            },
             {
                 'queue_name': creds.Consumer.design_lead_form,
                 'callback': process_design_lead,
@@ -270,7 +518,10 @@ if __name__ == '__main__':
 
         for queue in queues:
             consumer = RabbitMQConsumer(
-                queue_name=queue['queue_name'], callback_func=queue['callback'], eh=queue['error_handler']
+                queue_name=queue['queue_name'],
+                callback_func=queue['callback'],
+                eh=queue['error_handler'],
+                manual_ack=queue.get('manual_ack', False),
             )
             consumers.append(consumer)
             thread = threading.Thread(target=consumer.start_consuming)
@@ -3,14 +3,19 @@ from traceback import format_exc as tb
 
 import pika.exceptions
 from setup.error_handler import ProcessInErrorHandler
+import functools
 import pika
+import queue
 import sys
 import time
 import threading
 
 
 class RabbitMQConsumer:
-    def __init__(self, queue_name, callback_func, host='localhost', eh=ProcessInErrorHandler):
+    """Consumes a durable queue, acking each message once callback_func returns. With manual_ack,
+    callback_func also receives ack, a function that acks the message and may be called from any thread."""
+
+    def __init__(self, queue_name, callback_func, host='localhost', eh=ProcessInErrorHandler, manual_ack=False):
         self.eh = eh
         self.logger = self.eh.logger
         self.error_handler = self.eh.error_handler
@@ -20,6 +25,7 @@ class RabbitMQConsumer:
         self.channel = None
         self._stop_event = threading.Event()  # Add stop event
         self.callback_func = callback_func
+        self.manual_ack = manual_ack
 
     def connect(self):
         parameters = pika.ConnectionParameters(self.host)
@@ -30,19 +36,40 @@ class RabbitMQConsumer:
     def callback(self, ch, method, properties, body):
         body = body.decode()
         self.logger.info(f'{self.queue_name}: Received: {body}')
+        handed_off = False
         try:
-            self.callback_func(body, eh=self.eh)
+            if self.manual_ack:
+                self.callback_func(body, ack=functools.partial(self.ack, ch, method.delivery_tag), eh=self.eh)
+                handed_off = True
+            else:
+                self.callback_func(body, eh=self.eh)
         except Exception as err:
             error_type = 'Exception:'
             self.error_handler.add_error_v(
                 error=f'Error ({error_type}): {err}', origin=self.queue_name, traceback=tb()
             )
         else:
-            self.logger.success(f'Processing Finished at {datetime.now():%H:%M:%S}\n')
+            if not self.manual_ack:
+                self.logger.success(f'Processing Finished at {datetime.now():%H:%M:%S}\n')
         finally:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            if not handed_off:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
             self.error_handler.print_errors()
 
+    def ack(self, channel, delivery_tag):
+        """Acks a delivery from any thread. If its channel has closed since, the broker redelivers the
+        message instead."""
+
+        def basic_ack():
+            if channel.is_open:
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+        try:
+            if channel.is_open:
+                channel.connection.add_callback_threadsafe(basic_ack)
+        except Exception as err:
+            self.logger.warn(f'{self.queue_name}: could not ack delivery {delivery_tag}: {err}')
+
     def start_consuming(self):
         while not self._stop_event.is_set():  # Check stop event
             try:
@@ -76,5 +103,134 @@ class RabbitMQConsumer:
             self.connection.close()
 
 
+class RabbitMQPublisher:
+    """Publishes persistent messages over a pool of long-lived connections with publisher confirms. A pika
+    connection is not thread safe, so each pooled connection is used by one request thread at a time. Queues
+    are declared once, on the first connection. A broken connection is dropped from the pool and the publish
+    is retried on a fresh one. Idle connections are serviced in the background so heartbeats are answered."""
+
+    class Link:
+        def __init__(self, connection, channel):
+            self.connection = connection
+            self.channel = channel
+
+    def __init__(self, queues: list[str], host='localhost', size=4, timeout=5, eh=ProcessInErrorHandler):
+        self.eh = eh
+        self.logger = self.eh.logger
+        self.error_handler = self.eh.error_handler
+        self.queues = queues
+        self.host = host
+        self.size = size
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+        self.opened = 0
+        self.declared = False
+        self.lock = threading.Lock()
+        self.keepalive = None
+
+    def connect(self) -> 'RabbitMQPublisher.Link':
+        parameters = pika.ConnectionParameters(self.host, blocked_connection_timeout=self.timeout)
+        connection = pika.BlockingConnection(parameters)
+        channel = connection.channel()
+        channel.confirm_delivery()
+        with self.lock:
+            if not self.declared:
+                for queue_name in self.queues:
+                    channel.queue_declare(queue=queue_name, durable=True)
+                self.declared = True
+        return RabbitMQPublisher.Link(connection, channel)
+
+    def start(self):
+        """Opens the first connection, declares the queues and starts the keepalive thread. Called once at
+        startup. A publisher that was not started starts on its first publish."""
+        with self.lock:
+            if self.keepalive:
+                return
+            self.keepalive = threading.Thread(target=self.service_idle, daemon=True)
+            self.keepalive.start()
+        self.release(self.acquire())
+
+    def acquire(self) -> 'RabbitMQPublisher.Link':
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            grow = self.opened < self.size
+            if grow:
+                self.opened += 1
+        if not grow:
+            return self.pool.get(timeout=self.timeout)
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def release(self, link: 'RabbitMQPublisher.Link', broken=False):
+        if not broken:
+            self.pool.put(link)
+            return
+        with self.lock:
+            self.opened -= 1
+        try:
+            link.connection.close()
+        except Exception:
+            pass
+
+    def publish(self, queue_name: str, body: str, retries=1):
+        """Publishes body to a durable queue and waits for the broker to confirm it. Raises if the message
+        could not be confirmed."""
+        if not self.keepalive:
+            self.start()
+        properties = pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent)
+        for attempt in range(retries + 1):
+            link = self.acquire()
+            try:
+                link.channel.basic_publish(
+                    exchange='', routing_key=queue_name, body=body, properties=properties, mandatory=True
+                )
+            except pika.exceptions.UnroutableError:
+                # Queue is not declared (new queue or broker reset). Declare it and publish again.
+                broken = True
+                try:
+                    link.channel.queue_declare(queue=queue_name, durable=True)
+                    broken = False
+                finally:
+                    self.release(link, broken=broken)
+                if attempt == retries:
+                    raise
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+                self.release(link, broken=True)
+                if attempt == retries:
+                    raise
+            except Exception:
+                self.release(link, broken=True)
+                raise
+            else:
+                self.release(link)
+                return
+
+    def service_idle(self, interval=15):
+        """Lets idle connections process heartbeats and drops the ones the broker has closed"""
+        while True:
+            time.sleep(interval)
+            idle = []
+            while True:
+                try:
+                    idle.append(self.pool.get_nowait())
+                except queue.Empty:
+                    break
+            for link in idle:
+                try:
+                    link.connection.process_data_events(time_limit=0)
+                except Exception as err:
+                    self.logger.warn(f'RabbitMQ Publisher: dropping connection: {err}')
+                    self.release(link, broken=True)
+                else:
+                    self.release(link)
+
+
 if __name__ == '__main__':
     pass
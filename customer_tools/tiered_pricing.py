@@ -1,7 +1,6 @@
 from datetime import datetime
 
 from customer_tools.customers import is_current_customer, Customer
-from setup import creds
 from database import Database as db
 from setup.error_handler import ScheduledTasksErrorHandler as error_handler
 
@@ -58,24 +57,13 @@ def reassess_tiered_pricing(start_date, end_date, demote=False):
     error_handler.logger.info(f'Assessment Start Date: {start_date:%m/%d/%Y}')
     error_handler.logger.info(f'Assessment End Date: {end_date:%m/%d/%Y}')
 
-    sales_history_query = f"""
-    "{creds.SQL.DATABASE}"."dbo"."USP_RPT_SA_BY_X";1 
-    'select distinct AR_CUST.CUST_NO as GRP_ID, AR_CUST.NAM as GRP_DESCR 
-    from AR_CUST where ((AR_CUST.CATEG_COD = ''WHOLESALE'')) 
-    union 
-    select distinct VI_PS_TKT_HIST.CUST_NO as GRP_ID, NULL as GRP_DESCR 
-    from %HISTORY% 
-    where not exists(select 1 from AR_CUST where AR_CUST.CUST_NO = VI_PS_TKT_HIST.CUST_NO) and ( (1=1) ) and ( (1=1) ) 
-    and %ANYPERIODFILTER%', 'select VI_PS_TKT_HIST.CUST_NO as GRP_ID, %HISTCOLUMNS% from %HISTORY% where ( (1=1) ) and 
-    ( (1=1) ) and %PERIODFILTER%', ' 
-    (VI_PS_TKT_HIST.POST_DAT >= ''{start_date}'') and 
-    (VI_PS_TKT_HIST.POST_DAT <= ''{end_date}'')', ' (1=0) ', ' 
-    (1=0) ', 0, 0, 'SLS_EXT_PRC_A - RTN_EXT_PRC_VALID_A - RTN_EXT_PRC_NONVALID_A', 2
-    """
-
-    wholesale_customers_during_period = db.query(sales_history_query)
+    wholesale_customers_during_period = [
+        (x['GRP_ID'], x['GRP_DESCR'], x['SLS_AMT'])
+        for x in db.SalesHistory.summarize('CUST_NO', start_date, end_date, cust_categ='WHOLESALE')
+        if x['GRP_ID']
+    ]
 
-    if wholesale_customers_during_period is not None:
+    if wholesale_customers_during_period:
         for i in wholesale_customers_during_period:
             customer_number = i[0]
 
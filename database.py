@@ -3,15 +3,189 @@ import math
 from setup import creds
 from shortuuid import ShortUUID
 from setup.creds import Table
-from setup.utilities import PhoneNumber, EmailAddress
+from setup.utilities import PhoneNumber, EmailAddress, LRUCache
 from setup.error_handler import ProcessOutErrorHandler, ProcessInErrorHandler, LeadFormErrorHandler
 from datetime import datetime, timedelta
 from traceback import format_exc as tb
 from time import sleep
+import functools
+import inspect
+import json
 import re
+import threading
+import time
 import pyodbc
 
 
+class ConnectionPool:
+    """Bounded, thread-safe pool of pyodbc connections shared by every Database.query call in the process.
+    Idle connections are pinged before reuse and recycled once they exceed their max lifetime."""
+
+    # pyodbc SQLSTATE prefixes that indicate the connection itself is no longer usable
+    broken_states = ('08', 'HYT')
+
+    class Connection:
+        def __init__(self, connection):
+            self.connection = connection
+            self.created = time.monotonic()
+            self.last_used = self.created
+
+    def __init__(self, connection_string, size, timeout, max_lifetime, health_check):
+        self.connection_string = connection_string
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.idle: list[ConnectionPool.Connection] = []
+        self.open_count = 0
+        self.lock = threading.Condition()
+        # Counters
+        self.hits = 0
+        self.waits = 0
+        self.opens = 0
+        self.recycled = 0
+        self.discarded = 0
+
+    def __str__(self):
+        stats = self.stats()
+        return ', '.join(f'{k}: {v}' for k, v in stats.items())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': self.size,
+                'open': self.open_count,
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'waits': self.waits,
+                'opens': self.opens,
+                'recycled': self.recycled,
+                'discarded': self.discarded,
+            }
+
+    def connect(self):
+        connection = pyodbc.connect(self.connection_string, autocommit=True)
+        connection.setdecoding(pyodbc.SQL_CHAR, encoding='utf-16-le')
+        connection.setencoding('utf-16-le')
+        with self.lock:
+            self.opens += 1
+        return ConnectionPool.Connection(connection)
+
+    def is_healthy(self, conn: 'ConnectionPool.Connection') -> bool:
+        """Recycle connections past their lifetime and ping connections that have been idle too long."""
+        now = time.monotonic()
+        if now - conn.created > self.max_lifetime:
+            with self.lock:
+                self.recycled += 1
+            return False
+        if now - conn.last_used > self.health_check:
+            try:
+                cursor = conn.connection.cursor()
+                cursor.execute('SELECT 1').fetchall()
+                cursor.close()
+            except pyodbc.Error:
+                return False
+        return True
+
+    def acquire(self) -> 'ConnectionPool.Connection':
+        deadline = time.monotonic() + self.timeout
+        with self.lock:
+            waited = False
+            while not self.idle and self.open_count >= self.size:
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'No database connection available after {self.timeout} seconds. {self}')
+                self.lock.wait(remaining)
+
+            if self.idle:
+                conn = self.idle.pop()
+                self.hits += 1
+            else:
+                conn = None
+                self.open_count += 1
+
+        if conn is not None:
+            if self.is_healthy(conn):
+                return conn
+            ConnectionPool.close(conn)
+
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.open_count -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, conn: 'ConnectionPool.Connection', broken=False):
+        if broken:
+            ConnectionPool.close(conn)
+            with self.lock:
+                self.open_count -= 1
+                self.discarded += 1
+                self.lock.notify()
+            return
+
+        conn.last_used = time.monotonic()
+        with self.lock:
+            self.idle.append(conn)
+            self.lock.notify()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.open_count -= len(idle)
+            self.lock.notify_all()
+        for conn in idle:
+            ConnectionPool.close(conn)
+
+    @staticmethod
+    def close(conn: 'ConnectionPool.Connection'):
+        try:
+            conn.connection.close()
+        except pyodbc.Error:
+            pass
+
+    @staticmethod
+    def is_broken(error: pyodbc.Error) -> bool:
+        return bool(error.args) and str(error.args[0]).startswith(ConnectionPool.broken_states)
+
+
+
+def cached_id_lookup(result_tag=None):
+    """Read-through Database.id_cache for single-row middleware ID lookups keyed by item number, binding ID,
+    product ID, or variant ID. Entries are tagged with those arguments and, when result_tag is given, with the
+    value returned, so the middleware write paths can invalidate exactly the lookups they affect. Calls with any
+    other argument set (e.g. image_id, all) go straight to the database."""
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            if any(v for k, v in arguments.items() if k not in Database.id_tags and k != 'eh'):
+                return func(*args, **kwargs)
+
+            lookup = tuple(sorted((k, v) for k, v in arguments.items() if k in Database.id_tags and v))
+            tags = [f'{Database.id_tags[k]}:{v}' for k, v in lookup]
+
+            def get_tags(result):
+                if result_tag and result is not None:
+                    return tags + [f'{result_tag}:{result}']
+                return tags
+
+            result = Database.id_cache.get((func.__qualname__, lookup), lambda: func(*args, **kwargs), get_tags)
+            return list(result) if isinstance(result, list) else result
+
+        return wrapper
+
+    return decorator
+
+
 class Database:
     SERVER = creds.SQL.SERVER
     DATABASE = creds.SQL.DATABASE
@@ -21,29 +195,58 @@ class Database:
     error_handler = ProcessOutErrorHandler.error_handler
     logger = ProcessOutErrorHandler.logger
 
-    def query(query, mapped=False):
-        """Runs Query Against SQL Database. Use Commit Kwarg for updating database"""
-        connection_string = f"""
+    connection_string = f"""
         DRIVER={{ODBC Driver 18 for SQL Server}};
-        SERVER={Database.SERVER};
-        PORT={Database.PORT};
-        DATABASE={Database.DATABASE};
-        UID={Database.USERNAME};
-        PWD={Database.PASSWORD};
+        SERVER={SERVER};
+        PORT={PORT};
+        DATABASE={DATABASE};
+        UID={USERNAME};
+        PWD={PASSWORD};
         TrustServerCertificate=yes;
         timeout=3;
         ansi=True;
         """
 
-        connection = pyodbc.connect(connection_string, autocommit=True)
+    pool = ConnectionPool(
+        connection_string=connection_string,
+        size=creds.SQL.POOL_SIZE,
+        timeout=creds.SQL.POOL_TIMEOUT,
+        max_lifetime=creds.SQL.POOL_MAX_LIFETIME,
+        health_check=creds.SQL.POOL_HEALTH_CHECK,
+    )
+
+    # SQL Server accepts at most 2100 parameters per statement
+    batch_size = 1000
+    deadlock_retries = 3
+
+    # Middleware ID lookups (see cached_id_lookup). Argument name: tag prefix
+    id_cache = LRUCache(maxsize=creds.SQL.ID_CACHE_SIZE, name='Middleware ID Cache', ttl=creds.SQL.ID_CACHE_TTL)
+    id_tags = {'item_no': 'item', 'sku': 'item', 'binding_id': 'binding', 'product_id': 'product'}
+
+    def query(query, mapped=False, params=None, attempt=0):
+        """Runs Query Against SQL Database. Use params to bind values to ? placeholders in the query.
+        Errors are logged and returned as a dict with a code, or None, never raised."""
+        conn = Database.pool.acquire()
+        broken = False
+        retry = False
+        sql_data = None
 
-        connection.setdecoding(pyodbc.SQL_CHAR, encoding='utf-16-le')
-        connection.setencoding('utf-16-le')
+        try:
+            cursor = conn.connection.cursor()
+        except pyodbc.Error:
+            # Connection was dropped by the server while idle. Replace it and continue.
+            Database.pool.release(conn, broken=True)
+            conn = Database.pool.acquire()
+            try:
+                cursor = conn.connection.cursor()
+            except Exception as e:
+                Database.pool.release(conn, broken=True)
+                Database.error_handler.add_error_v(error=e, origin='database.py', traceback=tb())
+                return None
 
-        cursor = connection.cursor()
         query = str(query).strip()
         try:
-            response = cursor.execute(query)
+            response = cursor.execute(query, params) if params else cursor.execute(query)
             sql_data = response.fetchall()
         except pyodbc.ProgrammingError as e:
             if e.args[0] == 'No results.  Previous SQL was not a query.':
@@ -64,20 +267,21 @@ class Database:
                     sql_data = {'code': f'{e.args[0]}', 'query': query, 'message': 'Unknown Error'}
 
         except pyodbc.Error as e:
-            if e.args[0] == '40001':
+            if e.args[0] == '40001' and attempt < Database.deadlock_retries:
                 Database.logger.warn('Deadlock Detected. Retrying Query')
-                sleep(1)
-                Database.query(query)
+                retry = True
             else:
+                broken = ConnectionPool.is_broken(e)
                 sql_data = {'code': f'{e.args[0]}', 'message': f'{e.args[1]}', 'query': query}
 
         except KeyboardInterrupt:
             Database.logger.warn('Keyboard Interrupt. Query Cancelled.')
+            broken = True
             raise KeyboardInterrupt
 
         except Exception as e:
+            broken = True
             Database.error_handler.add_error_v(error=e, origin='database.py', traceback=tb())
-            raise Exception(e)
         else:
             if mapped:
                 column_response = cursor.description
@@ -100,9 +304,51 @@ class Database:
 
                 sql_data = {'code': code, 'message': message, 'rows': row_count, 'data': mapped_response}
         finally:
-            cursor.close()
-            connection.close()
-            return sql_data if sql_data else None
+            try:
+                cursor.close()
+            except pyodbc.Error:
+                broken = True
+            # Return the connection to the pool before any retry so a deadlock retry never holds two connections
+            Database.pool.release(conn, broken=broken)
+
+        if retry:
+            sleep(1)
+            return Database.query(query, mapped=mapped, params=params, attempt=attempt + 1)
+
+        return sql_data if sql_data else None
+
+    def query_batch(query, keys, mapped=False, params=None, batch_size=None):
+        """Runs a query with an IN-list of bound parameters once per chunk of keys and returns the combined rows.
+        The query must contain a {keys} placeholder, e.g. SELECT ... WHERE ITEM_NO IN ({keys}).
+        Additional params are bound before the keys."""
+        keys = list(dict.fromkeys(x for x in keys if x is not None))  # Unique, ordered, no nulls
+        if not keys:
+            return []
+
+        batch_size = batch_size or Database.batch_size
+        params = list(params) if params else []
+        result = []
+
+        for i in range(0, len(keys), batch_size):
+            chunk = keys[i : i + batch_size]
+            chunk_query = query.replace('{keys}', ', '.join('?' * len(chunk)))
+            response = Database.query(chunk_query, mapped=mapped, params=params + chunk)
+
+            if mapped:
+                if response['code'] == 200:
+                    result += response['data']
+                elif response['code'] != 201:
+                    Database.error_handler.add_error_v(
+                        error=f'Batch query failed. Response: {response}', origin='Database.query_batch'
+                    )
+            elif isinstance(response, dict):
+                Database.error_handler.add_error_v(
+                    error=f'Batch query failed. Response: {response}', origin='Database.query_batch'
+                )
+            elif response:
+                result += response
+
+        return result
 
     def sql_scrub(string):
         """Sanitize a string for use in SQL queries."""
@@ -256,6 +502,290 @@ class Database:
         for table in tables:
             Database.query(tables[table])
 
+    class ChangeTracking:
+        """SQL Server Change Tracking feed for the sync queues. Each consumer stores the change version it last
+        read and gets the exact keys changed since then from CHANGETABLE, instead of polling LST_MAINT_DT."""
+
+        version_file = './integration/change_versions.json'
+        lock = threading.Lock()
+        # Tracked table: key column returned to consumers
+        tables = {
+            Table.CP.Item.table: 'ITEM_NO',
+            'IM_INV': 'ITEM_NO',
+            'IM_PRC': 'ITEM_NO',
+            Table.CP.Customers.table: 'CUST_NO',
+            'EC_CATEG': 'CATEG_ID',
+        }
+
+        def enable(retention_days=2):
+            """One-time setup. Enables change tracking on the database and on each tracked table."""
+            Database.query(
+                f'ALTER DATABASE [{creds.SQL.DATABASE}] SET CHANGE_TRACKING = ON '
+                f'(CHANGE_RETENTION = {int(retention_days)} DAYS, AUTO_CLEANUP = ON)'
+            )
+            for table in Database.ChangeTracking.tables:
+                query = f"""
+                IF NOT EXISTS (SELECT 1 FROM sys.change_tracking_tables WHERE object_id = OBJECT_ID('{table}'))
+                ALTER TABLE {table} ENABLE CHANGE_TRACKING"""
+                Database.query(query)
+
+        def current_version() -> int:
+            response = Database.query('SELECT CHANGE_TRACKING_CURRENT_VERSION()')
+            return response[0][0] if response else None
+
+        def get_changes(table: str, since: int) -> set | None:
+            """Returns the keys changed in a table after a change version. Returns None when the version is
+            missing or older than the retention window, in which case the caller must do a full timestamp sync."""
+            if since is None:
+                return None
+            response = Database.query(f"SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('{table}'))")
+            if not response or response[0][0] is None or since < response[0][0]:
+                Database.logger.warn(f'Change tracking version {since} is no longer valid for {table}.')
+                return None
+
+            key = Database.ChangeTracking.tables[table]
+            response = Database.query(
+                f'SELECT DISTINCT CT.{key} FROM CHANGETABLE(CHANGES {table}, ?) AS CT', params=(since,)
+            )
+            if isinstance(response, dict):
+                Database.error_handler.add_error_v(
+                    error=f'Error reading changes for {table}. Response: {response}',
+                    origin='Database.ChangeTracking.get_changes',
+                )
+                return None
+            return {x[0] for x in response} if response else set()
+
+        def get_version(consumer: str) -> int:
+            with Database.ChangeTracking.lock:
+                try:
+                    with open(Database.ChangeTracking.version_file) as file:
+                        return json.load(file).get(consumer)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    return None
+
+        def set_version(consumer: str, version: int):
+            with Database.ChangeTracking.lock:
+                try:
+                    with open(Database.ChangeTracking.version_file) as file:
+                        versions = json.load(file)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    versions = {}
+                versions[consumer] = version
+                with open(Database.ChangeTracking.version_file, 'w') as file:
+                    json.dump(versions, file)
+
+    class ChangeFeed:
+        """Keys changed since a consumer's last completed cycle. Read the changes at the start of a cycle and
+        call commit() once the cycle finishes. Each attribute is None when a full sync is needed instead."""
+
+        def __init__(self, consumer: str):
+            self.consumer = consumer
+            self.version = Database.ChangeTracking.current_version()
+            since = Database.ChangeTracking.get_version(consumer)
+            get_changes = Database.ChangeTracking.get_changes
+
+            self.items = Database.ChangeFeed.union(
+                get_changes(Table.CP.Item.table, since), get_changes('IM_INV', since), get_changes('IM_PRC', since)
+            )
+            self.customers = get_changes(Table.CP.Customers.table, since)
+            self.categories = get_changes('EC_CATEG', since)
+
+        def __str__(self):
+            def count(x):
+                return 'full sync' if x is None else len(x)
+
+            return (
+                f'Change Feed ({self.consumer}) at version {self.version}: items: {count(self.items)}, '
+                f'customers: {count(self.customers)}, categories: {count(self.categories)}\n'
+            )
+
+        @staticmethod
+        def union(*changes) -> set | None:
+            if any(x is None for x in changes):
+                return None
+            return set().union(*changes)
+
+        def commit(self):
+            if self.version is not None:
+                Database.ChangeTracking.set_version(self.consumer, self.version)
+
+    class SalesHistory:
+        """Materialized daily sales by item, customer, category and store, aggregated from PS_TKT_HIST and
+        PS_TKT_HIST_LIN. Reports read from this table instead of running USP_RPT_SA_BY_X over all ticket history.
+        Only the scheduled Sales History task writes it. refresh() re-aggregates the last few business days, so the
+        task runs hourly. summarize() and summarize_windows() only read."""
+
+        lock = threading.Lock()
+        # Group column: (description table, key column, description column)
+        groups = {
+            'ITEM_NO': (Table.CP.Item.table, 'ITEM_NO', 'DESCR'),
+            'CUST_NO': (Table.CP.Customers.table, 'CUST_NO', 'NAM'),
+            'CATEG_COD': ('IM_CATEG_COD', 'CATEG_COD', 'DESCR'),
+            'STR_ID': ('PS_STR', 'STR_ID', 'DESCR'),
+        }
+
+        def create_table():
+            query = f"""
+            IF OBJECT_ID('{Table.Middleware.sales_history}', 'U') IS NULL
+            CREATE TABLE {Table.Middleware.sales_history} (
+            BUS_DAT date NOT NULL,
+            STR_ID varchar(10) NOT NULL,
+            ITEM_NO varchar(50) NOT NULL,
+            CUST_NO varchar(50) NOT NULL,
+            CATEG_COD varchar(20),
+            SLS_QTY decimal(15, 4) NOT NULL DEFAULT(0),
+            SLS_AMT decimal(15, 2) NOT NULL DEFAULT(0),
+            RTN_QTY decimal(15, 4) NOT NULL DEFAULT(0),
+            RTN_AMT decimal(15, 2) NOT NULL DEFAULT(0),
+            PRIMARY KEY (BUS_DAT, STR_ID, ITEM_NO, CUST_NO),
+            INDEX IX_{Table.Middleware.sales_history}_ITEM (ITEM_NO, BUS_DAT),
+            INDEX IX_{Table.Middleware.sales_history}_CUST (CUST_NO, BUS_DAT)
+            )"""
+            return Database.query(query)
+
+        def refresh(start_date=None, build=False, eh=ProcessOutErrorHandler):
+            """Re-aggregates every business day from start_date on. By default starts SALES_HISTORY_LOOKBACK days
+            before the last aggregated day. An empty table is only loaded from SALES_HISTORY_START when build is
+            True, since the initial load aggregates all ticket history. The scheduled task builds it."""
+            with Database.SalesHistory.lock:
+                Database.SalesHistory.create_table()
+                if start_date is None:
+                    response = Database.query(f'SELECT MAX(BUS_DAT) FROM {Table.Middleware.sales_history}')
+                    if response and response[0][0]:
+                        start_date = response[0][0] - timedelta(days=creds.SQL.SALES_HISTORY_LOOKBACK)
+                    elif build:
+                        start_date = creds.SQL.SALES_HISTORY_START
+                    else:
+                        eh.logger.warn('Sales history has not been built. Run the Sales History task.')
+                        return {'code': 201, 'message': 'Sales history has not been built'}
+
+                # A single MERGE keeps the refresh atomic: readers see either the old or the new days, never a gap.
+                query = f"""
+                WITH TARGET AS (SELECT * FROM {Table.Middleware.sales_history} WHERE BUS_DAT >= ?)
+                MERGE TARGET
+                USING (
+                    SELECT CAST(H.BUS_DAT AS date) AS BUS_DAT, H.STR_ID, L.ITEM_NO,
+                    ISNULL(H.CUST_NO, '') AS CUST_NO, MAX(L.CATEG_COD) AS CATEG_COD,
+                    SUM(CASE WHEN L.LIN_TYP = 'S' THEN L.QTY_SOLD ELSE 0 END) AS SLS_QTY,
+                    SUM(CASE WHEN L.LIN_TYP = 'S' THEN L.EXT_PRC ELSE 0 END) AS SLS_AMT,
+                    SUM(CASE WHEN L.LIN_TYP = 'R' THEN ABS(L.QTY_SOLD) ELSE 0 END) AS RTN_QTY,
+                    SUM(CASE WHEN L.LIN_TYP = 'R' THEN ABS(L.EXT_PRC) ELSE 0 END) AS RTN_AMT
+                    FROM PS_TKT_HIST H
+                    INNER JOIN PS_TKT_HIST_LIN L ON L.BUS_DAT = H.BUS_DAT AND L.DOC_ID = H.DOC_ID
+                    WHERE H.BUS_DAT >= ? AND L.ITEM_NO IS NOT NULL AND L.LIN_TYP IN ('S', 'R')
+                    GROUP BY CAST(H.BUS_DAT AS date), H.STR_ID, L.ITEM_NO, ISNULL(H.CUST_NO, '')
+                ) AS SOURCE
+                ON TARGET.BUS_DAT = SOURCE.BUS_DAT AND TARGET.STR_ID = SOURCE.STR_ID
+                AND TARGET.ITEM_NO = SOURCE.ITEM_NO AND TARGET.CUST_NO = SOURCE.CUST_NO
+                WHEN MATCHED THEN
+                    UPDATE SET CATEG_COD = SOURCE.CATEG_COD, SLS_QTY = SOURCE.SLS_QTY, SLS_AMT = SOURCE.SLS_AMT,
+                    RTN_QTY = SOURCE.RTN_QTY, RTN_AMT = SOURCE.RTN_AMT
+                WHEN NOT MATCHED BY TARGET THEN
+                    INSERT (BUS_DAT, STR_ID, ITEM_NO, CUST_NO, CATEG_COD, SLS_QTY, SLS_AMT, RTN_QTY, RTN_AMT)
+                    VALUES (SOURCE.BUS_DAT, SOURCE.STR_ID, SOURCE.ITEM_NO, SOURCE.CUST_NO, SOURCE.CATEG_COD,
+                    SOURCE.SLS_QTY, SOURCE.SLS_AMT, SOURCE.RTN_QTY, SOURCE.RTN_AMT)
+                WHEN NOT MATCHED BY SOURCE THEN DELETE;"""
+                response = Database.query(query, params=(start_date, start_date))
+                if response['code'] not in (200, 201):
+                    eh.error_handler.add_error_v(
+                        error=f'Error refreshing sales history from {start_date}. Response: {response}',
+                        origin='Database.SalesHistory.refresh',
+                    )
+                return response
+
+        def summarize(
+            group_by: str,
+            start_date,
+            end_date,
+            str_id: str = None,
+            categ_cod: str = None,
+            binding_id: str = None,
+            cust_categ: str = None,
+            order_by: str = 'REVENUE',
+            limit: int = 0,
+        ) -> list[dict]:
+            """Returns sales between two business days (inclusive) grouped by ITEM_NO, CUST_NO, CATEG_COD or STR_ID.
+            Each row has GRP_ID, GRP_DESCR, SLS_QTY, SLS_AMT, RTN_QTY, RTN_AMT and the net QTY and REVENUE.
+            cust_categ limits sales to customers in an AR_CUST category, e.g. WHOLESALE.
+            Rows are sorted by order_by, descending for QTY and REVENUE. A limit of 0 returns every group."""
+            if group_by not in Database.SalesHistory.groups:
+                raise ValueError(f'Cannot group sales history by {group_by}')
+
+            table, key, description = Database.SalesHistory.groups[group_by]
+            where = ['S.BUS_DAT >= ?', 'S.BUS_DAT <= ?']
+            params = [start_date, end_date]
+            if str_id is not None:
+                where.append('S.STR_ID = ?')
+                params.append(str_id)
+            if categ_cod is not None:
+                where.append('S.CATEG_COD = ?')
+                params.append(categ_cod)
+            if binding_id is not None:
+                where.append(
+                    f'S.ITEM_NO IN (SELECT ITEM_NO FROM {Table.CP.Item.table} '
+                    f'WHERE {Table.CP.Item.Column.binding_id} = ?)'
+                )
+                params.append(binding_id)
+            if cust_categ is not None:
+                where.append(f'S.CUST_NO IN (SELECT CUST_NO FROM {Table.CP.Customers.table} WHERE CATEG_COD = ?)')
+                params.append(cust_categ)
+
+            order = 'S.' + group_by if order_by == 'GRP_ID' else f'{order_by} DESC'
+            query = f"""
+            SELECT {f'TOP {int(limit)} ' if limit else ''}S.{group_by} AS GRP_ID, MAX(D.{description}) AS GRP_DESCR,
+            SUM(S.SLS_QTY) AS SLS_QTY, SUM(S.SLS_AMT) AS SLS_AMT,
+            SUM(S.RTN_QTY) AS RTN_QTY, SUM(S.RTN_AMT) AS RTN_AMT,
+            SUM(S.SLS_QTY - S.RTN_QTY) AS QTY, SUM(S.SLS_AMT - S.RTN_AMT) AS REVENUE
+            FROM {Table.Middleware.sales_history} S
+            LEFT OUTER JOIN {table} D ON D.{key} = S.{group_by}
+            WHERE {' AND '.join(where)}
+            GROUP BY S.{group_by}
+            ORDER BY {order}"""
+            response = Database.query(query, mapped=True, params=params)
+            if response['code'] == 200:
+                return response['data']
+            if response['code'] != 201:
+                Database.error_handler.add_error_v(
+                    error=f'Error reading sales history by {group_by}. Response: {response}',
+                    origin='Database.SalesHistory.summarize',
+                )
+            return []
+
+        def summarize_windows(group_by: str, windows: list[tuple]) -> dict[tuple, list[dict]]:
+            """Runs summarize for many (start_date, end_date) windows in one query.
+            Returns {window: rows}, with rows in GRP_ID order and shaped like those from summarize."""
+            if group_by not in Database.SalesHistory.groups:
+                raise ValueError(f'Cannot group sales history by {group_by}')
+
+            windows = list(dict.fromkeys(windows))
+            result = {window: [] for window in windows}
+            if not windows:
+                return result
+
+            table, key, description = Database.SalesHistory.groups[group_by]
+            values = ', '.join('(?, CAST(? AS date), CAST(? AS date))' for _ in windows)
+            params = [x for i, (start_date, end_date) in enumerate(windows) for x in (i, start_date, end_date)]
+            query = f"""
+            SELECT W.WINDOW_ID, S.{group_by} AS GRP_ID, MAX(D.{description}) AS GRP_DESCR,
+            SUM(S.SLS_QTY) AS SLS_QTY, SUM(S.SLS_AMT) AS SLS_AMT,
+            SUM(S.RTN_QTY) AS RTN_QTY, SUM(S.RTN_AMT) AS RTN_AMT,
+            SUM(S.SLS_QTY - S.RTN_QTY) AS QTY, SUM(S.SLS_AMT - S.RTN_AMT) AS REVENUE
+            FROM (VALUES {values}) AS W (WINDOW_ID, START_DAT, END_DAT)
+            INNER JOIN {Table.Middleware.sales_history} S ON S.BUS_DAT >= W.START_DAT AND S.BUS_DAT <= W.END_DAT
+            LEFT OUTER JOIN {table} D ON D.{key} = S.{group_by}
+            GROUP BY W.WINDOW_ID, S.{group_by}
+            ORDER BY W.WINDOW_ID, S.{group_by}"""
+            response = Database.query(query, mapped=True, params=params)
+            if response['code'] == 200:
+                for row in response['data']:
+                    result[windows[row.pop('WINDOW_ID')]].append(row)
+            elif response['code'] != 201:
+                Database.error_handler.add_error_v(
+                    error=f'Error reading sales history windows by {group_by}. Response: {response}',
+                    origin='Database.SalesHistory.summarize_windows',
+                )
+            return result
+
     class DesignLead:
         def get(yesterday=True):
             if yesterday:
@@ -1808,6 +2338,66 @@ class Database:
                 except:
                     return None
 
+            def get_prices(item_nos: list[str]) -> dict[str, tuple]:
+                """Returns {item_no: (PRC_1, PRC_2)} for a list of items in a handful of round-trips."""
+                response = Database.query_batch(
+                    'SELECT ITEM_NO, PRC_1, PRC_2 FROM IM_PRC WHERE ITEM_NO IN ({keys})', keys=item_nos
+                )
+                return {x[0]: (x[1], x[2]) for x in response}
+
+            def get_binding_ids(item_nos: list[str]) -> dict[str, str]:
+                """Returns {item_no: binding_id} for a list of items. Items without a binding ID map to None."""
+                response = Database.query_batch(
+                    f'SELECT ITEM_NO, {Table.CP.Item.Column.binding_id} '
+                    f'FROM {Table.CP.Item.table} WHERE ITEM_NO IN ({{keys}})',
+                    keys=item_nos,
+                )
+                return {x[0]: x[1] for x in response}
+
+            def get_family_members(binding_ids: list[str], parents_only=False, web_enabled=True) -> dict[str, list]:
+                """Returns {binding_id: [item_no, ...]} for a list of binding IDs."""
+                query = f"""
+                SELECT {Table.CP.Item.Column.binding_id}, ITEM_NO
+                FROM {Table.CP.Item.table}
+                WHERE {Table.CP.Item.Column.binding_id} IN ({{keys}})"""
+                if web_enabled:
+                    query += f" AND {Table.CP.Item.Column.web_enabled} = 'Y'"
+                if parents_only:
+                    query += f" AND {Table.CP.Item.Column.is_parent} = 'Y'"
+
+                result = {}
+                for binding_id, item_no in Database.query_batch(query, keys=binding_ids):
+                    result.setdefault(binding_id, []).append(item_no)
+                return result
+
+            def get_inventory_changes(since: datetime) -> list[dict]:
+                """Returns the Shopify inventory ID, available quantity, and stock buffer of every synced
+                e-commerce item whose inventory changed since a given time. Preorder status is taken from the
+                parent of bound items, since the parent decides it for the whole family."""
+                query = f"""
+                SELECT ITEM.ITEM_NO, MW.INVENTORY_ID,
+                CAST(ISNULL(INV.QTY_AVAIL, 0) AS INTEGER) AS QTY_AVAIL,
+                CAST(ISNULL(ITEM.{Table.CP.Item.Column.buffer}, 0) AS INTEGER) AS BUFFER,
+                ISNULL(PARENT.{Table.CP.Item.Column.is_preorder_item},
+                ITEM.{Table.CP.Item.Column.is_preorder_item}) AS IS_PREORDER
+                FROM {Table.CP.Item.table} ITEM
+                INNER JOIN IM_INV INV ON ITEM.ITEM_NO = INV.ITEM_NO
+                INNER JOIN {Table.Middleware.products} MW ON ITEM.ITEM_NO = MW.ITEM_NO
+                LEFT OUTER JOIN {Table.CP.Item.table} PARENT
+                ON PARENT.{Table.CP.Item.Column.binding_id} = ITEM.{Table.CP.Item.Column.binding_id}
+                AND PARENT.{Table.CP.Item.Column.is_parent} = 'Y'
+                WHERE INV.LST_MAINT_DT > ? AND ITEM.{Table.CP.Item.Column.web_enabled} = 'Y'
+                AND MW.INVENTORY_ID IS NOT NULL"""
+                response = Database.query(query, mapped=True, params=(since,))
+                if response['code'] == 200:
+                    return response['data']
+                if response['code'] != 201:
+                    Database.error_handler.add_error_v(
+                        error=f'Error getting inventory changes. Response: {response}',
+                        origin='Database.CP.Product.get_inventory_changes',
+                    )
+                return []
+
             def get_retail_price(sku: str) -> float:
                 query = f"""
                 SELECT PRC_1
@@ -2800,7 +3390,8 @@ class Database:
                 if customer_no:
                     customer_filter = f"AND CP.CUST_NO = '{customer_no}'"
                 elif customer_list:
-                    customer_filter = f'AND CP.CUST_NO IN {tuple(customer_list)}'
+                    customers = ', '.join(f"'{x}'" for x in customer_list)
+                    customer_filter = f'AND CP.CUST_NO IN ({customers})'
                 else:
                     customer_filter = ''
 
@@ -3192,6 +3783,17 @@ class Database:
                     WHERE CUST_NO = '{cust_no}'"""
                     return Database.query(query)
 
+                def get_many(cust_nos: list[str]) -> dict[str, list]:
+                    """Returns {cust_no: [address rows]} for a list of customers."""
+                    query = f"""
+                    SELECT CUST_NO, FST_NAM, LST_NAM, ADRS_1, ADRS_2, CITY, STATE, ZIP_COD, CNTRY, PHONE_1
+                    FROM {Table.CP.customer_ship_addresses}
+                    WHERE CUST_NO IN ({{keys}})"""
+                    result = {}
+                    for row in Database.query_batch(query, keys=cust_nos):
+                        result.setdefault(row[0], []).append(tuple(row[1:]))
+                    return result
+
                 def insert(customer):
                     columns = ', '.join([x for x in customer.keys()])
                     values = ', '.join([f"'{x}'" for x in customer.values()])
@@ -3703,6 +4305,8 @@ class Database:
                 for table in tables:
                     Database.query(tables[table])
 
+                Database.Shopify.Product.Fingerprint.create_table()
+
             # Drop Tables
             def drop_tables():
                 tables = [
@@ -3751,6 +4355,14 @@ class Database:
                 response = Database.query(query)
                 return response[0][0] if response else None
 
+            def get_ids(cp_cust_nos: list[str]) -> dict[str, int]:
+                """Returns {cust_no: shopify_cust_id} for a list of Counterpoint customers."""
+                response = Database.query_batch(
+                    f'SELECT CUST_NO, SHOP_CUST_ID FROM {Table.Middleware.customers} WHERE CUST_NO IN ({{keys}})',
+                    keys=cp_cust_nos,
+                )
+                return {x[0]: x[1] for x in response}
+
             def exists(shopify_cust_no):
                 query = f"""
                         SELECT * FROM {Table.Middleware.customers}
@@ -4000,6 +4612,14 @@ class Database:
                     Database.error_handler.add_error_v(error=error)
                     raise Exception(error)
 
+            def get_sortable(collection_ids: list[int]) -> set[int]:
+                """Returns the collections in a list that are flagged for automatic sort ordering."""
+                response = Database.query_batch(
+                    'SELECT COLLECTION_ID, IMG_FILE FROM VI_SN_SHOP_CATEG WHERE COLLECTION_ID IN ({keys})',
+                    keys=[str(x) for x in collection_ids],
+                )
+                return {int(x[0]) for x in response if str(x[1]).lower().strip() == 'true'}
+
             def backfill_html_description(collection_id, description):
                 cp_categ_id = Database.Shopify.Collection.get_cp_categ_id(collection_id)
                 query = f"""
@@ -4045,6 +4665,12 @@ class Database:
                         product_list.append(Database.Shopify.Product.get_id(item_no=sku))
                     return product_list
 
+            def invalidate(item_no=None, product_id=None, binding_id=None):
+                """Drops cached ID lookups for a product after its middleware rows change."""
+                arguments = {'item_no': item_no, 'product_id': product_id, 'binding_id': binding_id}
+                Database.id_cache.invalidate(*[f'{Database.id_tags[k]}:{v}' for k, v in arguments.items() if v])
+
+            @cached_id_lookup(result_tag='product')
             def get_id(item_no=None, binding_id=None, image_id=None, video_id=None, all=False):
                 """Get product ID from SQL using image ID. If not found, return None."""
                 if all:
@@ -4077,6 +4703,20 @@ class Database:
                     Database.logger.warn('No product ID found for the given parameters.')
                     return None
 
+            def get_many(item_nos: list[str]) -> dict[str, dict]:
+                """Returns {item_no: middleware row} for a list of items in a handful of round-trips."""
+                query = f"""
+                SELECT ITEM_NO, ID, BINDING_ID, IS_PARENT, PRODUCT_ID, VARIANT_ID, INVENTORY_ID, CATEG_ID,
+                OPTION_ID, OPTION_VALUE_ID
+                FROM {Table.Middleware.products}
+                WHERE ITEM_NO IN ({{keys}})"""
+                return {x['ITEM_NO']: x for x in Database.query_batch(query, keys=item_nos, mapped=True)}
+
+            def get_ids(item_nos: list[str]) -> dict[str, int]:
+                """Returns {item_no: product_id} for a list of items. Items not in the middleware are omitted."""
+                return {k: v['PRODUCT_ID'] for k, v in Database.Shopify.Product.get_many(item_nos).items()}
+
+            @cached_id_lookup(result_tag='item')
             def get_parent_item_no(product_id=None, binding_id=None, eh=ProcessOutErrorHandler):
                 if not product_id and not binding_id:
                     eh.error_handler.add_error_v(
@@ -4101,6 +4741,7 @@ class Database:
                     except:
                         return None
 
+            @cached_id_lookup(result_tag='item')
             def get_sku(product_id):
                 if product_id:
                     query = f"""
@@ -4117,6 +4758,7 @@ class Database:
                     except:
                         return None
 
+            @cached_id_lookup(result_tag='binding')
             def get_binding_id(product_id):
                 if product_id:
                     query = f"""
@@ -4133,6 +4775,56 @@ class Database:
                     except KeyError:
                         return None
 
+            class Fingerprint:
+                """Content hashes of the payload sections last sent to Shopify for each product."""
+
+                def create_table():
+                    query = f"""
+                    IF OBJECT_ID('{Table.Middleware.product_fingerprints}', 'U') IS NULL
+                    CREATE TABLE {Table.Middleware.product_fingerprints} (
+                    ITEM_NO varchar(50) NOT NULL PRIMARY KEY,
+                    PRODUCT_ID bigint,
+                    HASH char(64) NOT NULL,
+                    SECTIONS nvarchar(max) NOT NULL,
+                    LST_MAINT_DT datetime NOT NULL DEFAULT(current_timestamp)
+                    )"""
+                    return Database.query(query)
+
+                def get(item_no: str) -> dict:
+                    """Returns {section: hash} for a product, or an empty dict if it has not been synced."""
+                    return Database.Shopify.Product.Fingerprint.get_many([item_no]).get(item_no, {})
+
+                def get_many(item_nos: list[str]) -> dict[str, dict]:
+                    """Returns {item_no: {section: hash}} for a list of products."""
+                    query = f"""
+                    SELECT ITEM_NO, SECTIONS
+                    FROM {Table.Middleware.product_fingerprints}
+                    WHERE ITEM_NO IN ({{keys}})"""
+                    return {x[0]: json.loads(x[1]) for x in Database.query_batch(query, keys=item_nos)}
+
+                def upsert(item_no: str, product_id: int, product_hash: str, sections: dict):
+                    query = f"""
+                    MERGE {Table.Middleware.product_fingerprints} AS target
+                    USING (SELECT ? AS ITEM_NO) AS source ON target.ITEM_NO = source.ITEM_NO
+                    WHEN MATCHED THEN
+                        UPDATE SET PRODUCT_ID = ?, HASH = ?, SECTIONS = ?, LST_MAINT_DT = GETDATE()
+                    WHEN NOT MATCHED THEN
+                        INSERT (ITEM_NO, PRODUCT_ID, HASH, SECTIONS) VALUES (?, ?, ?, ?);"""
+                    sections = json.dumps(sections, sort_keys=True)
+                    params = (item_no, product_id, product_hash, sections, item_no, product_id, product_hash, sections)
+                    response = Database.query(query, params=params)
+                    if response['code'] != 200:
+                        Database.error_handler.add_error_v(
+                            error=f'Error saving fingerprint for {item_no}. Response: {response}',
+                            origin='Database.Shopify.Product.Fingerprint.upsert',
+                        )
+                    return response
+
+                def delete(product_id: int):
+                    if product_id:
+                        query = f'DELETE FROM {Table.Middleware.product_fingerprints} WHERE PRODUCT_ID = ?'
+                        return Database.query(query, params=(product_id,))
+
             def sync(product, eh=ProcessOutErrorHandler, verbose=False):
                 for variant in product.variants:
                     if variant.mw_db_id:
@@ -4165,6 +4857,8 @@ class Database:
                     return
 
                 response = Database.query(query)
+                Database.Shopify.Product.Fingerprint.delete(product_id)
+                Database.id_cache.clear()  # Item and binding lookups for the product may be cached
 
                 if response['code'] == 200:
                     Database.logger.success(f'Product {product_id} deleted from Middleware.')
@@ -4186,6 +4880,7 @@ class Database:
                 response = Database.query(query)
                 return [x[0] for x in response] if response else None
 
+            @cached_id_lookup()
             def get_collection_ids(item_no=None, binding_id=None, product_id=None):
                 if item_no:
                     query = f"""
@@ -4212,6 +4907,37 @@ class Database:
                 except:
                     return []
 
+            def get_collection_ids_many(product_ids: list[int]) -> dict[int, list[int]]:
+                """Returns {product_id: [collection_id, ...]} for a list of products."""
+                response = Database.query_batch(
+                    f'SELECT PRODUCT_ID, CATEG_ID FROM {Table.Middleware.products} WHERE PRODUCT_ID IN ({{keys}})',
+                    keys=product_ids,
+                )
+                result = {}
+                for product_id, categ_ids in response:
+                    collection_ids = result.setdefault(int(product_id), [])
+                    for x in (categ_ids or '').split(','):
+                        if x.strip() and int(x) not in collection_ids:
+                            collection_ids.append(int(x))
+                return result
+
+            def get_stock_status() -> dict[int, bool]:
+                """Returns {product_id: in_stock} for every synced product from Counterpoint inventory. A product
+                is in stock when any of its variants has buffered stock, or when it is an upcoming preorder."""
+                query = f"""
+                SELECT MW.PRODUCT_ID,
+                MAX(CASE WHEN ISNULL(INV.QTY_AVAIL, 0) - ISNULL(ITEM.{Table.CP.Item.Column.buffer}, 0) > 0
+                OR (ITEM.{Table.CP.Item.Column.is_preorder_item} = 'Y'
+                AND ITEM.{Table.CP.Item.Column.preorder_release_date} > GETDATE())
+                THEN 1 ELSE 0 END) AS IN_STOCK
+                FROM {Table.Middleware.products} MW
+                INNER JOIN {Table.CP.Item.table} ITEM ON ITEM.ITEM_NO = MW.ITEM_NO
+                LEFT OUTER JOIN IM_INV INV ON INV.ITEM_NO = MW.ITEM_NO
+                WHERE MW.PRODUCT_ID IS NOT NULL
+                GROUP BY MW.PRODUCT_ID"""
+                response = Database.query(query)
+                return {int(product_id): bool(in_stock) for product_id, in_stock in response or []}
+
             def add_collection_id(collection_id: int, item_no=None, binding_id=None, product_id=None, eh=None):
                 if eh is None:
                     eh = Database
@@ -4228,6 +4954,7 @@ class Database:
                     WHERE ITEM_NO = '{item_no}'
                     """
                     response = Database.query(query)
+                    Database.Shopify.Product.invalidate(item_no, product_id, binding_id)
                     if response['code'] == 200:
                         eh.logger.success(f'Collection ID added to {item_no}')
                     elif response['code'] == 201:
@@ -4252,6 +4979,7 @@ class Database:
                     WHERE ITEM_NO = '{item_no}'
                     """
                     response = Database.query(query)
+                    Database.Shopify.Product.invalidate(item_no, product_id, binding_id)
                     if response['code'] == 200:
                         eh.logger.success(f'Collection ID removed from {item_no}')
                     else:
@@ -4260,6 +4988,7 @@ class Database:
                         )
 
             class Variant:
+                @cached_id_lookup()
                 def get_id(sku):
                     if sku:
                         query = f"""
@@ -4273,6 +5002,7 @@ class Database:
                     if response is not None:
                         return response[0][0]
 
+                @cached_id_lookup()
                 def get_option_id(sku):
                     if sku:
                         query = f"""
@@ -4286,6 +5016,7 @@ class Database:
                     if response is not None:
                         return response[0][0]
 
+                @cached_id_lookup()
                 def get_option_value_id(sku):
                     if sku:
                         query = f"""
@@ -4347,6 +5078,7 @@ class Database:
                         )
                         """
                     response = Database.query(insert_query)
+                    Database.Shopify.Product.invalidate(variant.sku, product.product_id, product.binding_id)
                     if response['code'] == 200:
                         if verbose:
                             eh.logger.success(
@@ -4403,6 +5135,7 @@ class Database:
                         WHERE ID = {variant.mw_db_id}
                         """
                     response = Database.query(update_query)
+                    Database.Shopify.Product.invalidate(variant.sku, product.product_id, product.binding_id)
                     if response['code'] == 200:
                         if verbose:
                             eh.logger.success(
@@ -4532,6 +5265,7 @@ class Database:
                         eh.logger.warn('No variant ID provided for deletion.')
                         return
                     response = Database.query(query)
+                    Database.id_cache.clear()  # Cached lookups are not keyed by variant ID
 
                     if response['code'] == 200:
                         if verbose:
@@ -5087,6 +5821,56 @@ class Database:
                     else:
                         return f'Webhook {hook_id} deleted'
 
+            class Event:
+                """Event ids of received webhooks, so retried deliveries are dropped after a restart."""
+
+                def create_table():
+                    query = f"""
+                    IF OBJECT_ID('{Table.Middleware.webhook_events}', 'U') IS NULL
+                    CREATE TABLE {Table.Middleware.webhook_events} (
+                    EVENT_ID varchar(100) NOT NULL PRIMARY KEY,
+                    TOPIC varchar(50),
+                    RCV_DT datetime NOT NULL DEFAULT(current_timestamp),
+                    INDEX IX_{Table.Middleware.webhook_events}_RCV_DT (RCV_DT)
+                    )"""
+                    return Database.query(query)
+
+                def get(since: datetime) -> list[tuple[str, datetime]]:
+                    """Returns (event_id, received) for events received since a date, oldest first."""
+                    query = f"""
+                    SELECT EVENT_ID, RCV_DT FROM {Table.Middleware.webhook_events}
+                    WHERE RCV_DT >= ? ORDER BY RCV_DT"""
+                    response = Database.query(query, params=(since,))
+                    return [(x[0], x[1]) for x in response] if response else []
+
+                def insert(events: list[tuple[str, str, datetime]]):
+                    """Inserts (event_id, topic, received) rows. Event ids already stored are skipped."""
+                    events = list({event[0]: event for event in events}.values())
+                    for i in range(0, len(events), 500):
+                        chunk = events[i : i + 500]
+                        query = f"""
+                        INSERT INTO {Table.Middleware.webhook_events} (EVENT_ID, TOPIC, RCV_DT)
+                        SELECT V.EVENT_ID, V.TOPIC, V.RCV_DT
+                        FROM (VALUES {', '.join(['(?, ?, ?)'] * len(chunk))}) V(EVENT_ID, TOPIC, RCV_DT)
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM {Table.Middleware.webhook_events} E WHERE E.EVENT_ID = V.EVENT_ID
+                        )"""
+                        response = Database.query(query, params=[x for event in chunk for x in event])
+                        if response['code'] not in [200, 201]:
+                            raise Exception(response['message'])
+
+                def delete(event_id: str):
+                    query = f'DELETE FROM {Table.Middleware.webhook_events} WHERE EVENT_ID = ?'
+                    response = Database.query(query, params=(event_id,))
+                    if response['code'] not in [200, 201]:
+                        raise Exception(response['message'])
+
+                def purge(before: datetime):
+                    query = f'DELETE FROM {Table.Middleware.webhook_events} WHERE RCV_DT < ?'
+                    response = Database.query(query, params=(before,))
+                    if response['code'] not in [200, 201]:
+                        raise Exception(response['message'])
+
         class Promotion:
             """Promotion Prices translated into Automatic Discounts in Shopify."""
 
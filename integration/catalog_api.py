@@ -1,6 +1,8 @@
 import os
 import re
 import json
+import hashlib
+import threading
 from datetime import datetime
 from setup.date_presets import Dates
 import time
@@ -12,7 +14,7 @@ from PIL import Image as PILImage
 from setup import creds
 from setup.creds import Table
 from database import Database as db
-from setup.utilities import get_product_images, convert_to_utc, parse_custom_url, get_filesize
+from setup.utilities import convert_to_utc, parse_custom_url, get_filesize, Diff, ImageIndex, StageScheduler
 from concurrent.futures import ThreadPoolExecutor
 from product_tools.products import get_all_back_in_stock_items, get_all_new_new_items
 from setup.error_handler import ProcessOutErrorHandler
@@ -36,6 +38,8 @@ class Catalog:
         test_mode=False,
         test_queue=None,
         initial_sync=False,
+        changes: set = None,
+        changed_categories: set = None,
     ):
         self.dates: Dates = dates
         self.initial_sync = initial_sync
@@ -44,8 +48,11 @@ class Catalog:
         self.verbose = verbose
         self.test_mode = test_mode
         self.test_queue = test_queue
+        self.changes = changes  # Item numbers from the change feed. None means use last_sync.
         if not self.inventory_only and not self.test_mode:
-            self.category_tree = Collections(last_sync=last_sync)
+            self.category_tree = Collections(last_sync=last_sync, changes=changed_categories)
+        if not self.inventory_only:
+            db.Shopify.Product.Fingerprint.create_table()
 
         self.cp_items = []
         self.mw_items = []
@@ -89,6 +96,12 @@ class Catalog:
             WHERE INV.LST_MAINT_DT > '{self.last_sync: %Y-%m-%d %H:%M:%S}' and
             ITEM.{Table.CP.Item.Column.web_enabled} = 'Y'
             ORDER BY {Table.CP.Item.Column.binding_id} DESC"""
+        elif self.changes is not None:
+            query = f"""
+            SELECT ITEM_NO, ITEM.{Table.CP.Item.Column.binding_id} as 'Binding ID'
+            FROM {Table.CP.Item.table} ITEM
+            WHERE ITEM.ITEM_NO IN ({{keys}}) and
+            ITEM.{Table.CP.Item.Column.web_enabled} = 'Y'"""
         else:
             query = f"""
             SELECT ITEM_NO, ITEM.{Table.CP.Item.Column.binding_id} as 'Binding ID'
@@ -97,61 +110,51 @@ class Catalog:
             ITEM.{Table.CP.Item.Column.web_enabled} = 'Y'
             ORDER BY {Table.CP.Item.Column.binding_id} DESC
             """
-        response = db.query(query)
+        if self.changes is not None and not self.inventory_only:
+            response = db.query_batch(query, keys=self.changes) or None
+        else:
+            response = db.query(query)
         if response is not None:
-            result = []
-            for item in response:
-                sku = item[0]
-                binding_id = item[1]
-                queue_payload = {}
-                if binding_id is not None:
-                    # Check if the binding ID matches the correct format. (e.g. B0001)
-                    pattern = creds.Company.binding_id_format
-                    if not bool(re.fullmatch(pattern, binding_id)):
+            # Validate binding IDs once each. (e.g. B0001)
+            pattern = creds.Company.binding_id_format
+            binding_ids = {}
+            for _, binding_id in response:
+                if binding_id is not None and binding_id not in binding_ids:
+                    binding_ids[binding_id] = bool(re.fullmatch(pattern, binding_id))
+                    if not binding_ids[binding_id]:
                         message = f'Product {binding_id} has an invalid binding ID.'
                         Catalog.error_handler.add_error_v(error=message, origin='get_products()')
-                        # Skip this product
-                        continue
-
-                    else:
-                        # Get Parent to Process.
-                        query = f"""
-                        SELECT ITEM_NO
-                        FROM {Table.CP.Item.table}
-                        WHERE {Table.CP.Item.Column.binding_id} = '{binding_id}' AND 
-                        {Table.CP.Item.Column.web_enabled} = 'Y' 
-                        AND {Table.CP.Item.Column.is_parent} = 'Y'"""
-
-                        get_parent_response = db.query(query)
-
-                        if get_parent_response is not None:
-                            # Parent(s) found
-                            parent_list = [x[0] for x in get_parent_response]
-                            # If multiple parents are found, choose the lowest price parent.
-                            if len(parent_list) > 1:
-                                Catalog.logger.warn(f'Multiple parents found for {binding_id}.')
-                                # Set Parent Status for new parent.
-                                parent_sku = Product.set_parent(binding_id=binding_id, remove_current=True)
-
-                            else:
-                                # Single Parent Found.
-                                parent_sku = parent_list[0]
-                        else:
-                            # Missing Parent!
-                            # Will choose the lowest price web enabled variant as the parent.
-                            Catalog.logger.warn(f'Parent SKU not found for {binding_id}.')
-                            parent_sku = Product.set_parent(binding_id=binding_id)
 
-                        queue_payload = {'sku': parent_sku, 'binding_id': binding_id}
+            # Resolve the parent of every bound product in the queue at once.
+            valid_binding_ids = [x for x, valid in binding_ids.items() if valid]
+            parents = db.CP.Product.get_family_members(valid_binding_ids, parents_only=True)
+            parent_skus = {}
+            for binding_id in valid_binding_ids:
+                parent_list = parents.get(binding_id)
+                if not parent_list:
+                    # Missing Parent!
+                    # Will choose the lowest price web enabled variant as the parent.
+                    Catalog.logger.warn(f'Parent SKU not found for {binding_id}.')
+                    parent_skus[binding_id] = Product.set_parent(binding_id=binding_id)
+                elif len(parent_list) > 1:
+                    # If multiple parents are found, choose the lowest price parent.
+                    Catalog.logger.warn(f'Multiple parents found for {binding_id}.')
+                    parent_skus[binding_id] = Product.set_parent(binding_id=binding_id, remove_current=True)
                 else:
-                    # This will add single products to the queue
-                    queue_payload = {'sku': sku}
+                    # Single Parent Found.
+                    parent_skus[binding_id] = parent_list[0]
 
-                result.append(queue_payload)
+            # Keyed on (sku, binding_id) so each product is queued once, in query order.
+            queue = {}
+            for sku, binding_id in response:
+                if binding_id is None:
+                    # This will add single products to the queue
+                    queue.setdefault((sku, None), {'sku': sku})
+                elif binding_ids[binding_id]:
+                    parent_sku = parent_skus[binding_id]
+                    queue.setdefault((parent_sku, binding_id), {'sku': parent_sku, 'binding_id': binding_id})
 
-            res = []
-            [res.append(x) for x in result if x not in res]
-            self.sync_queue = res
+            self.sync_queue = list(queue.values())
             if test_mode:
                 self.sync_queue = {'sku': '10338', 'binding_id': 'B0001'}
             if self.sync_queue:
@@ -162,32 +165,32 @@ class Catalog:
         if self.verbose:
             Catalog.logger.info('Processing Product Deletions.')
 
-        delete_targets = Catalog.get_deletion_target(secondary_source=self.mw_items, primary_source=self.cp_items)
+        delete_targets = Diff(source=self.cp_items, target=self.mw_items).deletes
 
         add_targets = []
 
+        # Resolve middleware rows and counterpoint family members for the whole queue up front.
+        single_skus = [x['sku'] for x in self.sync_queue if 'binding_id' not in x]
+        binding_ids = [x['binding_id'] for x in self.sync_queue if 'binding_id' in x]
+        family_members = db.CP.Product.get_family_members(binding_ids)
+        members = [member for binding_id in binding_ids for member in family_members.get(binding_id, [])]
+        mw_products = db.Shopify.Product.get_many(single_skus + members)
+
         for item in self.sync_queue:
             if 'binding_id' not in item:
                 # Check if the target product has a binding ID in the middleware database.
-                mw_binding_id = Product.get_binding_id(item['sku'], middleware=True)
-                if mw_binding_id:
+                mw_product = mw_products.get(item['sku'])
+                if mw_product and mw_product['BINDING_ID']:
                     # This is a former bound product. Delete it.
                     delete_targets.append(item['sku'])
             else:
                 # These products have a binding ID. Get all family members of the binding ID.
-                family_members = Product.get_family_members(binding_id=item['binding_id'], counterpoint=True)
-
-                for member in family_members:
-                    query = f"""
-                    SELECT ID, BINDING_ID
-                    FROM {Table.Middleware.products}
-                    WHERE ITEM_NO = '{member}'
-                    """
-                    response = db.query(query)
+                for member in family_members.get(item['binding_id'], []):
+                    mw_product = mw_products.get(member)
 
-                    if response is not None:
-                        exists_in_mw = True if response[0][0] else False
-                        member_mw_binding_id = response[0][1]
+                    if mw_product is not None:
+                        exists_in_mw = True if mw_product['ID'] else False
+                        member_mw_binding_id = mw_product['BINDING_ID']
                     else:
                         exists_in_mw = False
                         member_mw_binding_id = None
@@ -239,13 +242,28 @@ class Catalog:
         def process_images():
             if self.verbose:
                 Catalog.logger.info('Processing Image Updates.')
-            self.product_images = get_product_images(eh=self.eh, verbose=self.verbose)
-            mw_images = db.Shopify.Product.Media.Image.get(column='IMAGE_NAME, SIZE')
-            self.mw_image_list = [[x[0], x[1]] for x in mw_images] if mw_images else []
+            changes = ImageIndex.refresh()
+            self.product_images = changes.images
+            if self.verbose:
+                Catalog.logger.info(f'Image Folder Changes: {changes}')
 
-            delete_targets = Catalog.get_deletion_target(
-                primary_source=self.product_images, secondary_source=self.mw_image_list
-            )
+            if changes.initial:
+                # No saved index yet. Reconcile the whole folder against the middleware once.
+                mw_images = db.Shopify.Product.Media.Image.get(column='IMAGE_NAME, SIZE')
+                self.mw_image_list = [[x[0], x[1]] for x in mw_images] if mw_images else []
+
+                # Keyed on file name so a resized image shows up as a change rather than an add and a delete.
+                image_diff = Diff(
+                    source=self.product_images, target=self.mw_image_list, key=lambda x: x[0], value=lambda x: x[1]
+                )
+                delete_targets = image_diff.deletes + [target for _, target in image_diff.changes]
+                addition_targets = image_diff.adds + [source for source, _ in image_diff.changes]
+            else:
+                delete_targets = changes.removed + [old for old, _ in changes.changed]
+                addition_targets = changes.added + [new for _, new in changes.changed]
+                if changes.added:
+                    # New images may replace default images on products that were missing photos.
+                    delete_targets.append(['coming-soon.jpg', None])
 
             if delete_targets:
                 delete_targets_set = list(set(x[0] for x in delete_targets))
@@ -298,17 +316,14 @@ class Catalog:
             # Update Item LST_MAINT_DT if new images have been deleted/added/changed.
             update_list = delete_targets
 
-            addition_targets = Catalog.get_deletion_target(
-                primary_source=self.mw_image_list, secondary_source=self.product_images
-            )
-
             if addition_targets:
                 for x in addition_targets:
                     update_list.append(x)
 
             if update_list:
                 sku_list = [x[0].split('.')[0].split('^')[0] for x in update_list]
-                binding_list = [x for x in sku_list if x in Catalog.all_binding_ids]
+                all_binding_ids = set(Catalog.all_binding_ids)
+                binding_list = [x for x in sku_list if x in all_binding_ids]
 
                 sku_list = tuple(sku_list)
                 
@@ -334,15 +349,16 @@ class Catalog:
                             f'Process Media: Updated LST_MAINT_DT for {response['affected rows']} items.'
                         )
 
+            # Changes have been applied. Make this scan the baseline for the next cycle.
+            ImageIndex.save()
+
         def process_videos():
             if self.verbose:
                 Catalog.logger.info('Processing Video Updates.')
             self.product_videos = db.CP.Product.Media.Video.get()
             mw_video_data = db.Shopify.Product.Media.Video.get(column='ITEM_NO, URL')
             mw_video_list = [[x[0], x[1]] for x in mw_video_data] if mw_video_data else []
-            delete_targets = Catalog.get_deletion_target(
-                primary_source=self.product_videos, secondary_source=mw_video_list
-            )
+            delete_targets = Diff(source=self.product_videos, target=mw_video_list).deletes
 
             if delete_targets:
                 Catalog.logger.info(f'Delete Targets: {delete_targets}')
@@ -393,24 +409,32 @@ class Catalog:
             if not self.inventory_only or self.verbose:
                 Catalog.logger.info(f'Syncing {queue_length} products.', origin='CATALOG SYNC: ')
 
+            variant_images = VariantImageQueue()
+
             def task(target):
                 prod = Product(target, last_sync=self.last_sync, inventory_only=self.inventory_only)
                 prod.get(last_sync=self.last_sync)
                 if prod.validate():
-                    return prod.process()
+                    return prod.process(variant_images=variant_images)
                 else:
                     return False, target
 
-            with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
-                results = executor.map(task, self.sync_queue)
+            if not self.inventory_only and queue_length >= creds.Integrator.bulk_threshold:
+                results = self.process_bulk(task)
+            else:
+                with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
+                    results = list(executor.map(StageScheduler.budget(task), self.sync_queue))
 
-                for x in results:
-                    success, item = x
-                    if success:
-                        success_count += 1
-                    else:
-                        fail_count['number'] += 1
-                        fail_count['items'].append(item)
+            # Media has been processing while the rest of the queue synced
+            variant_images.drain()
+
+            for x in results:
+                success, item = x
+                if success:
+                    success_count += 1
+                else:
+                    fail_count['number'] += 1
+                    fail_count['items'].append(item)
 
             if not self.inventory_only:
                 Catalog.logger.info(
@@ -431,7 +455,7 @@ class Catalog:
                     return task(target)
 
                 with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
-                    results = executor.map(retry, fail_count['items'])
+                    results = executor.map(StageScheduler.budget(retry), fail_count['items'])
 
                     for x in results:
                         success, item = x
@@ -449,21 +473,159 @@ class Catalog:
                         f'Fail Items: {retry_fail_count["items"]}\n'
                         '-----------------------\n'
                     )
+                variant_images.drain()
+
+    def process_bulk(self, task):
+        """Sync a large queue with bulk mutations. Existing products are updated with one productUpdate bulk
+        operation and one bulk operation per variant mutation, then the per-product follow-up work runs in the
+        thread pool. New products and products gaining variants still go through Product.process."""
+        Catalog.logger.info(f'Queue size above {creds.Integrator.bulk_threshold}. Using bulk mutations.')
+
+        def load(target):
+            prod = Product(target, last_sync=self.last_sync, inventory_only=self.inventory_only)
+            prod.get(last_sync=self.last_sync)
+            return prod if prod.validate() else None
+
+        with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
+            loaded = list(executor.map(StageScheduler.budget(load), self.sync_queue))
+
+        results = []
+        bulk_products: list[Product] = []
+        individual = []
+        for target, prod in zip(self.sync_queue, loaded):
+            if prod is None:
+                results.append((False, target))
+            elif prod.product_id and all(x.variant_id for x in prod.variants):
+                bulk_products.append(prod)
+            else:
+                individual.append(target)
+
+        failed = {}
+        product_changes = set()
+        variant_changes = set()
+
+        def fail(prod: Product, error):
+            msg = prod.web_title + ' - ' + (prod.binding_id if prod.binding_id else prod.sku)
+            Product.error_handler.add_error_v(
+                f'Error processing product {msg}: {error}', origin='Catalog.process_bulk'
+            )
+            failed[id(prod)] = prod
+
+        # Fingerprints and middleware IDs for sections that will be skipped
+        fingerprints = db.Shopify.Product.Fingerprint.get_many([x.binding_id or x.sku for x in bulk_products])
+        mw_rows = db.Shopify.Product.get_many([v.sku for x in bulk_products for v in x.variants])
+        for prod in bulk_products:
+            key = prod.binding_id or prod.sku
+            prod.fingerprint = Fingerprint(key, saved=fingerprints.get(key, {}))
+
+        # Stage 1: Product Updates
+        payloads = {}
+        for prod in bulk_products:
+            payload = prod.get_payload()
+            if prod.fingerprint.changed('product', payload):
+                payloads[id(prod)] = payload
+                product_changes.add(id(prod))
+            else:
+                prod.option_id = mw_rows[prod.sku]['OPTION_ID'] if prod.sku in mw_rows else None
+        updates = [x for x in bulk_products if id(x) in product_changes]
+        if updates:
+            responses = Shopify.Product.update_bulk([payloads[id(x)] for x in updates])
+            for prod, response in zip(updates, responses):
+                if isinstance(response, Exception):
+                    fail(prod, response)
+                else:
+                    prod.get_product_meta_ids(response)
+
+        # Stage 2: Variant Updates
+        variant_responses = {}
+        bound = []
+        single = []
+        for prod in bulk_products:
+            if id(prod) in failed:
+                continue
+            payload = prod.get_bulk_variant_payload() if prod.is_bound else prod.get_single_variant_payload()
+            if not prod.fingerprint.changed('variants', payload):
+                prod.load_variant_ids(mw_rows)
+                continue
+            payloads[id(prod)] = payload
+            variant_changes.add(id(prod))
+            (bound if prod.is_bound else single).append(prod)
+        if bound:
+            responses = Shopify.Product.Variant.update_many(
+                'productVariantsBulkUpdate', [payloads[id(x)] for x in bound]
+            )
+            for prod, response in zip(bound, responses):
+                if isinstance(response, Exception):
+                    fail(prod, response)
+                    continue
+                for variant in prod.variants:
+                    variant.option_id = prod.option_id
+                    variant.option_value_id = response[variant.sku]['option_value_id']
+                    variant.variant_id = response[variant.sku]['variant_id']
+                    variant.has_variant_image = response[variant.sku]['has_image']
+                variant_responses[id(prod)] = response
+        if single:
+            responses = Shopify.Product.Variant.update_many(
+                'productVariantUpdate', [payloads[id(x)] for x in single]
+            )
+            for prod, response in zip(single, responses):
+                if isinstance(response, Exception):
+                    fail(prod, response)
+
+        # Stage 3: Per-product follow-up (media order, variant images, middleware, inventory)
+        unchanged = []
+
+        def finish(prod: Product):
+            if id(prod) in failed:
+                return False, prod.product_data
+            try:
+                changed = False
+                if id(prod) in product_changes:
+                    Shopify.Product.Media.reorder(prod)
+                    changed = True
+                if id(prod) in variant_changes:
+                    if prod.is_bound:
+                        Shopify.Product.Option.reorder(prod)
+                        # Media finished processing while the bulk operations ran
+                        Shopify.Product.Variant.Image.create(prod.product_id, prod.get_variant_image_payload())
+                        prod.get_variant_meta_ids(variant_responses[id(prod)])
+                    changed = True
+                if changed:
+                    db.Shopify.Product.sync(product=prod, eh=Catalog.eh, verbose=self.verbose)
+                if not prod.is_preorder:
+                    inventory_payload = prod.get_inventory_payload()
+                    if prod.fingerprint.changed('inventory', inventory_payload):
+                        Shopify.Inventory.update(inventory_payload)
+                        changed = True
+                prod.fingerprint.save(prod.product_id)
+                if not changed:
+                    unchanged.append(prod)
+            except Exception as e:
+                fail(prod, e)
+                return False, prod.product_data
+            return True, prod.product_data
+
+        with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
+            results += list(executor.map(StageScheduler.budget(finish), bulk_products))
+            results += list(executor.map(StageScheduler.budget(task), individual))
+
+        Catalog.logger.info(
+            f'Bulk Sync: {len(bulk_products) - len(failed)}/{len(bulk_products)} products updated in bulk, '
+            f'{len(unchanged)} unchanged, {len(individual)} processed individually.'
+        )
+        return results
 
     @staticmethod
     def get_deletion_target(primary_source, secondary_source):
-        return [element for element in secondary_source if element not in primary_source]
+        return Diff(source=primary_source, target=secondary_source).deletes
 
     @staticmethod
     def get_local_product_images(sku):
         """Get local image information for product"""
         product_images = []
-        photo_path = creds.Company.product_images
-        list_of_files = os.listdir(photo_path)
-        if list_of_files is not None:
-            for x in list_of_files:
-                if x.split('.')[0].split('^')[0].lower() == sku.lower():
-                    product_images.append(x)
+        for x in ImageIndex.files():
+            if x.split('.')[0].split('^')[0].lower() == sku.lower():
+                product_images.append(x)
         return product_images
 
     def delete(products=True, collections=True):
@@ -486,7 +648,7 @@ class Catalog:
                 db.Shopify.Product.delete(product_id=target)
 
             # Check for any remaining products in Shopify
-            response = Shopify.Product.get_all()
+            response = Shopify.Product.get_all(bulk=True)
             if response:
                 for product in response:
                     Shopify.Product.delete(product)
@@ -545,9 +707,10 @@ class Collections:
     logger = ProcessOutErrorHandler.logger
     error_handler = ProcessOutErrorHandler.error_handler
 
-    def __init__(self, last_sync=datetime(1970, 1, 1), verbose=False):
+    def __init__(self, last_sync=datetime(1970, 1, 1), verbose=False, changes: set = None):
         self.last_sync: datetime = last_sync
         self.verbose: bool = verbose
+        self.changes = changes  # Category IDs from the change feed. None means use last_sync.
         self.categories: set[Collection] = set()
         self.heads: list[Collection] = []  # top level collections
         self.get_tree()
@@ -614,21 +777,26 @@ class Collections:
                     db.Shopify.Collection.insert(cat)
 
                 else:
-                    if cat.lst_maint_dt > self.last_sync:
+                    if self.is_changed(cat):
                         db.Shopify.Collection.update(cat)
 
                 self.categories.add(cat)
 
-            for x in self.categories:
-                for y in self.categories:
-                    if y.cp_parent_id == x.cp_categ_id:
-                        x.add_child(y)
+            categories_by_id = {x.cp_categ_id: x for x in self.categories}
+            for y in self.categories:
+                if y.cp_parent_id in categories_by_id:
+                    categories_by_id[y.cp_parent_id].add_child(y)
 
             self.heads = [x for x in self.categories if x.cp_parent_id == '0']
 
             # Sort Heads by x.sort_order
             self.heads.sort(key=lambda x: x.sort_order)
 
+    def is_changed(self, category: 'Collection') -> bool:
+        if self.changes is not None:
+            return category.cp_categ_id in self.changes
+        return category.lst_maint_dt > self.last_sync
+
     def sync(self):
         self.process_collections()
         self.process_menus()
@@ -639,7 +807,7 @@ class Collections:
 
         def collections_h(category: Collection):
             # Get Shopify Collection ID and Parent ID
-            if category.lst_maint_dt > self.last_sync:
+            if self.is_changed(category):
                 queue.append(category)
                 if category.collection_id is None:
                     category.collection_id = Shopify.Collection.create(category.get_category_payload())
@@ -755,7 +923,7 @@ class Collections:
     def update_middleware(self):
         # Update Entire Category Tree in Middleware
         def update_helper(collection: Collection):
-            if collection.lst_maint_dt > self.last_sync:
+            if self.is_changed(collection):
                 db.Shopify.Collection.update(collection)
             for child in collection.children:
                 update_helper(child)
@@ -934,6 +1102,90 @@ class Collection:
         return payload
 
 
+class Fingerprint:
+    """Tracks a hash of each payload section last sent to Shopify for a product so unchanged sections can be
+    skipped. Sections are only recorded once they have been sent successfully."""
+
+    def __init__(self, sku, saved=None):
+        self.sku = sku
+        self.saved: dict = saved if saved is not None else db.Shopify.Product.Fingerprint.get(sku)
+        self.current: dict = {}
+
+    def __str__(self):
+        return f'Fingerprint {self.sku}: {len(self.saved)} saved, {len(self.current)} current'
+
+    @staticmethod
+    def hash(payload) -> str:
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def changed(self, section, payload) -> bool:
+        """Records the hash of a section payload and returns True if it differs from the last sync."""
+        self.current[section] = Fingerprint.hash(payload)
+        return self.saved.get(section) != self.current[section]
+
+    def save(self, product_id):
+        sections = {**self.saved, **self.current}
+        db.Shopify.Product.Fingerprint.upsert(
+            item_no=self.sku, product_id=product_id, product_hash=Fingerprint.hash(sections), sections=sections
+        )
+        self.saved, self.current = sections, {}
+
+
+class VariantImageQueue:
+    """Variant image assignments deferred until Shopify has finished processing the product media. Workers add
+    their payload and move on to the next product. drain() assigns each product's variant images as soon as
+    all of its media is READY, polling only while nothing is ready yet."""
+
+    logger = ProcessOutErrorHandler.logger
+    error_handler = ProcessOutErrorHandler.error_handler
+    poll_interval = 1  # Seconds between status checks
+    timeout = 60  # Seconds after which images still processing are assigned anyway
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: dict[int, list] = {}  # {product_id: variant image payload}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, product_id: int, payload: list):
+        if payload:
+            with self.lock:
+                self.pending.setdefault(product_id, []).extend(payload)
+
+    def assign(self, product_id: int, force=False) -> bool:
+        """Assigns the variant images for a product if its media is ready. Returns True when done."""
+        payload = self.pending[product_id]
+        try:
+            if not force:
+                status = Shopify.Product.Media.get_status(product_id)
+                wanted = [status.get(x['imageId']) for x in payload]
+                if 'FAILED' in wanted:
+                    raise Exception(f'Media processing failed. Status: {status}')
+                if any(x != 'READY' for x in wanted):
+                    return False
+            Shopify.Product.Variant.Image.create(product_id, payload)
+        except Exception as e:
+            VariantImageQueue.error_handler.add_error_v(
+                error=f'Error assigning variant images for product {product_id}: {e}',
+                origin='VariantImageQueue.assign',
+                traceback=tb(),
+            )
+        return True
+
+    def drain(self):
+        deadline = time.monotonic() + VariantImageQueue.timeout
+        while self.pending:
+            force = time.monotonic() > deadline
+            if force:
+                VariantImageQueue.logger.warn(f'Media still processing for {list(self.pending)}. Assigning anyway.')
+            with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
+                done = dict(zip(self.pending, executor.map(lambda x: self.assign(x, force), self.pending)))
+            self.pending = {k: v for k, v in self.pending.items() if not done[k]}
+            if self.pending:
+                time.sleep(VariantImageQueue.poll_interval)
+
+
 class Product:
     logger = ProcessOutErrorHandler.logger
     error_handler = ProcessOutErrorHandler.error_handler
@@ -967,6 +1219,7 @@ class Product:
         # Product Information
         self.product_id = None
         self.option_id = None
+        self.fingerprint: Fingerprint = None
         self.web_title = None
         self.type = None
         self.long_descr = None
@@ -2232,8 +2485,10 @@ class Product:
 
         return variant_image_payload
 
-    def process(self):
-        """Process Product Creation/Delete/Update in Shopify and Middleware."""
+    def process(self, variant_images: VariantImageQueue = None):
+        """Process Product Creation/Delete/Update in Shopify and Middleware. Variant image assignments are added
+        to variant_images for the caller to drain. Without a queue, they are assigned before returning."""
+        queue = variant_images if variant_images is not None else VariantImageQueue()
 
         def create():
             """Create new product in Shopify and Middleware."""
@@ -2272,9 +2527,8 @@ class Product:
 
                 Shopify.Product.Option.reorder(self)
 
-                # Wait for images to process
-                time.sleep(3)
-                Shopify.Product.Variant.Image.create(self.product_id, self.get_variant_image_payload())
+                # Assign variant images once Shopify has finished processing the media
+                queue.add(self.product_id, self.get_variant_image_payload())
                 self.get_variant_meta_ids(variant_response)
 
             else:
@@ -2285,16 +2539,30 @@ class Product:
             Shopify.Product.publish(self.product_id)
 
         def update():
-            """Will update existing product. Will clear out custom field data and reinsert."""
-
+            """Will update existing product. Will clear out custom field data and reinsert. Sections whose
+            payload matches the fingerprint from the last sync are not sent."""
             product_payload = self.get_payload()
-            response = Shopify.Product.update(product_payload)
-            self.get_product_meta_ids(response)
-            Shopify.Product.Media.reorder(self)  # Reorder media if necessary
-
             if self.is_bound:
+                variant_payload = self.get_bulk_variant_payload()
+            else:
+                variant_payload = self.get_single_variant_payload()
+
+            product_changed = self.fingerprint.changed('product', product_payload)
+            variants_changed = self.fingerprint.changed('variants', variant_payload)
+
+            if product_changed:
+                response = Shopify.Product.update(product_payload)
+                self.get_product_meta_ids(response)
+                Shopify.Product.Media.reorder(self)  # Reorder media if necessary
+            else:
+                self.option_id = db.Shopify.Product.Variant.get_option_id(sku=self.sku)
+
+            if not variants_changed:
+                self.load_variant_ids()
+
+            elif self.is_bound:
                 # Update the Variants
-                variant_response = Shopify.Product.Variant.update_bulk(self.get_bulk_variant_payload())
+                variant_response = Shopify.Product.Variant.update_bulk(variant_payload)
 
                 for variant in self.variants:
                     variant.option_id = self.option_id
@@ -2304,27 +2572,40 @@ class Product:
 
                 Shopify.Product.Option.reorder(self)
 
-                # Wait for images to process
-                time.sleep(3)
-                Shopify.Product.Variant.Image.create(self.product_id, self.get_variant_image_payload())
+                # Assign variant images once Shopify has finished processing the media
+                queue.add(self.product_id, self.get_variant_image_payload())
                 self.get_variant_meta_ids(variant_response)
 
             else:
-                variant_payload = self.get_single_variant_payload()
                 variant_response = Shopify.Product.Variant.update_single(variant_payload)
 
+            return product_changed or variants_changed
+
         try:
+            changed = True
             if not self.inventory_only:
                 if self.product_id:
-                    update()
+                    self.fingerprint = Fingerprint(self.binding_id or self.sku)
+                    changed = update()
                 else:
                     create()
                 # Update Middleware (Insert or Update)
-                db.Shopify.Product.sync(product=self, eh=Catalog.eh, verbose=self.verbose)
+                if changed:
+                    db.Shopify.Product.sync(product=self, eh=Catalog.eh, verbose=self.verbose)
 
             # Update Inventory
             if not self.is_preorder:
-                Shopify.Inventory.update(self.get_inventory_payload())
+                inventory_payload = self.get_inventory_payload()
+                fingerprint = self.fingerprint
+                if self.inventory_only or not fingerprint or fingerprint.changed('inventory', inventory_payload):
+                    Shopify.Inventory.update(inventory_payload)
+                    changed = True
+
+            if self.fingerprint:
+                self.fingerprint.save(self.product_id)
+
+            if variant_images is None:
+                queue.drain()
 
         except Exception as e:
             msg = self.web_title + ' - ' + (self.binding_id if self.binding_id else self.sku)
@@ -2335,7 +2616,10 @@ class Product:
 
         else:
             msg = self.web_title + ' - ' + (self.binding_id if self.binding_id else self.sku)
-            Product.logger.success(f'Product {msg} processed successfully.')
+            if changed:
+                Product.logger.success(f'Product {msg} processed successfully.')
+            elif self.verbose:
+                Product.logger.info(f'Product {msg} unchanged since last sync. Skipped.')
             return True, self.product_data
 
     def get_product_meta_ids(self, response):
@@ -2417,6 +2701,18 @@ class Product:
         if response['media_ids']:
             get_media_ids(response)
 
+    def load_variant_ids(self, rows=None):
+        """Loads option and option value IDs from the middleware for variants whose update was skipped, so the
+        middleware sync does not overwrite them."""
+        if rows is None:
+            rows = db.Shopify.Product.get_many([x.sku for x in self.variants])
+        for variant in self.variants:
+            row = rows.get(variant.sku)
+            variant.option_id = self.option_id
+            if row:
+                variant.option_id = row['OPTION_ID'] or self.option_id
+                variant.option_value_id = row['OPTION_VALUE_ID']
+
     def get_variant_meta_ids(self, response):
         """Used to get metafield IDs for variants."""
         for item in response:
@@ -9,6 +9,7 @@ from traceback import format_exc as tb
 
 
 from setup.error_handler import ProcessOutErrorHandler
+from setup.utilities import StageScheduler
 
 
 class Customers:
@@ -17,11 +18,14 @@ class Customers:
     logger = ProcessOutErrorHandler.logger
     error_handler = ProcessOutErrorHandler.error_handler
 
-    def __init__(self, last_sync=datetime(1970, 1, 1), verbose=False, test_mode=False, test_customer=None):
+    def __init__(
+        self, last_sync=datetime(1970, 1, 1), verbose=False, test_mode=False, test_customer=None, changes: set = None
+    ):
         self.last_sync = last_sync
         self.verbose = verbose
         self.test_mode = test_mode
         self.test_customer = test_customer
+        self.changes = changes  # Customer numbers from the change feed. None means use last_sync.
         self.update_customer_timestamps()
         self.customers: list[Customer] = self.get_updated_customers()
 
@@ -40,14 +44,26 @@ class Customers:
         customer_list = [x[0] for x in response] if response is not None else []
         if customer_list:
             db.CP.Customer.update_timestamps(customer_list)
+            if self.changes is not None:
+                self.changes.update(customer_list)
 
     def get_updated_customers(self):
         if self.test_mode:
             response = db.CP.Customer.get_all(customer_no=self.test_customer)
+        elif self.changes is not None:
+            changes = sorted(self.changes)
+            response = []
+            for i in range(0, len(changes), db.batch_size):
+                response += db.CP.Customer.get_all(customer_list=changes[i : i + db.batch_size])
         else:
             response = db.CP.Customer.get_all(last_sync=self.last_sync)
 
-        return [Customer(x, verbose=self.verbose) for x in response] if response is not None else []
+        if not response:
+            return []
+
+        # Fetch shipping addresses for every customer in the queue at once rather than one query per customer
+        addresses = db.CP.Customer.ShippingAddress.get_many([x['CUST_NO'] for x in response])
+        return [Customer(x, verbose=self.verbose, ship_addresses=addresses.get(x['CUST_NO'], [])) for x in response]
 
     def get_cp_customers(self):
         """Get all customers from Counterpoint that are e-commerce customers."""
@@ -75,16 +91,15 @@ class Customers:
         cp_customers = self.get_cp_customers()
         mw_customers = self.get_mw_customers()
         # Find Customers in MW that are not in CP
-        delete_queue = []
-        for mw_customer in mw_customers:
-            if mw_customer not in cp_customers:
-                delete_queue.append(mw_customer)
+        cp_customers = set(cp_customers)
+        delete_queue = [x for x in mw_customers if x not in cp_customers]
 
         if delete_queue:
+            shopify_cust_nos = db.Shopify.Customer.get_ids(delete_queue)
             count = 1
             for x in delete_queue:
                 Customers.logger.info(f'{count}/{len(delete_queue)}: Deleting customer CUST_NO: {x}', origin=origin)
-                shopify_cust_no = db.Shopify.Customer.get_id(x)
+                shopify_cust_no = shopify_cust_nos.get(x)
                 Shopify.Customer.delete(shopify_cust_no)
                 db.Shopify.Customer.delete(shopify_cust_no)
                 count += 1
@@ -106,7 +121,7 @@ class Customers:
                 return customer.process()
 
             with concurrent.futures.ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
-                results = executor.map(task, self.customers)
+                results = executor.map(StageScheduler.budget(task), self.customers)
 
             for x in results:
                 result, cust_no = x
@@ -141,7 +156,7 @@ class Customer:
     logger = ProcessOutErrorHandler.logger
     error_handler = ProcessOutErrorHandler.error_handler
 
-    def __init__(self, cust_result, verbose=False):
+    def __init__(self, cust_result, verbose=False, ship_addresses=None):
         self.verbose = verbose
         self.cp_cust_no = cust_result['CUST_NO']
         self.fst_nam = str(cust_result['FST_NAM']).title()
@@ -186,7 +201,7 @@ class Customer:
         self.mw_id = cust_result['ID']
 
         self.addresses = []
-        self.get_addresses()
+        self.get_addresses(ship_addresses)
 
         if self.loyalty_points < 0:
             self.set_loyalty_points_to_zero()
@@ -230,7 +245,7 @@ class Customer:
         except:
             return None
 
-    def get_addresses(self):
+    def get_addresses(self, ship_addresses=None):
         # Add the primary address
         address_main = {
             'first_name': self.fst_nam,
@@ -245,8 +260,11 @@ class Customer:
         }
         self.addresses.append(address_main)
 
-        # Get additional addresses
-        address_res = db.CP.Customer.ShippingAddress.get(cust_no=self.cp_cust_no)
+        # Get additional addresses. Use prefetched rows when the caller has already batched the lookup.
+        if ship_addresses is not None:
+            address_res = ship_addresses
+        else:
+            address_res = db.CP.Customer.ShippingAddress.get(cust_no=self.cp_cust_no)
         if address_res is not None:
             for x in address_res:
                 address = {
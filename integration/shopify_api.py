@@ -1,6 +1,7 @@
 from setup import creds
 from setup.creds import API
 import requests
+import requests.adapters
 import json
 from time import sleep
 from setup.error_handler import ProcessOutErrorHandler
@@ -9,13 +10,15 @@ from database import Database
 from traceback import print_exc as tb
 from setup.utilities import local_to_utc
 from datetime import datetime
-from product_tools import products
-import random
+import re
+import time
 
 import concurrent.futures
 
 import threading
 
+import bisect
+
 
 class MoveInput:
     """A Shopify Product ID and a position to move it to"""
@@ -58,6 +61,307 @@ class MovesCollection:
     def get(self):
         return [move.get() for move in self.moves]
 
+    def __len__(self):
+        return sum(len(moves.get()) for moves in self.moves)
+
+    @staticmethod
+    def stable_positions(sequence: list[int]) -> set[int]:
+        """Indexes of one longest increasing subsequence of sequence"""
+        tails, tail_indexes, previous = [], [], [-1] * len(sequence)
+        for i, value in enumerate(sequence):
+            k = bisect.bisect_left(tails, value)
+            if k == len(tails):
+                tails.append(value)
+                tail_indexes.append(i)
+            else:
+                tails[k] = value
+                tail_indexes[k] = i
+            previous[i] = tail_indexes[k - 1] if k else -1
+
+        result = set()
+        i = tail_indexes[-1] if tail_indexes else -1
+        while i != -1:
+            result.add(i)
+            i = previous[i]
+        return result
+
+    @staticmethod
+    def from_diff(current: list[int], target: list[int]):
+        """Build the smallest set of moves that turns the current order of a collection into the target order.
+
+        Products whose current positions form the longest increasing subsequence of the target order are
+        already in the right relative order and stay put. Every other product is moved directly behind its
+        target predecessor. Shopify applies moves in the order they are sent, so the moves must be sent
+        sequentially and the positions are computed against the order left by the previous move."""
+        mc = MovesCollection()
+        index = {product_id: i for i, product_id in enumerate(current)}
+        stable = MovesCollection.stable_positions([index[product_id] for product_id in target])
+
+        # A moved product lands directly behind its target predecessor, so each run of moved products ends up
+        # behind the stable product before it in the target, or at the front. Lay out one slot per current
+        # position plus one per moved product in that final order; a position is then the number of occupied
+        # slots before a product's slot, counted with a Fenwick tree instead of searching the order per move.
+        runs = {None: []}
+        anchor = None
+        for position, product_id in enumerate(target):
+            if position in stable:
+                anchor = product_id
+                runs[anchor] = []
+            else:
+                runs[anchor].append(product_id)
+
+        original_slot, moved_slot = {}, {}
+        for product_id in runs[None]:
+            moved_slot[product_id] = len(original_slot) + len(moved_slot)
+        for product_id in current:
+            original_slot[product_id] = len(original_slot) + len(moved_slot)
+            for moved in runs.get(product_id, ()):
+                moved_slot[moved] = len(original_slot) + len(moved_slot)
+
+        tree = [0] * (len(original_slot) + len(moved_slot) + 1)
+
+        def occupy(slot, delta):
+            slot += 1
+            while slot < len(tree):
+                tree[slot] += delta
+                slot += slot & -slot
+
+        def occupied_before(slot):
+            count = 0
+            while slot:
+                count += tree[slot]
+                slot -= slot & -slot
+            return count
+
+        for slot in original_slot.values():
+            occupy(slot, 1)
+        for position, product_id in enumerate(target):
+            if position in stable:
+                continue
+            occupy(original_slot[product_id], -1)
+            occupy(moved_slot[product_id], 1)
+            mc.add(MoveInput(item_id=product_id, position=occupied_before(moved_slot[product_id])))
+        return mc
+
+
+class QueryDocuments:
+    """Process-wide cache of GraphQL documents. Each .graphql file is read and split into its top-level
+    definitions once, so a request only sends the operation it names plus the fragments that operation uses."""
+
+    definition_pattern = re.compile(r'^\s*(query|mutation|subscription|fragment)\s+([_A-Za-z]\w*)')
+    spread_pattern = re.compile(r'\.\.\.\s*([_A-Za-z]\w*)')
+
+    class Document:
+        def __init__(self, text: str, operations: dict[str, str], fragments: dict[str, str]):
+            self.text = text
+            self.operations = operations
+            self.fragments = fragments
+            self.compiled: dict[str, str] = {}
+
+    documents: dict[str, Document] = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(document: str, operation_name: str = None) -> str:
+        """Return the query text to send for an operation. Falls back to the full document when the
+        operation is not named or cannot be found in the file."""
+        doc = QueryDocuments.load(document)
+        if operation_name is None or operation_name not in doc.operations:
+            return doc.text
+
+        compiled = doc.compiled.get(operation_name)
+        if compiled is None:
+            compiled = QueryDocuments.compile(doc, operation_name)
+            doc.compiled[operation_name] = compiled
+        return compiled
+
+    @staticmethod
+    def load(document: str) -> 'QueryDocuments.Document':
+        key = str(Path(document).resolve())
+        doc = QueryDocuments.documents.get(key)
+        if doc is None:
+            with QueryDocuments.lock:
+                doc = QueryDocuments.documents.get(key)
+                if doc is None:
+                    doc = QueryDocuments.parse(Path(document).read_text())
+                    QueryDocuments.documents[key] = doc
+        return doc
+
+    @staticmethod
+    def parse(text: str) -> 'QueryDocuments.Document':
+        """Split a document into named operations and fragments by tracking brace depth."""
+        operations = {}
+        fragments = {}
+        depth = 0
+        start = None
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if char == '#':
+                # Comment - skip to end of line
+                end = text.find('\n', i)
+                i = len(text) if end == -1 else end
+                continue
+            if char == '"':
+                # String or block string - skip to the closing quote
+                quote = '"""' if text.startswith('"""', i) else '"'
+                end = text.find(quote, i + len(quote))
+                while quote == '"' and end != -1 and text[end - 1] == '\\':
+                    end = text.find(quote, end + 1)
+                i = len(text) if end == -1 else end + len(quote)
+                continue
+            if depth == 0 and start is None and not char.isspace():
+                start = i
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0 and start is not None:
+                    definition = text[start : i + 1]
+                    match = QueryDocuments.definition_pattern.match(definition)
+                    if match:
+                        kind, name = match.groups()
+                        if kind == 'fragment':
+                            fragments[name] = definition
+                        else:
+                            operations[name] = definition
+                    start = None
+            i += 1
+
+        return QueryDocuments.Document(text, operations, fragments)
+
+    @staticmethod
+    def compile(doc: 'QueryDocuments.Document', operation_name: str) -> str:
+        """Return the named operation followed by every fragment it references, directly or indirectly."""
+        parts = [doc.operations[operation_name]]
+        included = set()
+        pending = [parts[0]]
+        while pending:
+            for name in QueryDocuments.spread_pattern.findall(pending.pop()):
+                if name in doc.fragments and name not in included:
+                    included.add(name)
+                    parts.append(doc.fragments[name])
+                    pending.append(doc.fragments[name])
+        return '\n\n'.join(parts)
+
+
+class QueryStats:
+    """Thread-safe latency counters for each GraphQL operation sent to Shopify."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations: dict[str, dict] = {}
+
+    def __str__(self):
+        result = ''
+        for name, stats in sorted(self.stats().items(), key=lambda x: x[1]['total'], reverse=True):
+            result += (
+                f'\n{name}: count: {stats["count"]}, errors: {stats["errors"]}, '
+                f'avg: {stats["avg"]:.3f}s, max: {stats["max"]:.3f}s, total: {stats["total"]:.2f}s'
+            )
+        return result
+
+    def add(self, operation_name: str, elapsed: float, error: bool = False):
+        with self.lock:
+            stats = self.operations.setdefault(
+                operation_name or 'anonymous', {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+            )
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            if error:
+                stats['errors'] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {k: {**v, 'avg': v['total'] / v['count']} for k, v in self.operations.items()}
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+
+class CostThrottler:
+    """Client-side mirror of Shopify's GraphQL leaky bucket, shared by every worker thread.
+
+    Each call reserves the requested cost of its operation (learned from previous responses) before it is
+    sent. Threads wait only as long as the bucket needs to restore that cost, and the bucket is resynced from
+    extensions.cost.throttleStatus whenever a response comes back."""
+
+    default_cost = 10
+
+    def __init__(self, maximum: float, restore_rate: float):
+        self.maximum = maximum
+        self.restore_rate = restore_rate
+        self.available = maximum
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.costs: dict[str, float] = {}
+        self.lock = threading.Condition()
+        # Counters
+        self.waits = 0
+        self.wait_time = 0.0
+        self.throttled = 0
+
+    def __str__(self):
+        with self.lock:
+            return (
+                f'available: {self.available:.0f}/{self.maximum:.0f}, restore rate: {self.restore_rate}/s, '
+                f'waits: {self.waits}, wait time: {self.wait_time:.2f}s, throttled: {self.throttled}'
+            )
+
+    def restore(self):
+        """Add the cost restored since the last update. Caller must hold the lock."""
+        now = time.monotonic()
+        self.available = min(self.maximum, self.available + (now - self.updated) * self.restore_rate)
+        self.updated = now
+
+    def reserve(self, operation_name: str = None) -> float:
+        """Block until the bucket can cover the operation's expected cost, then take it."""
+        with self.lock:
+            cost = min(self.costs.get(operation_name, CostThrottler.default_cost), self.maximum)
+            start = None
+            while True:
+                self.restore()
+                if self.available >= cost:
+                    break
+                if self.restore_rate <= 0 and not self.in_flight:
+                    # Nothing restores the bucket or will resync it, so send and let the response resync it
+                    break
+                if start is None:
+                    start = time.monotonic()
+                    self.waits += 1
+                # Without a restore rate, wait for an in-flight response to resync the bucket
+                self.lock.wait((cost - self.available) / self.restore_rate if self.restore_rate > 0 else None)
+            if start is not None:
+                self.wait_time += time.monotonic() - start
+            self.available -= cost
+            self.in_flight += cost
+            return cost
+
+    def update(self, operation_name: str, reserved: float, response: dict = None):
+        """Release a reservation and resync the bucket from the response's cost extension."""
+        with self.lock:
+            self.in_flight -= reserved
+            cost = (response or {}).get('extensions', {}).get('cost')
+            if cost:
+                status = cost['throttleStatus']
+                self.maximum = status['maximumAvailable']
+                self.restore_rate = status['restoreRate']
+                # Requests still in flight have been reserved locally but may not be reflected by the server yet
+                self.available = max(0, status['currentlyAvailable'] - self.in_flight)
+                self.updated = time.monotonic()
+                if cost.get('requestedQueryCost') is not None:
+                    self.costs[operation_name] = cost['requestedQueryCost']
+            else:
+                # The request never reached Shopify or its cost is unknown - return the reservation
+                self.available = min(self.maximum, self.available + reserved)
+
+            errors = (response or {}).get('errors')
+            if isinstance(errors, list) and any(x.get('message') == 'Throttled' for x in errors):
+                self.throttled += 1
+            self.lock.notify_all()
+
 
 class Shopify:
     eh = ProcessOutErrorHandler
@@ -66,6 +370,20 @@ class Shopify:
     token = creds.Shopify.admin_token
     shop_url = creds.Shopify.shop_url
     headers = {'X-Shopify-Access-Token': token, 'Content-Type': 'application/json'}
+    endpoint = f'https://{shop_url}/admin/api/2024-07/graphql.json'
+
+    # Keep-alive session shared by every worker thread. The connection pool is sized to the integrator
+    # thread pool so concurrent syncs reuse open TLS connections instead of handshaking per request.
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount(
+        'https://',
+        requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=creds.Integrator.max_workers, pool_block=True
+        ),
+    )
+    stats = QueryStats()
+    throttler = CostThrottler(maximum=creds.Shopify.bucket_size, restore_rate=creds.Shopify.restore_rate)
 
     class Query:
         def __init__(self, document, variables=None, operation_name=None):
@@ -213,6 +531,10 @@ class Shopify:
                                 self.user_errors.remove(i)
                                 continue
 
+                        elif operation_name.startswith('bulkOperation'):
+                            # Shopify.BulkOperation inspects these itself (e.g. an operation already running)
+                            break
+
                         else:
                             Shopify.error_handler.add_error_v(
                                 f'User Error: {self.user_errors}\nResponse: {json.dumps(self.response, indent=4)}'
@@ -225,7 +547,8 @@ class Shopify:
                     # Errors
                     for i in self.errors:
                         if i['message'] == 'Throttled':
-                            sleep(random.randint(20, 50) / 10)
+                            # The throttler has already resynced from this response, so the retry waits
+                            # exactly as long as the bucket needs to restore the operation's cost.
                             self.errors.remove(i)
                             return self.__init__(document, variables, operation_name)
 
@@ -241,19 +564,216 @@ class Shopify:
             return json.dumps(self.response, indent=4)
 
         def execute_query(self, document, variables=None, operation_name=None):
-            query_doc = Path(document).read_text()
-            endpoint = f'https://{Shopify.shop_url}/admin/api/2024-07/graphql.json'
+            query_doc = QueryDocuments.get(document, operation_name)
             payload = {'query': query_doc, 'variables': variables, 'operationName': operation_name}
-            response = requests.post(endpoint, headers=Shopify.headers, json=payload)
+            reserved = Shopify.throttler.reserve(operation_name)
+            start = time.perf_counter()
             try:
-                return response.json()
+                response = Shopify.session.post(Shopify.endpoint, json=payload)
+            except requests.exceptions.RequestException:
+                Shopify.stats.add(operation_name, time.perf_counter() - start, error=True)
+                Shopify.throttler.update(operation_name, reserved)
+                raise
+            Shopify.stats.add(operation_name, time.perf_counter() - start, error=not response.ok)
+            try:
+                result = response.json()
             except:
+                Shopify.throttler.update(operation_name, reserved)
                 if response.text.startswith('upstream connect error or disconnect/reset before headers.'):
                     sleep(5)
                     return self.execute_query(document, variables, operation_name)
 
                 raise Exception(f'Error: {response.text}')
 
+            Shopify.throttler.update(operation_name, reserved, result)
+            return result
+
+    class BulkOperation:
+        """Runs a query as a Shopify bulk operation and streams the JSONL result. Use for full-catalog reads
+        that would otherwise page through hundreds of 250-item cursors."""
+
+        queries = './integration/queries/bulk.graphql'
+        prefix = 'gid://shopify/BulkOperation/'
+        poll_interval = 1  # Seconds. Doubles on each poll up to max_poll_interval
+        max_poll_interval = 10
+        timeout = 3600
+
+        class Record:
+            """A single line of a bulk operation result. Nested connections are flattened by Shopify, so
+            children point back to their parent through parent_id."""
+
+            def __init__(self, data: dict):
+                self.data = data
+                self.gid: str = data.get('id')
+                self.type: str = self.gid.split('/')[-2] if self.gid else None
+                self.id: int = int(self.gid.split('/')[-1].split('?')[0]) if self.gid else None
+                parent = data.get('__parentId')
+                self.parent_id: int = int(parent.split('/')[-1]) if parent else None
+
+            def __getitem__(self, key):
+                return self.data[key]
+
+            def get(self, key, default=None):
+                return self.data.get(key, default)
+
+            def __repr__(self):
+                return f'{self.type}({self.id})'
+
+        @staticmethod
+        def run(query: str, verbose=False):
+            """Submit a bulk query, wait for it to finish, and yield a Record for each line of the result."""
+            operation_id = Shopify.BulkOperation.submit(query)
+            operation = Shopify.BulkOperation.wait(operation_id)
+            if verbose:
+                Shopify.logger.info(
+                    f'Bulk Operation {operation_id}: {operation["status"]}, {operation["objectCount"]} objects, '
+                    f'{operation["fileSize"] or 0} bytes'
+                )
+            if operation['status'] != 'COMPLETED':
+                raise Exception(f'Bulk Operation {operation_id} {operation["status"]}: {operation["errorCode"]}')
+
+            if operation['url']:
+                # url is None when the query matched no objects
+                yield from Shopify.BulkOperation.stream(operation['url'])
+
+        @staticmethod
+        def submit(query: str) -> str:
+            """Start a bulk query and return the operation ID."""
+            return Shopify.BulkOperation.start('bulkOperationRunQuery', {'query': query})
+
+        @staticmethod
+        def submit_mutation(mutation: str, staged_upload_path: str) -> str:
+            """Start a bulk mutation against an uploaded JSONL variables file and return the operation ID."""
+            return Shopify.BulkOperation.start(
+                'bulkOperationRunMutation', {'mutation': mutation, 'stagedUploadPath': staged_upload_path}
+            )
+
+        @staticmethod
+        def start(operation_name: str, variables: dict) -> str:
+            """Shopify runs one bulk query and one bulk mutation per shop at a time, so wait for any
+            operation of the same type already in progress before submitting."""
+            if operation_name == 'bulkOperationRunQuery':
+                current_operation = 'currentBulkOperation'
+            else:
+                current_operation = 'currentBulkMutation'
+            while True:
+                response = Shopify.Query(
+                    document=Shopify.BulkOperation.queries, variables=variables, operation_name=operation_name
+                )
+                if not response.user_errors:
+                    return response.data[operation_name]['bulkOperation']['id']
+
+                if any('already in progress' in x for x in response.user_errors):
+                    current = Shopify.Query(
+                        document=Shopify.BulkOperation.queries, operation_name=current_operation
+                    ).data['currentBulkOperation']
+                    if current and current['status'] in ('CREATED', 'RUNNING', 'CANCELING'):
+                        Shopify.logger.info(f'Waiting for Bulk Operation {current["id"]} to finish.')
+                        Shopify.BulkOperation.wait(current['id'])
+                    continue
+
+                raise Exception(f'Bulk Operation Error: {response.user_errors}\n\nVariables: {variables}')
+
+        @staticmethod
+        def run_mutation(document: str, operation_name: str, variables: list[dict], verbose=False) -> list[dict]:
+            """Run one mutation from a .graphql document for every set of variables in a single bulk operation.
+            Returns the result for each set of variables in input order. Each result has the mutation's data,
+            or None with the errors reported for that line."""
+            if not variables:
+                return []
+
+            staged_upload_path = Shopify.BulkOperation.upload(variables)
+            mutation = QueryDocuments.get(document, operation_name)
+            operation_id = Shopify.BulkOperation.submit_mutation(mutation, staged_upload_path)
+            operation = Shopify.BulkOperation.wait(operation_id)
+            if verbose:
+                Shopify.logger.info(
+                    f'Bulk Mutation {operation_name} {operation_id}: {operation["status"]}, '
+                    f'{operation["objectCount"]} objects'
+                )
+
+            # A failed operation may still have processed some lines before it stopped
+            url = operation['url'] or operation['partialDataUrl']
+            if operation['status'] != 'COMPLETED' and not url:
+                raise Exception(f'Bulk Operation {operation_id} {operation["status"]}: {operation["errorCode"]}')
+
+            result = [{'data': None, 'errors': ['No result returned']} for _ in variables]
+            if url:
+                with requests.get(url, stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    for line in response.iter_lines():
+                        if line:
+                            line = json.loads(line)
+                            result[line['__lineNumber']] = {
+                                'data': line.get('data'),
+                                'errors': line.get('errors', []),
+                            }
+            return result
+
+        @staticmethod
+        def upload(variables: list[dict]) -> str:
+            """Upload a JSONL file of mutation variables and return its staged upload path."""
+            response = Shopify.Query(
+                document=Shopify.Product.Files.queries,
+                variables={
+                    'input': [
+                        {
+                            'resource': 'BULK_MUTATION_VARIABLES',
+                            'filename': 'bulk_op_vars.jsonl',
+                            'mimeType': 'text/jsonl',
+                            'httpMethod': 'POST',
+                        }
+                    ]
+                },
+                operation_name='stagedUploadsCreate',
+            )
+            target = response.data['stagedUploadsCreate']['stagedTargets'][0]
+            form_data = {x['name']: x['value'] for x in target['parameters']}
+            body = '\n'.join(json.dumps(x) for x in variables).encode()
+            upload = requests.post(url=target['url'], files={'file': ('bulk_op_vars.jsonl', body)}, data=form_data)
+            if not 200 <= upload.status_code < 300:
+                raise Exception(f'Bulk mutation variables failed to upload. Code: {upload.status_code}')
+            return form_data['key']
+
+        @staticmethod
+        def wait(operation_id: str) -> dict:
+            """Poll an operation with backoff until it reaches a final status."""
+            interval = Shopify.BulkOperation.poll_interval
+            deadline = time.monotonic() + Shopify.BulkOperation.timeout
+            while True:
+                operation = Shopify.Query(
+                    document=Shopify.BulkOperation.queries,
+                    variables={'id': operation_id},
+                    operation_name='bulkOperation',
+                ).data['node']
+                if operation['status'] not in ('CREATED', 'RUNNING', 'CANCELING'):
+                    return operation
+                if time.monotonic() > deadline:
+                    Shopify.BulkOperation.cancel(operation_id)
+                    raise TimeoutError(
+                        f'Bulk Operation {operation_id} did not finish in {Shopify.BulkOperation.timeout} seconds'
+                    )
+                sleep(interval)
+                interval = min(interval * 2, Shopify.BulkOperation.max_poll_interval)
+
+        @staticmethod
+        def cancel(operation_id: str):
+            response = Shopify.Query(
+                document=Shopify.BulkOperation.queries,
+                variables={'id': operation_id},
+                operation_name='bulkOperationCancel',
+            )
+            return response.data
+
+        @staticmethod
+        def stream(url: str):
+            """Download the JSONL result line by line so memory stays flat regardless of result size."""
+            with requests.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        yield Shopify.BulkOperation.Record(json.loads(line))
+
     class Order:
         queries = './integration/queries/orders.graphql'
         prefix = 'gid://shopify/Order/'
@@ -444,7 +964,7 @@ class Shopify:
         queries = './integration/queries/customers.graphql'
         prefix = 'gid://shopify/Customer/'
 
-        def get(customer_id: int = None, rest=False):
+        def get(customer_id: int = None, rest=False, bulk=False):
             if rest:
                 if customer_id:
                     response = requests.get(
@@ -460,6 +980,10 @@ class Shopify:
                 )
                 return response.data
 
+            if bulk:
+                query = '{ customers { edges { node { id } } } }'
+                return [x.id for x in Shopify.BulkOperation.run(query)]
+
             id_list = []
             variables = {'first': 250}
             response = Shopify.Query(
@@ -476,12 +1000,10 @@ class Shopify:
 
             return id_list
 
-        def get_customer_ids_not_in_mw():
-            all_shopify_cust_ids = Shopify.Customer.get()
+        def get_customer_ids_not_in_mw(bulk=False):
+            all_shopify_cust_ids = Shopify.Customer.get(bulk=bulk)
             all_mw_cust_data = Database.Shopify.Customer.get()
-            all_mw_cust_ids = []
-            for x in all_mw_cust_data:
-                all_mw_cust_ids.append(x[2])
+            all_mw_cust_ids = set(x[2] for x in all_mw_cust_data) if all_mw_cust_data else set()
             return [x for x in all_shopify_cust_ids if x not in all_mw_cust_ids]
 
         def get_customer_metafields(metafields: list):
@@ -568,10 +1090,10 @@ class Shopify:
 
         def backfill(all=False):
             if all:
-                cust_ids = Shopify.Customer.get()
+                cust_ids = Shopify.Customer.get(bulk=True)
 
             else:
-                cust_ids = Shopify.Customer.get_customer_ids_not_in_mw()
+                cust_ids = Shopify.Customer.get_customer_ids_not_in_mw(bulk=True)
 
             if cust_ids:
                 for shop_cust_id in cust_ids:
@@ -732,7 +1254,7 @@ class Shopify:
         queries = './integration/queries/products.graphql'
         prefix = 'gid://shopify/Product/'
 
-        def get(product_id: int = None, collection_title: str = None):
+        def get(product_id: int = None, collection_title: str = None, bulk=False):
             if product_id:
                 variables = {'id': f'{Shopify.Product.prefix}{product_id}'}
                 response = Shopify.Query(
@@ -749,6 +1271,10 @@ class Shopify:
             if collection_id:
                 Database.Shopify.Product.get(collection_id=collection_id)
 
+            if bulk:
+                query = '{ products { edges { node { id } } } }'
+                return [str(x.id) for x in Shopify.BulkOperation.run(query)]
+
             id_list = []
             variables = {'first': 250, 'after': None}
             response = Shopify.Query(
@@ -763,7 +1289,12 @@ class Shopify:
                 id_list += [x['node']['id'].split('/')[-1] for x in response.data['products']['edges']]
             return id_list
 
-        def get_all(collection_id: int = None):
+        def get_all(collection_id: int = None, bulk=False):
+            if collection_id and bulk:
+                query = f"""{{ collection(id: "{Shopify.Collection.prefix}{collection_id}") {{
+                    products {{ edges {{ node {{ id }} }} }} }} }}"""
+                return [str(x.id) for x in Shopify.BulkOperation.run(query) if x.type == 'Product']
+
             id_list = []
             start = True
             response = None
@@ -784,7 +1315,7 @@ class Shopify:
 
                 return id_list
             else:
-                return Shopify.Product.get()
+                return Shopify.Product.get(bulk=bulk)
 
         def create(product_payload) -> tuple:
             """Create product on shopify and return tuple of product ID, media IDs, and variant IDs"""
@@ -844,10 +1375,7 @@ class Shopify:
             return result
 
         def update(product_payload):
-            if 'media' in product_payload:
-                operation_name = 'UpdateProductWithNewMedia'
-            else:
-                operation_name = 'updateProduct'
+            operation_name = Shopify.Product.get_update_operation(product_payload)
 
             response = Shopify.Query(
                 document=Shopify.Product.queries, operation_name=operation_name, variables=product_payload
@@ -858,13 +1386,44 @@ class Shopify:
                     f'Error: {response.errors}\nUser Error: {response.user_errors}\nPayload: {product_payload}'
                 )
 
-            media_ids = [
-                x['id'].split('/')[-1] for x in response.data['productUpdate']['product']['media']['nodes']
-            ]
-            option_ids = [x['id'].split('/')[-1] for x in response.data['productUpdate']['product']['options']]
+            return Shopify.Product.parse_update_response(response.data['productUpdate'])
+
+        def update_bulk(product_payloads: list[dict]) -> list:
+            """Update many existing products in one bulk mutation per operation type. Returns a list in input
+            order holding the same dict as update() or an Exception for products that failed."""
+            result = [None] * len(product_payloads)
+            groups = {}
+            for i, payload in enumerate(product_payloads):
+                groups.setdefault(Shopify.Product.get_update_operation(payload), []).append(i)
+
+            for operation_name, indexes in groups.items():
+                responses = Shopify.BulkOperation.run_mutation(
+                    document=Shopify.Product.queries,
+                    operation_name=operation_name,
+                    variables=[product_payloads[i] for i in indexes],
+                )
+                for i, response in zip(indexes, responses):
+                    data = response['data']['productUpdate'] if response['data'] else None
+                    if response['errors'] or not data or data['userErrors']:
+                        user_errors = [x['message'] for x in data['userErrors']] if data else []
+                        result[i] = Exception(f'Error: {response["errors"]}\nUser Error: {user_errors}')
+                    else:
+                        result[i] = Shopify.Product.parse_update_response(data)
+
+            return result
+
+        def get_update_operation(product_payload) -> str:
+            if 'media' in product_payload:
+                return 'UpdateProductWithNewMedia'
+            else:
+                return 'updateProduct'
+
+        def parse_update_response(data: dict) -> dict:
+            media_ids = [x['id'].split('/')[-1] for x in data['product']['media']['nodes']]
+            option_ids = [x['id'].split('/')[-1] for x in data['product']['options']]
             meta_ids = [
                 {'id': x['node']['id'].split('/')[-1], 'namespace': x['node']['namespace'], 'key': x['node']['key']}
-                for x in response.data['productUpdate']['product']['metafields']['edges']
+                for x in data['product']['metafields']['edges']
             ]
 
             variant_meta_ids = [
@@ -874,7 +1433,7 @@ class Shopify:
                     'key': x['metafield']['key'],
                     'value': x['metafield']['value'],
                 }
-                for x in response.data['productUpdate']['product']['variants']['nodes']
+                for x in data['product']['variants']['nodes']
                 if x['metafield']
             ]
 
@@ -973,7 +1532,7 @@ class Shopify:
                 )
                 return response.data
 
-            def parse_bulk_variant_response(operation_name, variables, response):
+            def parse_bulk_variant_response(operation_name, variables, data):
                 result = {}
 
                 for i in variables['variants']:
@@ -982,23 +1541,23 @@ class Shopify:
                     result[sku] = {
                         'variant_id': [
                             x['id'].split('/')[-1]
-                            for x in response.data[operation_name]['productVariants']
+                            for x in data[operation_name]['productVariants']
                             if x['sku'] == sku
                         ][0],
                         'option_value_id': [
                             x['id'].split('/')[-1]
-                            for x in response.data[operation_name]['product']['options'][0]['optionValues']
+                            for x in data[operation_name]['product']['options'][0]['optionValues']
                             if x['name'] == name
                         ][0],
                         'inventory_id': [
                             x['inventoryItem']['id'].split('/')[-1]
-                            for x in response.data[operation_name]['productVariants']
+                            for x in data[operation_name]['productVariants']
                             if x['sku'] == sku
                         ][0],
                         'has_image': True
                         if [
                             x['image']['id'].split('/')[-1]
-                            for x in response.data[operation_name]['productVariants']
+                            for x in data[operation_name]['productVariants']
                             if x['sku'] == sku and x['image'] is not None
                         ]
                         else False,
@@ -1009,7 +1568,7 @@ class Shopify:
                                 'key': x['metafield']['key'],
                                 'value': x['metafield']['value'],
                             }
-                            for x in response.data[operation_name]['productVariants']
+                            for x in data[operation_name]['productVariants']
                             if x['sku'] == sku and x['metafield']
                         ],
                     }
@@ -1021,7 +1580,7 @@ class Shopify:
                 response = Shopify.Query(
                     document=Shopify.Product.Variant.queries, operation_name=operation_name, variables=variables
                 )
-                return Shopify.Product.Variant.parse_bulk_variant_response(operation_name, variables, response)
+                return Shopify.Product.Variant.parse_bulk_variant_response(operation_name, variables, response.data)
 
             def update_single(variables):
                 response = Shopify.Query(
@@ -1029,7 +1588,10 @@ class Shopify:
                     variables=variables,
                     operation_name='productVariantUpdate',
                 )
-                metafield = response.data['productVariantUpdate']['productVariant']['metafield']
+                return Shopify.Product.Variant.parse_single_variant_response(response.data)
+
+            def parse_single_variant_response(data):
+                metafield = data['productVariantUpdate']['productVariant']['metafield']
                 variant_meta_ids = []
                 if metafield:
                     variant_meta_ids.append(
@@ -1048,7 +1610,27 @@ class Shopify:
                 response = Shopify.Query(
                     document=Shopify.Product.Variant.queries, variables=variables, operation_name=operation_name
                 )
-                return Shopify.Product.Variant.parse_bulk_variant_response(operation_name, variables, response)
+                return Shopify.Product.Variant.parse_bulk_variant_response(operation_name, variables, response.data)
+
+            def update_many(operation_name: str, variables: list[dict]) -> list:
+                """Run productVariantsBulkUpdate or productVariantUpdate for many products in one bulk mutation.
+                Returns a list in input order holding the parsed response or an Exception for failed products."""
+                result = []
+                responses = Shopify.BulkOperation.run_mutation(
+                    document=Shopify.Product.Variant.queries, operation_name=operation_name, variables=variables
+                )
+                for payload, response in zip(variables, responses):
+                    data = response['data']
+                    user_errors = [x['message'] for x in data[operation_name]['userErrors']] if data else []
+                    if response['errors'] or not data or user_errors:
+                        result.append(Exception(f'Error: {response["errors"]}\nUser Error: {user_errors}'))
+                    elif operation_name == 'productVariantUpdate':
+                        result.append(Shopify.Product.Variant.parse_single_variant_response(data))
+                    else:
+                        result.append(
+                            Shopify.Product.Variant.parse_bulk_variant_response(operation_name, payload, data)
+                        )
+                return result
 
             def delete(product_id, variant_id: int):
                 response = Shopify.Query(
@@ -1146,6 +1728,15 @@ class Shopify:
                 else:
                     return [x for x in response.data['product']['media']['nodes']]
 
+            def get_status(product_id: int) -> dict[str, str]:
+                """Returns {media gid: status} (UPLOADED, PROCESSING, READY, FAILED) for a product."""
+                response = Shopify.Query(
+                    document=Shopify.Product.Media.queries,
+                    variables={'id': f'{Shopify.Product.prefix}{product_id}'},
+                    operation_name='productMediaStatus',
+                )
+                return {x['id']: x['status'] for x in response.data['product']['media']['nodes']}
+
             def reorder(product):
                 if not product.reorder_media_queue:
                     return
@@ -1499,9 +2090,29 @@ class Shopify:
             )
             return response.data
 
+        def update_many(quantities: list[dict], batch_size: int = 250) -> int:
+            """Sets available quantities for any number of inventory items, packing up to 250 per
+            inventorySetQuantities call. Each quantity is {'inventoryItemId', 'locationId', 'quantity'}.
+            Returns the number of calls made."""
+            calls = 0
+            for i in range(0, len(quantities), batch_size):
+                payload = {
+                    'input': {
+                        'name': 'available',
+                        'reason': 'other',
+                        'ignoreCompareQuantity': True,
+                        'quantities': quantities[i : i + batch_size],
+                    }
+                }
+                Shopify.Inventory.update(payload)
+                calls += 1
+            return calls
+
     class Collection:
         queries = './integration/queries/collections.graphql'
         prefix = 'gid://shopify/Collection/'
+        job_poll_interval = 0.5  # Seconds between checks of a reorder job
+        job_timeout = 120
 
         def get(collection_id: int = None, collection_handle=None):
             if collection_id:
@@ -1571,42 +2182,33 @@ class Shopify:
         def get_product_ids(collection_id: int):
             return Shopify.Product.get_all(collection_id=collection_id)
 
-        def get_out_of_stock_items(collection_id: int, eh=ProcessOutErrorHandler):
-            """Get a list of out of stock items in a collection"""
-            try:
-                response = None
-                variables = {'collectionID': f'{Shopify.Collection.prefix}{collection_id}', 'after': None}
-
-                data = []
-
-                preorder_product_ids = products.get_preorder_product_ids()
-
-                while response is None or response.data['products']['pageInfo']['hasNextPage']:
-                    if response is not None:
-                        variables['after'] = response.data['products']['pageInfo']['endCursor']
-
-                    response = Shopify.Query(
-                        document=Shopify.Product.queries, variables=variables, operation_name='outOfStockProducts'
-                    )
-
-                    for edge in response.data['products']['edges']:
-                        if not edge['node']['inCollection']:
-                            continue
-
-                        id = int(edge['node']['id'].split('/')[-1])
-
-                        if id in preorder_product_ids:
-                            continue
-
-                        data.append(id)
-
-                return data
-            except Exception as e:
-                eh.error_handler.add_error_v(
-                    error=f'Error getting out of stock items for collection {collection_id}: {e}',
-                    origin='Shopify.Collection.get_out_of_stock_items',
+        def get_product_order(collection_id: int, with_sort_order=False) -> list[int] | tuple[str, list[int]]:
+            """Get the product IDs of a collection in their current collection order. With with_sort_order,
+            returns (sort_order, product_ids)."""
+            product_ids = []
+            variables = {'id': f'{Shopify.Collection.prefix}{collection_id}', 'after': None}
+            while True:
+                response = Shopify.Query(
+                    document=Shopify.Collection.queries,
+                    variables=variables,
+                    operation_name='collectionProductOrder',
                 )
-                return []
+                data = response.data['collection']['products']
+                product_ids += [int(x['node']['id'].split('/')[-1]) for x in data['edges']]
+                if not data['pageInfo']['hasNextPage']:
+                    if with_sort_order:
+                        return response.data['collection']['sortOrder'], product_ids
+                    return product_ids
+                variables['after'] = data['pageInfo']['endCursor']
+
+        def get_manual_order(collection_id: int) -> list[int]:
+            """Get the current product order of a collection, switching it to manual sorting first if it is
+            not already manually sorted."""
+            sort_order, product_ids = Shopify.Collection.get_product_order(collection_id, with_sort_order=True)
+            if sort_order == 'MANUAL':
+                return product_ids
+            Shopify.Collection.change_sort_order_to_manual(collection_id=collection_id)
+            return Shopify.Collection.get_product_order(collection_id)
 
         def reorder_250_items(collection_id: int, moves: list[MoveInput], eh=ProcessOutErrorHandler):
             """Reorder up to 250 items within a collection. ONLY WORKS ON MANUALLY SORTED COLLECTIONS"""
@@ -1621,76 +2223,66 @@ class Shopify:
             )
             return response.data
 
-        def reorder_items(collection_id: int, collection_of_moves: MovesCollection, eh=ProcessOutErrorHandler):
-            """Reorder any amount of items using a MovesCollection. ONLY WORKS ON MANUALLY SORTED COLLECTIONS"""
+        def wait_for_job(job: dict):
+            """Wait for an asynchronous reorder job to finish"""
+            deadline = time.monotonic() + Shopify.Collection.job_timeout
+            while job and not job['done']:
+                if time.monotonic() > deadline:
+                    raise Exception(f'Reorder job {job["id"]} did not finish in {Shopify.Collection.job_timeout}s')
+                sleep(Shopify.Collection.job_poll_interval)
+                response = Shopify.Query(
+                    document=Shopify.Collection.queries, variables={'id': job['id']}, operation_name='reorderJob'
+                )
+                job = response.data['job']
+
+        def reorder_items(
+            collection_id: int, collection_of_moves: MovesCollection, eh=ProcessOutErrorHandler, sequential=False
+        ):
+            """Reorder any amount of items using a MovesCollection. ONLY WORKS ON MANUALLY SORTED COLLECTIONS
+
+            Moves built against a running order (MovesCollection.from_diff) must be sent with sequential=True.
+            Shopify applies each batch in a background job, so sequential waits for one to finish before sending
+            the next."""
             responses = []
 
-            list_of_moves = collection_of_moves.get()
+            list_of_moves = [moves for moves in collection_of_moves.get() if moves]
 
             def task(moves):
                 return Shopify.Collection.reorder_250_items(collection_id=collection_id, moves=moves, eh=eh)
 
+            if sequential:
+                for i, moves in enumerate(list_of_moves):
+                    response = task(moves)
+                    responses.append(response)
+                    if i < len(list_of_moves) - 1:
+                        Shopify.Collection.wait_for_job(response['collectionReorderProducts']['job'])
+                return responses
+
             with concurrent.futures.ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
                 responses = executor.map(task, list_of_moves)
 
             return responses
 
-        def move_to_bottom(collection_id: int, product_id_list: list[int], eh=ProcessOutErrorHandler):
-            """Move a list of items to the bottom of a collection"""
-            count = Shopify.Collection.get_product_count(collection_id=collection_id)
-            mc = MovesCollection()
-            for i, product_id in enumerate(product_id_list):
-                move = MoveInput(item_id=product_id, position=count - (i + 1))
-                mc.add(move)
-
-            return Shopify.Collection.reorder_items(collection_id=collection_id, collection_of_moves=mc, eh=eh)
-
-        def move_all_out_of_stock_to_bottom(verbose=False, eh=ProcessOutErrorHandler):
-            """Move all out of stock items to the bottom of all collections"""
-
-            collections = [int(x['id']) for x in Shopify.Collection.get()]
-
-            if verbose:
-                eh.logger.info(
-                    f'COLLECTIONS SORT: Moving all out of stock items to bottom of {len(collections)} collections'
+        def apply_order(
+            collection_id: int, target: list[int], current: list[int] = None, eh=ProcessOutErrorHandler
+        ) -> int:
+            """Bring a collection into the target order by sending only the moves that change it.
+            Products in the collection that are missing from target keep their relative order behind it.
+            Returns the number of moves sent."""
+            if current is None:
+                current = Shopify.Collection.get_manual_order(collection_id)
+
+            in_collection = set(current)
+            target = [x for x in dict.fromkeys(target) if x in in_collection]
+            targeted = set(target)
+            target += [x for x in current if x not in targeted]
+
+            mc = MovesCollection.from_diff(current=current, target=target)
+            if len(mc):
+                Shopify.Collection.reorder_items(
+                    collection_id=collection_id, collection_of_moves=mc, eh=eh, sequential=True
                 )
-
-            responses = []
-
-            def change_sort_order_to_manual(collection_id):
-                Shopify.Collection.change_sort_order_to_manual(collection_id=collection_id)
-
-            def task(collection_id):
-                # Spawn a new thread to run change the sort order to manual
-                thread = threading.Thread(target=change_sort_order_to_manual, args=(collection_id,))
-
-                # Start the thread.
-                # Our task will continue to run at the same time.
-                thread.start()
-
-                items = [x for x in Shopify.Collection.get_out_of_stock_items(collection_id=collection_id, eh=eh)]
-
-                if len(items) == 0:
-                    return
-
-                # Wait for the thread to finish if it hasn't already.
-                thread.join()
-
-                response = Shopify.Collection.move_to_bottom(
-                    collection_id=collection_id, product_id_list=items, eh=eh
-                )
-
-                responses.append(response)
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
-                responses = executor.map(task, collections)
-
-            if verbose:
-                eh.logger.success(
-                    f'COLLECTIONS SORT: Moved all out of stock items to bottom of {len(collections)} collections'
-                )
-
-            return responses
+            return len(mc)
 
         def change_sort_order_to_manual(collection_id: int):
             """Change sort order to manual for a collection"""
@@ -1792,7 +2384,7 @@ class Shopify:
         prefix = 'gid://shopify/Metafield/'
 
         def backfill_metafields_to_counterpoint():
-            all_products = Shopify.Product.get_all()
+            all_products = Shopify.Product.get_all(bulk=True)
             for product_id in all_products:
                 response = Shopify.Product.get(product_id)
                 try:
@@ -2407,7 +2999,7 @@ def refresh_order(tkt_no):
 
 
 if __name__ == '__main__':
-    shopify_product_ids = Shopify.Product.get()
+    shopify_product_ids = Shopify.Product.get(bulk=True)
     for x in shopify_product_ids:
         res = Database.query(f"SELECT * FROM SN_SHOP_PROD WHERE PRODUCT_ID = {x}", mapped=True)
         if res['code'] == 201:
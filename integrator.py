@@ -1,6 +1,7 @@
 from integration.catalog_api import Catalog, Product, Collections
 from integration.customers_api import Customers, Subscribers
 from integration.promotions_api import Promotions
+from integration.shopify_api import Shopify
 from datetime import datetime
 
 from database import Database
@@ -10,7 +11,7 @@ from setup import creds
 from setup import date_presets
 from product_tools.sort_order import SortOrderEngine
 from setup.error_handler import ProcessOutErrorHandler
-from setup.utilities import get_last_sync, set_last_sync, timer
+from setup.utilities import get_last_sync, set_last_sync, timer, StageScheduler
 
 import sys
 import time
@@ -41,20 +42,36 @@ class Integrator:
         self.catalog_sync: bool = creds.Integrator.catalog_sync
         self.sort_collections: bool = creds.Integrator.collection_sorting
 
+        # Exact changed keys from SQL Server Change Tracking. Falls back to last_sync when disabled or expired.
+        self.change_feed: Database.ChangeFeed = None
+        if creds.Integrator.change_tracking:
+            self.change_feed = Database.ChangeFeed('integrator')
+        feed = self.change_feed
+
         # Sync components
         if self.customer_sync:
-            self.customers: Customers = Customers(last_sync=self.last_sync, verbose=self.verbose)
+            self.customers: Customers = Customers(
+                last_sync=self.last_sync, verbose=self.verbose, changes=feed.customers if feed else None
+            )
         if self.subscriber_sync:
             self.subscribers: Subscribers = Subscribers(last_sync=self.last_sync, verbose=self.verbose)
         if self.promotions_sync:
             self.promotions: Promotions = Promotions(last_sync=datetime(2020,1,1), verbose=self.verbose)
         if self.catalog_sync:
-            self.catalog: Catalog = Catalog(dates=self.dates, last_sync=self.last_sync, verbose=self.verbose)
+            self.catalog: Catalog = Catalog(
+                dates=self.dates,
+                last_sync=self.last_sync,
+                verbose=self.verbose,
+                changes=feed.items if feed else None,
+                changed_categories=feed.categories if feed else None,
+            )
 
     def __str__(self):
         result = creds.Integrator.title + '\n'
         result += f'Authors: {creds.Integrator.authors}\nVersion: {creds.Integrator.version}\n'
         result += f'Last Sync: {self.last_sync}\n----------------\n'
+        if self.change_feed:
+            result += str(self.change_feed)
 
         sync_tasks = ''
 
@@ -83,24 +100,40 @@ class Integrator:
             f'Starting sync at {self.start_sync_time:%Y-%m-%d %H:%M:%S}. Last sync: {integrator.last_sync}'
         )
 
+        # Independent stages run concurrently. Subscribers match on customers synced this cycle, and
+        # promotions touch product timestamps, so the catalog queue is rebuilt after they finish.
+        scheduler = StageScheduler(eh=Integrator.eh)
         if self.customer_sync:
-            self.customers.sync()
+            scheduler.add('customers', self.customers.sync)
         if self.subscriber_sync:
-            self.subscribers.sync()
+            scheduler.add('subscribers', self.subscribers.sync, after=['customers'])
         if self.promotions_sync:
-            self.promotions.sync()
+            scheduler.add('promotions', self.promotions.sync)
         if self.catalog_sync:
-            self.catalog.sync()
+            scheduler.add('catalog', self.sync_catalog, after=['promotions'])
+        scheduler.run()
 
         # Finished
         self.completion_time = datetime.now()
         integrator.logger.info(f'Sync complete at {self.completion_time:%Y-%m-%d %H:%M:%S}')
+        if self.verbose:
+            self.logger.info(f'Database Connection Pool: {Database.pool}')
+            self.logger.info(str(Database.id_cache))
+            self.logger.info(f'Shopify API Latency: {Shopify.stats}')
+            self.logger.info(f'Shopify API Throttle: {Shopify.throttler}')
+            self.logger.info(f'Sync Stages: {scheduler}')
 
         set_last_sync(file_name='./integration/last_sync_integrator.txt', start_time=self.start_sync_time)
+        if self.change_feed:
+            self.change_feed.commit()
 
         if self.error_handler.errors:
             self.error_handler.print_errors()
 
+    def sync_catalog(self):
+        # Catalog.sync() rebuilds its queue first, picking up timestamps touched by the promotion sync
+        self.catalog.sync()
+
 
 def main_menu():
     """WIP: Menu System for CLI Interface"""
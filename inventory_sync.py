@@ -1,16 +1,19 @@
-from integration.catalog_api import Catalog
+from integration.shopify_api import Shopify
 from product_tools import inventory_upload
 import sys
-from setup.date_presets import Dates
+from database import Database as db
 from datetime import datetime
 from setup import creds
 from setup.error_handler import ProcessOutErrorHandler
 from traceback import format_exc as tb
 from setup.utilities import get_last_sync, set_last_sync
-from time import sleep
+from time import sleep, monotonic
 
 
 class Inventory:
+    """Pushes available quantities for items whose Counterpoint inventory changed since the last run. Reads
+    every changed row in one query and sends them in batches, without building Catalog/Product objects."""
+
     eh = ProcessOutErrorHandler
     logger = eh.logger
     error_handler = eh.error_handler
@@ -18,51 +21,135 @@ class Inventory:
     def __init__(self):
         self.last_sync = get_last_sync(file_name='./integration/last_sync_inventory.txt')
         self.verbose = creds.Integrator.verbose_logging
-        self.dates = Dates()
-        self.catalog = Catalog(
-            dates=self.dates, last_sync=self.last_sync, inventory_only=True, verbose=self.verbose
-        )
+        self.changes: list[dict] = []
 
     def __str__(self):
         return f'Integrator\n' f'Last Sync: {self.last_sync}\n'
 
-    def sync(self, initial=False):
+    def get_changes(self):
+        self.changes = [x for x in db.CP.Product.get_inventory_changes(self.last_sync) if x['IS_PREORDER'] != 'Y']
+
+    def get_quantities(self) -> list[dict]:
+        """Returns inventorySetQuantities entries with the stock buffer applied."""
+        return [
+            {
+                'inventoryItemId': f'gid://shopify/InventoryItem/{x["INVENTORY_ID"]}',
+                'locationId': creds.Shopify.Location.n2,
+                'quantity': max(x['QTY_AVAIL'] - x['BUFFER'], 0),
+            }
+            for x in self.changes
+        ]
+
+    def sync(self, initial=False) -> int:
+        """Returns the number of items sent to Shopify."""
         start_sync_time = datetime.now()
-        self.catalog.sync()
+        self.get_changes()
+        calls = 0
+        if self.changes:
+            try:
+                calls = Shopify.Inventory.update_many(self.get_quantities())
+            except Exception as e:
+                Inventory.error_handler.add_error_v(
+                    error=f'Error updating inventory: {e}', origin='Inventory.sync', traceback=tb()
+                )
+                return 0
+        self.last_sync = start_sync_time
         set_last_sync(file_name='./integration/last_sync_inventory.txt', start_time=start_sync_time)
         completion_time = (datetime.now() - start_sync_time).seconds
-        if self.verbose:
-            Inventory.logger.info(f'Inventory Sync completion time: {completion_time} seconds')
+        if self.verbose and self.changes:
+            Inventory.logger.info(
+                f'Inventory Sync: {len(self.changes)} items in {calls} calls. '
+                f'Completion time: {completion_time} seconds'
+            )
         if Inventory.error_handler.errors:
             Inventory.error_handler.print_errors()
+        return len(self.changes)
+
+
+class CycleStats:
+    """Timing counters for inventory daemon cycles."""
+
+    def __init__(self):
+        self.cycles = 0
+        self.idle_cycles = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.started = datetime.now()
+
+    def __str__(self):
+        avg = self.total / self.cycles if self.cycles else 0
+        return (
+            f'Inventory Daemon: cycles: {self.cycles}, idle: {self.idle_cycles}, items: {self.items}, '
+            f'avg: {avg:.3f}s, max: {self.max:.3f}s, last: {self.last:.3f}s, since: {self.started:%H:%M:%S}'
+        )
+
+    def add(self, elapsed: float, items: int):
+        self.cycles += 1
+        self.items += items
+        if not items:
+            self.idle_cycles += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.last = elapsed
+
+    def reset(self):
+        self.__init__()
+
+
+class InventoryDaemon:
+    """Runs Inventory.sync in a loop with one long-lived Inventory object. Polls at the minimum interval
+    while changes keep arriving and backs off (doubling) toward the day/night interval while idle."""
+
+    def __init__(self, inventory: Inventory):
+        self.inventory = inventory
+        self.interval = creds.Integrator.inv_min_run_interval
+        self.last_upload = None
+        self.stats = CycleStats()
+
+    def __str__(self):
+        return f'{self.stats}, interval: {self.interval}s'
+
+    @staticmethod
+    def max_interval():
+        if creds.Integrator.day_start <= datetime.now().hour <= creds.Integrator.day_end:
+            return creds.Integrator.inv_day_run_interval
+        return creds.Integrator.inv_night_run_interval
+
+    def next_interval(self, items: int):
+        if items:
+            self.interval = creds.Integrator.inv_min_run_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval())
+        return self.interval
+
+    def upload(self):
+        """Upload inventory CSVs to the file share on a fixed schedule, independent of the poll rate."""
+        if self.last_upload is None or monotonic() - self.last_upload >= creds.Integrator.inv_upload_interval:
+            inventory_upload.upload_inventory(verbose=self.inventory.verbose, eh=Inventory.eh)
+            self.last_upload = monotonic()
+            if self.inventory.verbose:
+                Inventory.logger.info(str(self))
+
+    def run(self):
+        while True:
+            try:
+                self.upload()
+                start = monotonic()
+                items = self.inventory.sync()
+                self.stats.add(monotonic() - start, items)
+                sleep(self.next_interval(items))
+
+            except Exception as e:
+                Inventory.error_handler.add_error_v(error=f'Error: {e}', origin='inventory_sync.py', traceback=tb())
+                sleep(60)
 
 
 if __name__ == '__main__':
     inventory = Inventory()
     if len(sys.argv) > 1:
         if '-v' in sys.argv:  # Set verbose logging
-                        inventory.verbose = True
-    
-    while True:
-        now = datetime.now()
-        hour = now.hour
-        
-        step = 6
-        if creds.Integrator.day_start <= hour <= creds.Integrator.day_end:
-            delay = creds.Integrator.inv_day_run_interval            
-        else:
-            delay = creds.Integrator.inv_night_run_interval
-        
-        try:
-            # Upload Inventory to file share.
-            inventory_upload.upload_inventory(verbose=inventory.verbose, eh=Inventory.eh)
-            
-            # Perform x(step) number of iterations of inventory sync before reuploading inventory.
-            for i in range(step):
-                inventory = Inventory()
-                inventory.sync()
-                sleep(delay)
-
-        except Exception as e:
-            Inventory.error_handler.add_error_v(error=f'Error: {e}', origin='inventory_sync.py', traceback=tb())
-            sleep(60)
+            inventory.verbose = True
+
+    InventoryDaemon(inventory).run()
@@ -740,24 +740,11 @@ def get_current_preorder_items_for_sort_order():
 
 def get_qty_sold_all_items():
     """Produces a list of all items with the total number of quantity sold"""
-    query = f"""
-    "{creds.SQL.DATABASE}"."dbo"."USP_RPT_SA_BY_X";1 
-    'select distinct IM_ITEM.ITEM_NO as GRP_ID, IM_ITEM.DESCR as GRP_DESCR 
-    from IM_ITEM 
-    where ( (1=1) ) 
-    union select distinct VI_PS_TKT_HIST_LIN.ITEM_NO as GRP_ID, NULL as GRP_DESCR 
-    from %HISTORY% where not exists(select 1 from IM_ITEM 
-    where IM_ITEM.ITEM_NO = VI_PS_TKT_HIST_LIN.ITEM_NO) and ((VI_PS_TKT_HIST.STR_ID = ''1'')) and 
-    ( (1=1) ) and %ANYPERIODFILTER%', 'select VI_PS_TKT_HIST_LIN.ITEM_NO as GRP_ID, %HISTCOLUMNS% 
-    from %HISTORY% where ((VI_PS_TKT_HIST.STR_ID = ''1'')) and ( (1=1) ) and %PERIODFILTER%', ' 
-    (VI_PS_TKT_HIST.POST_DAT >= ''2020-01-01'') and (VI_PS_TKT_HIST.POST_DAT <= ''{date_presets.today}'')', ' 
-    (1=0) ', ' (1=0) ', 0, 0, 'SLS_QTY_A - RTN_QTY_VALID_A - RTN_QTY_NONVALID_A', 2
-    """
-    response = db.query(query)
-    if response is not None:
+    response = db.SalesHistory.summarize('ITEM_NO', creds.SQL.SALES_HISTORY_START, date_presets.today, str_id='1')
+    if response:
         item_dict = {}
         for x in response:
-            item_dict[x[0]] = int(x[2])
+            item_dict[x['GRP_ID']] = int(x['QTY'])
         return item_dict
 
 
@@ -4,14 +4,16 @@ from setup.date_presets import *
 from setup.error_handler import ProcessOutErrorHandler as error_handler
 from database import Database as db
 from setup import creds
+from setup.creds import Table
 
 import concurrent.futures
 
 import time
 
-from integration.shopify_api import Shopify, MoveInput, MovesCollection
+from integration.shopify_api import Shopify
 
 import math
+import pandas as pd
 
 
 def constrain(n: float | int, low: float | int, high: float | int):
@@ -42,31 +44,25 @@ class SortOrderEngine:
     logger = error_handler.logger
 
     def group_ecomm_items_by_collection(top_ecomm_items_with_stock, verbose=False):
-        """Groups top ecomm items by collection"""
-        collections: dict[str, list[dict[str, str | int]]] = {}
+        """Groups top ecomm items by collection, keeping their ranked order within each collection."""
+        if not top_ecomm_items_with_stock:
+            return {}
 
-        items_not_found = 0
-
-        for i, item in enumerate(top_ecomm_items_with_stock):
-            try:
-                collection_ids = db.Shopify.Product.get_collection_ids(product_id=item['product_id'])
-
-                for collection_id in collection_ids:
-                    if collection_id not in collections:
-                        collections[collection_id] = []
-
-                    collections[collection_id].append(item)
-            except Exception as e:
-                SortOrderEngine.error_handler.add_error_v(
-                    error=f'Error getting collection ids for {item}: {e}',
-                    origin='SortOrderEngine.group_ecomm_items_by_collection',
-                )
-                items_not_found += 1
+        frame = pd.DataFrame(top_ecomm_items_with_stock)
+        collection_ids = db.Shopify.Product.get_collection_ids_many(frame['product_id'].tolist())
+        frame['collection_id'] = frame['product_id'].map(lambda x: collection_ids.get(x) or None)
 
+        items_not_found = int(frame['collection_id'].isna().sum())
         if items_not_found > 0:
             if verbose:
                 SortOrderEngine.logger.warn(f'{items_not_found} items not found in Shopify')
-        return collections
+
+        frame = frame.dropna(subset=['collection_id']).explode('collection_id')
+        columns = [x for x in frame.columns if x != 'collection_id']
+        return {
+            int(collection_id): group[columns].to_dict('records')
+            for collection_id, group in frame.groupby('collection_id', sort=False)
+        }
 
     def promote_fixed_price_sales(items: list):
         orig_items = items
@@ -126,11 +122,16 @@ class SortOrderEngine:
             """
 
             response = db.query(query)
-            response = [x[0] for x in response] if response else []
+            response = set(x[0] for x in response) if response else set()
+
+            binding_ids = db.CP.Product.get_binding_ids([x['item_no'] for x in items])
+            parents = db.CP.Product.get_family_members(
+                [x for x in binding_ids.values() if x], parents_only=True, web_enabled=False
+            )
 
             for item in items:
                 try:
-                    binding_id = products.get_binding_id(item['item_no'])
+                    binding_id = binding_ids.get(item['item_no'])
                     if binding_id is None:
                         if item['item_no'] in response:
                             featured_items.append(item)
@@ -138,7 +139,7 @@ class SortOrderEngine:
 
                         continue
 
-                    parent = products.get_parent_product(binding_id)
+                    parent = parents.get(binding_id)
 
                     if parent is None:
                         SortOrderEngine.error_handler.add_error_v(
@@ -146,7 +147,8 @@ class SortOrderEngine:
                         )
                         continue
 
-                    if parent in response:
+                    # Bindings with multiple parents are not promoted
+                    if len(parent) == 1 and parent[0] in response:
                         featured_items.append(item)
                 except Exception as e:
                     SortOrderEngine.error_handler.add_error_v(
@@ -176,83 +178,71 @@ class SortOrderEngine:
         )
 
     def remove_duplicate_products(items):
-        """Removes duplicate products"""
-
-        prod_ids = []
-        new_items = []
-
-        for item in items:
-            if item['product_id'] not in prod_ids:
-                new_items.append(item)
-                prod_ids.append(item['product_id'])
-
-        return new_items
+        """Removes duplicate products, keeping the highest ranked item of each"""
+        if not items:
+            return items
+        return pd.DataFrame(items).drop_duplicates(subset='product_id').to_dict('records')
+
+    def get_item_table(items: list[str]) -> pd.DataFrame:
+        """Returns one ranked row per item with its product ID and prices from a single bulk join. Items that
+        are not in the middleware are dropped."""
+        query = f"""
+        SELECT MW.ITEM_NO, MW.PRODUCT_ID, PRC.PRC_1, PRC.PRC_2
+        FROM {Table.Middleware.products} MW
+        INNER JOIN IM_PRC PRC ON MW.ITEM_NO = PRC.ITEM_NO
+        WHERE MW.ITEM_NO IN ({{keys}}) AND MW.PRODUCT_ID IS NOT NULL"""
+        columns = ['ITEM_NO', 'PRODUCT_ID', 'PRC_1', 'PRC_2']
+        details = pd.DataFrame(db.query_batch(query, keys=items, mapped=True), columns=columns)
+        details = details.drop_duplicates(subset='ITEM_NO')
+
+        ranked = pd.DataFrame({'item_no': items, 'rank': range(len(items))})
+        table = ranked.merge(details, left_on='item_no', right_on='ITEM_NO', how='inner').sort_values('rank')
+        return pd.DataFrame(
+            {
+                'item_no': table['item_no'],
+                'product_id': table['PRODUCT_ID'].astype('int64'),
+                'price_1': table['PRC_1'],
+                'price_2': table['PRC_2'],
+            }
+        )
 
     def parse_items(items, verbose=False):
         """Parses items for sorting"""
-        new_items = []
-
-        items_not_found = 0
+        if not items:
+            return []
 
-        for item in items:
-            try:
-                product_id = db.Shopify.Product.get_id(item_no=item)
-                if not product_id:
-                    continue
-
-                product_id = int(product_id)
-
-                def get_price(item_no):
-                    query = f"""
-                    SELECT PRC_1, PRC_2 FROM IM_PRC WHERE ITEM_NO = '{item_no}'
-                    """
-                    response = db.query(query)
-                    return response[0][0], response[0][1]
-
-                price_1, price_2 = get_price(item)
-
-                new_items.append(
-                    {'item_no': item, 'product_id': product_id, 'price_1': price_1, 'price_2': price_2}
-                )
-            except Exception as e:
-                SortOrderEngine.error_handler.add_error_v(
-                    error=f'Error parsing item {item}: {e}', origin='SortOrderEngine.parse_items'
-                )
-                items_not_found += 1
+        table = SortOrderEngine.get_item_table(items)
+        items_not_found = len(items) - len(table)
 
         if items_not_found > 0:
             if verbose:
                 SortOrderEngine.logger.warn(f'COLLECTIONS SORT: {items_not_found} items not found in Shopify')
 
-        return new_items
+        return [
+            {'item_no': x.item_no, 'product_id': int(x.product_id), 'price_1': x.price_1, 'price_2': x.price_2}
+            for x in table.itertuples(index=False)
+        ]
 
     def remove_excluded_collections(collections: dict, verbose=False) -> dict:
         """Removes excluded collections from collections dictionary"""
-        new_collections = {}
-
-        for collection_id, items in collections.items():
-            query = f"""
-                SELECT IMG_FILE FROM VI_SN_SHOP_CATEG
-                WHERE COLLECTION_ID = '{collection_id}'
-            """
+        sortable = db.Shopify.Collection.get_sortable(list(collections))
 
-            response = db.query(query)
-            try:
-                do_sort = str(response[0][0]).lower().strip() == 'true'
-            except Exception as e:
-                SortOrderEngine.error_handler.add_error_v(
-                    error=f'Error checking if collection {collection_id} is do sort: {e}',
-                    origin='SortOrderEngine.remove_excluded_collections',
-                )
-                do_sort = False
-
-            if do_sort:
-                new_collections[collection_id] = items
-            else:
-                if verbose:
+        if verbose:
+            for collection_id in collections:
+                if collection_id not in sortable:
                     SortOrderEngine.logger.info(f'COLLECTIONS SORT: Excluding collection {collection_id}')
 
-        return new_collections
+        return {k: v for k, v in collections.items() if k in sortable}
+
+    def rank(current: list[int], ranked: list[int], in_stock: dict[int, bool]) -> list[int]:
+        """Returns the target order of a collection. In stock items come first, led by the ranked items in
+        revenue order, and out of stock items go to the bottom. Items without a rank keep their current order.
+        Items missing from in_stock are treated as in stock."""
+        rank = {}
+        for product_id in ranked:
+            rank.setdefault(product_id, len(rank))
+
+        return sorted(current, key=lambda x: (not in_stock.get(x, True), rank.get(x, len(rank))))
 
     def sort(print_mode=False, out_of_stock_mode=True, verbose=False):
         """Sets sort order based on revenue data from prior year during the forecasted time period"""
@@ -340,41 +330,30 @@ class SortOrderEngine:
                 print('\n')
             return collections
 
-        collections_list = [(collection_id, items) for collection_id, items in collections.items()]
-
-        def task(collection):
-            collection_id, items = collection
-            Shopify.Collection.change_sort_order_to_manual(collection_id=collection_id)
-
-            mc = MovesCollection()
-            for item_index, item in enumerate(items):
-                product_id = item['product_id']
-
-                move = MoveInput(item_id=product_id, position=item_index)
+        collection_ids = list(collections)
+        in_stock = {}
+        if out_of_stock_mode:
+            # Every collection gets its out of stock items demoted, not only the ranked ones.
+            collection_ids += [x for x in (int(x['id']) for x in Shopify.Collection.get()) if x not in collections]
+            in_stock = db.Shopify.Product.get_stock_status()
 
-                mc.add(move)
+        def task(collection_id):
+            current = Shopify.Collection.get_manual_order(collection_id)
+            ranked = [int(item['product_id']) for item in collections.get(collection_id, [])]
+            target = SortOrderEngine.rank(current=current, ranked=ranked, in_stock=in_stock)
 
-            return Shopify.Collection.reorder_items(collection_id=collection_id, collection_of_moves=mc)
+            return Shopify.Collection.apply_order(
+                collection_id=collection_id, target=target, current=current, eh=SortOrderEngine.eh
+            )
 
         if verbose:
-            SortOrderEngine.logger.info(f'COLLECTIONS SORT: Processing {len(collections_list)} collections')
+            SortOrderEngine.logger.info(f'COLLECTIONS SORT: Processing {len(collection_ids)} collections')
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
-            responses = executor.map(task, collections_list)
+            responses = list(executor.map(task, collection_ids))
 
         if verbose:
-            SortOrderEngine.logger.success('COLLECTIONS SORT:Collections processed')
-
-        if not out_of_stock_mode:
-            duration = time.time() - start_time
-            SortOrderEngine.logger.info(f'COLLECTIONS SORT: : Completed in {duration:.2f} seconds')
-            return []
-
-        ###############################################################################################
-        #################### Move all out of stock items to bottom of collections. ####################
-        ###############################################################################################
-
-        responses = Shopify.Collection.move_all_out_of_stock_to_bottom(verbose=verbose, eh=SortOrderEngine.eh)
+            SortOrderEngine.logger.success(f'COLLECTIONS SORT: Collections processed with {sum(responses)} moves')
 
         duration = time.time() - start_time
 
@@ -1,4 +1,6 @@
+import concurrent.futures
 import datetime
+import functools
 import os
 
 from product_tools.products import get_ecomm_items_with_stock
@@ -64,34 +66,49 @@ def get_non_web_visibile_items():
     return result
 
 
-def revenue_sales_report(start_date, stop_date, split=True, anna_mode=False, short=False):
-    query = f"""
-    "{creds.SQL.DATABASE}"."dbo"."USP_RPT_SA_BY_X";1
-    'select distinct PS_STR.STR_ID as GRP_ID, PS_STR.DESCR as GRP_DESCR
-    from PS_STR
-    where ( (1=1) )
-    union
-    select distinct VI_PS_TKT_HIST.STR_ID as GRP_ID, NULL as GRP_DESCR
-    from %HISTORY%
-    where not exists(select 1 from PS_STR where PS_STR.STR_ID = VI_PS_TKT_HIST.STR_ID) and ( (1=1) ) and
-    ( (1=1) ) and %ANYPERIODFILTER%',
-    'select VI_PS_TKT_HIST.STR_ID as GRP_ID, %HISTCOLUMNS%
-    from %HISTORY% where ( (1=1) ) and ( (1=1) ) and %PERIODFILTER%', '
-    (VI_PS_TKT_HIST.POST_DAT >= ''{start_date}'') and (VI_PS_TKT_HIST.POST_DAT <= ''{stop_date}'')', '
-    (1=0) ', ' (1=0) ', 0, 0, 'GRP_ID', 2
-    """
-    results = db.query(query)
-    if results is not None:
-        retail_sales = results[0][5]
-        retail_valid_returns = results[0][9]
-        retail_nonvalid_returns = results[0][10]
-        web_sales = 0
-        web_valid_returns = 0
+class RevenuePlan:
+    """Revenue and ticket counts for date windows declared up front, fetched together so revenue_sales_report
+    renders each window from the results instead of querying per call. Windows not in the plan are queried."""
+
+    def __init__(self, windows: list[tuple], ticket_windows: list[tuple] = ()):
+        self.windows = list(dict.fromkeys(windows))
+        self.ticket_windows = list(dict.fromkeys(ticket_windows))
+        self.revenue: dict[tuple, list[dict]] = {}
+        self.tickets: dict[tuple, dict[str, int]] = {}
+
+    def fetch(self):
+        """One sales history query for every window and one ticket count query, run side by side"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            revenue = executor.submit(db.SalesHistory.summarize_windows, 'STR_ID', self.windows)
+            tickets = executor.submit(get_ticket_counts, self.ticket_windows)
+            self.revenue = revenue.result()
+            self.tickets = tickets.result()
+        return self
+
+
+def revenue_sales_report(start_date, stop_date, split=True, anna_mode=False, short=False, plan: RevenuePlan = None):
+    window = (start_date, stop_date)
+
+    def total_tickets():
+        if plan is not None and window in plan.tickets:
+            return format_total_tickets(plan.tickets[window])
+        return get_total_tickets(start_date, stop_date)
+
+    if plan is not None and window in plan.revenue:
+        results = plan.revenue[window]
+    else:
+        results = db.SalesHistory.summarize('STR_ID', start_date, stop_date, order_by='GRP_ID')
+    if results:
+        # Only stores with sales in the window have a row, so look each store up rather than relying on position.
+        stores = {str(x['GRP_ID']).strip(): x for x in results}
+        retail = stores.get('1', {})
+        web = stores.get('WEB', {})
+        retail_sales = retail.get('SLS_AMT', 0)
+        retail_valid_returns = retail.get('RTN_AMT', 0)
+        retail_nonvalid_returns = 0
+        web_sales = web.get('SLS_AMT', 0)
+        web_valid_returns = web.get('RTN_AMT', 0)
         web_nonvalid_returns = 0
-        if len(results) > 1:
-            web_sales = results[1][5]
-            web_valid_returns = results[1][9]
-            web_nonvalid_returns = results[1][10]
 
         # for reports with BOTH retail and web sales separated
         if split:
@@ -113,7 +130,7 @@ def revenue_sales_report(start_date, stop_date, split=True, anna_mode=False, sho
                 f"Total: ${"{:,}".format((retail_sales + web_sales) -
                                              (web_valid_returns + web_nonvalid_returns) -
                                              (retail_valid_returns + retail_nonvalid_returns))}<br>"
-                f"{get_total_tickets(start_date, stop_date)}</p>"
+                f"{total_tickets()}</p>"
             )
 
         # for reports with combined reporting
@@ -131,33 +148,50 @@ def revenue_sales_report(start_date, stop_date, split=True, anna_mode=False, sho
                     f"${"{:,}".format((retail_sales + web_sales) -
                                           (web_valid_returns + web_nonvalid_returns) -
                                           (retail_valid_returns + retail_nonvalid_returns))}"
-                    f"{get_total_tickets(start_date, stop_date)}</p>"
+                    f"{total_tickets()}</p>"
                 )
     else:
         return 'No Revenue Data Today'
 
 
-def get_total_tickets(start_day, end_day):
-    contents = ''
-    data = {}
-    categories = ['RETAIL', 'WHOLESALE']
-    for category in categories:
-        query = f"""
-        SELECT count(tic.TOT)
-        FROM PS_TKT_HIST tic
-        INNER JOIN AR_CUST cust on tic.CUST_NO = cust.CUST_NO
-        WHERE BUS_DAT >= '{start_day}' AND BUS_DAT <= '{end_day}' AND cust.CATEG_COD = '{category}'
-        """
-        response = db.query(query)
-        if response is not None:
-            data[category] = response[0][0]
+def get_ticket_counts(windows: list[tuple]) -> dict[tuple, dict[str, int]]:
+    """Returns {(start_day, end_day): {customer category: ticket count}} for many date windows in one query"""
+    windows = list(dict.fromkeys(windows))
+    result = {window: {} for window in windows}
+    if not windows:
+        return result
+
+    values = ', '.join('(?, CAST(? AS date), CAST(? AS date))' for _ in windows)
+    params = [x for i, (start_day, end_day) in enumerate(windows) for x in (i, start_day, end_day)]
+    query = f"""
+    SELECT W.WINDOW_ID, cust.CATEG_COD, count(tic.TOT)
+    FROM (VALUES {values}) AS W (WINDOW_ID, START_DAT, END_DAT)
+    INNER JOIN PS_TKT_HIST tic ON tic.BUS_DAT >= W.START_DAT AND tic.BUS_DAT <= W.END_DAT
+    INNER JOIN AR_CUST cust on tic.CUST_NO = cust.CUST_NO
+    WHERE cust.CATEG_COD IN ('RETAIL', 'WHOLESALE')
+    GROUP BY W.WINDOW_ID, cust.CATEG_COD
+    """
+    response = db.query(query, params=params)
+    if isinstance(response, list):
+        for window_id, category, count in response:
+            result[windows[window_id]][category] = count
+    return result
 
-    contents += f"\nTotal Retail Tickets: {data['RETAIL']}<br>"
-    contents += f"\nTotal Wholesale Tickets: {data['WHOLESALE']}<br>"
-    contents += f"\nTotal Tickets: {data['WHOLESALE'] + data['RETAIL']}"
+
+def format_total_tickets(data: dict[str, int]):
+    retail = data.get('RETAIL', 0)
+    wholesale = data.get('WHOLESALE', 0)
+    contents = ''
+    contents += f'\nTotal Retail Tickets: {retail}<br>'
+    contents += f'\nTotal Wholesale Tickets: {wholesale}<br>'
+    contents += f'\nTotal Tickets: {wholesale + retail}'
     return contents
 
 
+def get_total_tickets(start_day, end_day):
+    return format_total_tickets(get_ticket_counts([(start_day, end_day)])[(start_day, end_day)])
+
+
 def get_list_of_current_photo_sku():
     """Returns a sorted list of unique filenames from ItemImages Folder"""
     list_of_files = os.listdir(creds.Company.product_images)
@@ -189,19 +223,12 @@ def create_top_items_report(
         # Format one and two are strings (html, and text based response)
         result = ''
 
-    if category == 'ALL':
-        category_var = ' (1=1) '
-    else:
-        category_var = f"(VI_PS_TKT_HIST_LIN.CATEG_COD = ''{category}'')"
-
     if mode == 'quantity':
-        rank_filter = 'SLS_QTY_A - RTN_QTY_VALID_A - RTN_QTY_NONVALID_A'
         if return_format == 2:
             header = f'\nTop {number_of_items} (QTY):\n\n'
         else:
             header = f'\n<u>Top {number_of_items} (QTY):</u>'
     else:
-        rank_filter = 'SLS_EXT_PRC_A - RTN_EXT_PRC_VALID_A - RTN_EXT_PRC_NONVALID_A'
         if return_format == 2:
             header = f'\nTop {number_of_items} (Sales):\n\n'
         else:
@@ -210,48 +237,27 @@ def create_top_items_report(
     if return_format == 1 or return_format == 2:
         result += header
 
-    if merged:
-        item_filter = f"(IM_ITEM.USR_PROF_ALPHA_16 = ''{binding_id}'')"
-    else:
-        item_filter = '(1=1)'
-    top_items_query = f"""
-        "{creds.SQL.DATABASE}"."dbo"."USP_RPT_SA_BY_X";1
-        'select distinct IM_ITEM.ITEM_NO as GRP_ID, IM_ITEM.DESCR as GRP_DESCR
-        from IM_ITEM
-        where ( {item_filter} )
-        union select distinct VI_PS_TKT_HIST_LIN.ITEM_NO as GRP_ID, NULL as GRP_DESCR
-        from %HISTORY%
-        where not exists(select 1 from IM_ITEM where IM_ITEM.ITEM_NO = VI_PS_TKT_HIST_LIN.ITEM_NO)
-        and ( (1=1) ) and (({category_var})) and %ANYPERIODFILTER%',
-        'select VI_PS_TKT_HIST_LIN.ITEM_NO as GRP_ID, %HISTCOLUMNS%
-        from %HISTORY%
-        where ( (1=1) ) and (({category_var})) and %PERIODFILTER%', '
-        (VI_PS_TKT_HIST.POST_DAT >= ''{beginning_date}'') and (VI_PS_TKT_HIST.POST_DAT <= ''{ending_date}'')', '
-        (1=0) ', ' (1=0) ', {number_of_items}, 0, '{rank_filter}', 2
-        """
-
-    top_items_by_sales = db.query(top_items_query)
+    top_items_by_sales = db.SalesHistory.summarize(
+        'ITEM_NO',
+        beginning_date,
+        ending_date,
+        categ_cod=None if category == 'ALL' else category,
+        binding_id=binding_id if merged else None,
+        order_by='QTY' if mode == 'quantity' else 'REVENUE',
+        limit=number_of_items,
+    )
     counter = 1
-    if top_items_by_sales is not None:
-        for item in top_items_by_sales:
+    if top_items_by_sales:
+        for row in top_items_by_sales:
+            item = (row['GRP_ID'], row['GRP_DESCR'])
+            num_sold = int(row['SLS_QTY'])
+            num_returns = int(row['RTN_QTY'])
             if mode == 'quantity':
                 total = ''
-                num_sold = int(item[4])
-                num_valid_returns = item[7]
-                num_invalid_returns = item[8]
-                num_returns = int(num_valid_returns + num_invalid_returns)
-                current_stock = get_quantity_available(item[0])
             else:
-                revenue = item[2]
-                num_sold = int(item[4])
-                num_valid_returns = item[7]
-                num_invalid_returns = item[8]
-                num_returns = int(num_valid_returns + num_invalid_returns)
-                amt_valid_return = item[9]
-                amt_invalid_return = item[10]
-                return_amount = amt_valid_return + amt_invalid_return
-                total = round(revenue - return_amount, 2)
-                current_stock = get_quantity_available(item[0])
+                total = round(row['REVENUE'], 2)
+            # The item number list (format 3) does not show stock, so skip the lookup there
+            current_stock = get_quantity_available(item[0]) if return_format != 3 else None
             # html version
             if return_format == 1:
                 if mode == 'quantity':
@@ -610,31 +616,14 @@ def get_items_with_no_ecomm_category() -> list[dict]:
 def get_low_stock_items(number_of_items, dates: Dates):
     """Creates a sorted list of items with low stock. Sorted from the greatest revenue generated during a similar
     time period last year."""
-    top_items_query = f"""
-    "{creds.SQL.DATABASE}"."dbo"."USP_RPT_SA_BY_X";1
-    'select distinct IM_ITEM.ITEM_NO as GRP_ID, IM_ITEM.DESCR as GRP_DESCR
-    from IM_ITEM
-    INNER JOIN IM_INV on IM_ITEM.ITEM_NO = IM_INV.ITEM_NO where ( (1=1) )
-    union
-    select distinct VI_PS_TKT_HIST_LIN.ITEM_NO as GRP_ID, NULL as GRP_DESCR
-    from %HISTORY%
-    WHERE NOT EXISTS(select 1 from IM_ITEM where IM_ITEM.ITEM_NO = VI_PS_TKT_HIST_LIN.ITEM_NO) and
-    ((VI_PS_TKT_HIST.STR_ID = ''1'')) and ( (1=1) )
-    and %ANYPERIODFILTER%',
-    'select VI_PS_TKT_HIST_LIN.ITEM_NO as GRP_ID, %HISTCOLUMNS%
-    from %HISTORY%
-    where ( (1=1) ) and %PERIODFILTER%', ' (VI_PS_TKT_HIST.POST_DAT >= ''{dates.one_year_ago}'') and
-    (VI_PS_TKT_HIST.POST_DAT <= ''{dates.last_year_forecast}'')', ' (1=0) ', ' (1=0) ', 500, 0,
-    'SLS_EXT_PRC_A - RTN_EXT_PRC_VALID_A - RTN_EXT_PRC_NONVALID_A', 2
-    """
-    top_items = db.query(top_items_query)
+    top_items = db.SalesHistory.summarize('ITEM_NO', dates.one_year_ago, dates.last_year_forecast, limit=500)
     top_items_list = []
-    if top_items is not None:
+    if top_items:
         for item in top_items:
-            sku = item[0]
-            name = item[1]
-            revenue = round(float(item[2]), 2)
-            units_sold = int(item[4])
+            sku = item['GRP_ID']
+            name = item['GRP_DESCR']
+            revenue = round(float(item['SLS_AMT']), 2)
+            units_sold = int(item['SLS_QTY'])
             top_items_list.append([sku, name, revenue, units_sold])
     else:
         return 'No Top Items'
@@ -856,7 +845,34 @@ def report_generator(
     # Title
     report = f'\n<h1><strong>{title}</strong></h1>\n' f'\n<h3>{datetime.now():%A %B %d, %Y}</h3>'
 
+    # Revenue windows shown by the revenue and year to date sections, fetched in one batch before they render.
+    # Daily and weekly windows are shown with ticket counts.
+    revenue_windows = []
+    ticket_windows = []
     if revenue:
+        # Mondays show Saturday, since the store is closed on Sunday
+        last_open_day = dates.yesterday
+        if datetime.today().isoweekday() == 1:
+            last_open_day = dates.yesterday + relativedelta(days=-1)
+        ticket_windows.append((last_open_day, last_open_day))
+        for x in range(dates.years_to_show):
+            years_ago = relativedelta(years=(x * -1))
+            revenue_windows.append((dates.month_start + years_ago, dates.month_end + years_ago))
+            revenue_windows.append((dates.last_month_start + years_ago, dates.last_month_end + years_ago))
+            revenue_windows.append((dates.month_start + years_ago, dates.today + years_ago))
+            revenue_windows.append((dates.year_start + years_ago, dates.today + years_ago))
+        for x in range(dates.weeks_to_show):
+            weeks_ago = relativedelta(weeks=(x * -1))
+            ticket_windows.append((dates.last_week_start + weeks_ago, dates.last_week_end + weeks_ago))
+    if year_to_date:
+        for x in range(90):
+            day = dates.today + relativedelta(days=(x * -1))
+            ticket_windows.append((day, day))
+    plan = RevenuePlan(windows=revenue_windows + ticket_windows, ticket_windows=ticket_windows)
+    sales_report = functools.partial(revenue_sales_report, plan=plan)
+
+    def revenue_section():
+        report = ''
         section_header = 'Revenue Report'
         report += f'\n<h2><strong>{section_header}</strong></h2>'
         # YESTERDAY TOTAL REVENUE
@@ -865,7 +881,7 @@ def report_generator(
         try:
             if day_of_week > 1:
                 report += "\n<h4><strong>Yesterday's Total Revenue</strong></h4>"
-                report += revenue_sales_report(
+                report += sales_report(
                     start_date=dates.yesterday, stop_date=dates.yesterday, split=False, anna_mode=True
                 )
 
@@ -873,7 +889,7 @@ def report_generator(
             elif day_of_week == 1:
                 saturday = dates.yesterday + relativedelta(days=-1)
                 report += "\n<h4><strong>Saturday's Total Revenue</strong></h4>"
-                report += revenue_sales_report(start_date=saturday, stop_date=saturday, split=False, anna_mode=True)
+                report += sales_report(start_date=saturday, stop_date=saturday, split=False, anna_mode=True)
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
@@ -882,7 +898,7 @@ def report_generator(
             section_header = f'\n<h4><strong>{dates.month_start:%B} Revenue</strong></h4>'
             report += section_header
             for x in range(dates.years_to_show):
-                report += revenue_sales_report(
+                report += sales_report(
                     start_date=dates.month_start + relativedelta(years=(x * -1)),
                     stop_date=dates.month_end + relativedelta(years=(x * -1)),
                     split=False,
@@ -896,7 +912,7 @@ def report_generator(
             section_header = f'\n<h4><strong>{dates.last_month_start:%B} Total Revenue</strong></h4>'
             report += section_header
             for x in range(dates.years_to_show):
-                report += revenue_sales_report(
+                report += sales_report(
                     start_date=dates.last_month_start + relativedelta(years=(x * -1)),
                     stop_date=dates.last_month_end + relativedelta(years=(x * -1)),
                     split=False,
@@ -906,7 +922,7 @@ def report_generator(
             report += f'<p>Error! Message: {err}</p>'
 
         # report += "\n<h4><strong>Last Month Total</strong></h4>"
-        # report += f"\n{revenue_sales_report(last_month_start, last_month_end, split=False, short=True)}"
+        # report += f"\n{sales_report(last_month_start, last_month_end, split=False, short=True)}"
 
         # Add Month-to-Date Revenue Data
         report += '<h4><strong>Month to Date</strong></h4>'
@@ -918,7 +934,7 @@ def report_generator(
                 # Create Dynamic Header
                 report += f'<h5>{dynamic_month_start:%b %y}</h5>'
                 # Get Data from SQL
-                report += f'\n{revenue_sales_report(dynamic_month_start, dynamic_today, split=True)} \n'
+                report += f'\n{sales_report(dynamic_month_start, dynamic_today, split=True)} \n'
 
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
@@ -932,7 +948,7 @@ def report_generator(
                 # Create Dynamic YTD Header
                 report += f'\n<h5>{dynamic_year_start:%x} - {dynamic_today:%x}</h5>'
                 # Get Data
-                report += f'\n{revenue_sales_report(dynamic_year_start, dynamic_today, split=True)}'
+                report += f'\n{sales_report(dynamic_year_start, dynamic_today, split=True)}'
 
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
@@ -941,7 +957,7 @@ def report_generator(
         report += '\n<h4><strong>Weekly Revenue</strong></h4>' '\n<h5>Last Six Weeks</h5>'
         try:
             for x in range(dates.weeks_to_show):
-                report += f'\n{revenue_sales_report(
+                report += f'\n{sales_report(
                     start_date=dates.last_week_start + relativedelta(weeks=(x * -1)),
                     stop_date=dates.last_week_end + relativedelta(weeks=(x * -1)),
                     split=False, anna_mode=True)}'
@@ -949,7 +965,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if cogs_report:
+        return report
+
+    def cogs_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>Cost of Goods Sold Report</strong></h2>'
             f'\n<h5>{dates.last_week_start:{dates.date_format}} - {dates.last_week_end:{dates.date_format}}</h5>'
@@ -963,7 +982,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if sales_rep_report:
+        return report
+
+    def sales_rep_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>Sales Rep Report</strong></h2>'
             f'\n<h5>{dates.last_week_start:{dates.date_format}} - {dates.last_week_end:{dates.date_format}}</h5>'
@@ -975,7 +997,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if wholesale_report:
+        return report
+
+    def wholesale_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>Wholesale Totals</strong></h2>'
             f'\n<h5>{dates.last_week_start:{dates.date_format}} - {dates.last_week_start:{dates.last_week_end}}</h5>'
@@ -997,7 +1022,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if last_week_report:
+        return report
+
+    def last_week_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>Last Week Report</strong></h2>'
             f'\n<h5>{dates.last_week_start:{dates.date_format}} - {dates.last_week_end:{dates.date_format}}</h5>'
@@ -1014,7 +1042,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if mtd_month_report:
+        return report
+
+    def mtd_month_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>Month to Date Report</strong></h2>'
             f'\n<h5>{dates.month_start:{dates.date_format}} - {dates.today:{dates.date_format}}</h5>'
@@ -1029,7 +1060,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if last_year_mtd_report:
+        return report
+
+    def last_year_mtd_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>Last Year Month to Date Report</strong></h2>'
             f'\n<h5>{dates.month_start_last_year:{dates.date_format}} - {dates.one_year_ago:{dates.date_format}}</h5>'
@@ -1048,7 +1082,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if forecasting_report:
+        return report
+
+    def forecasting_report_section():
+        report = ''
         section_header = (
             f'\n<h2><strong>{dates.forecast_days} Days Forecasting Report</strong></h2>'
             f'\n<h5>{dates.one_year_ago:{dates.date_format}} - {dates.last_year_forecast:{dates.date_format}}</h5>'
@@ -1067,7 +1104,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if low_stock_items_report:
+        return report
+
+    def low_stock_items_report_section():
+        report = ''
         number_of_low_stock_items = 100
         section_header = (
             f'\n<h2><strong>Top {number_of_low_stock_items} Revenue Items with Low Stock</strong></h2>'
@@ -1080,7 +1120,10 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if top_items_by_category:
+        return report
+
+    def top_items_by_category_section():
+        report = ''
         section_header = '\n<h2><strong>Last Week Top Items by Top Categories</strong></h2>'
         report += section_header
         category_list = []
@@ -1106,15 +1149,41 @@ def report_generator(
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
 
-    if year_to_date:
+        return report
+
+    def year_to_date_section():
+        report = ''
         try:
             for x in range(90):
-                report += f'\n{revenue_sales_report(
+                report += f'\n{sales_report(
                     start_date=dates.today + relativedelta(days=(x * -1)),
                     stop_date=dates.today + relativedelta(days=(x * -1)),
                     split=False, anna_mode=True)}'
         except Exception as err:
             report += f'<p>Error! Message: {err}</p>'
+        return report
+
+    sections = [
+        (revenue, revenue_section),
+        (cogs_report, cogs_report_section),
+        (sales_rep_report, sales_rep_report_section),
+        (wholesale_report, wholesale_report_section),
+        (last_week_report, last_week_report_section),
+        (mtd_month_report, mtd_month_report_section),
+        (last_year_mtd_report, last_year_mtd_report_section),
+        (forecasting_report, forecasting_report_section),
+        (low_stock_items_report, low_stock_items_report_section),
+        (top_items_by_category, top_items_by_category_section),
+        (year_to_date, year_to_date_section),
+    ]
+
+    if plan.windows:
+        plan.fetch()
+
+    # Sections only read from the database, so they are built side by side and joined in their report order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
+        futures = [executor.submit(section) for enabled, section in sections if enabled]
+        report += ''.join(future.result() for future in futures)
 
     return report
 
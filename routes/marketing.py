@@ -10,7 +10,6 @@ import requests
 from setup.email_engine import Email
 import bleach
 import json
-import pika
 import base64
 import hmac
 import hashlib
@@ -21,6 +20,7 @@ from setup.utilities import EmailAddress, PhoneNumber
 import time
 from qr.qr_codes import QR
 from routes.limiter import limiter
+from routes.publisher import publisher
 
 
 marketing_routes = Blueprint('marketing_routes', __name__, template_folder='routes')
@@ -49,20 +49,7 @@ def marketing_lead_design():
         payload = json.dumps(data)
 
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-
-        channel = connection.channel()
-
-        channel.queue_declare(queue=creds.Consumer.design_lead_form, durable=True)
-
-        channel.basic_publish(
-            exchange='',
-            routing_key=creds.Consumer.design_lead_form,
-            body=payload,
-            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
-        )
-
-        connection.close()
+        publisher.publish(creds.Consumer.design_lead_form, payload)
     except Exception as e:
         LeadFormErrorHandler.error_handler.add_error_v(
             error=f'Error sending design request to RabbitMQ: {e}', origin=API.Route.design, traceback=tb()
@@ -96,16 +83,7 @@ def marketing_lead_design_admin():
         return jsonify({'error': 'Invalid token'}), 401
     data = request.json
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-        channel = connection.channel()
-        channel.queue_declare(queue=creds.Consumer.design_lead_form, durable=True)
-        channel.basic_publish(
-            exchange='',
-            routing_key=creds.Consumer.design_lead_form,
-            body=json.dumps(data),
-            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
-        )
-        connection.close()
+        publisher.publish(creds.Consumer.design_lead_form, json.dumps(data))
     except Exception as e:
         LeadFormErrorHandler.error_handler.add_error_v(
             error=f'Error sending design request to RabbitMQ: {e}', origin=API.Route.design_admin, traceback=tb()
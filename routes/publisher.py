@@ -0,0 +1,23 @@
+from consumers.rabbitmq import RabbitMQPublisher
+from setup import creds
+from setup.utilities import BufferedWriter
+
+queues = [
+    creds.Consumer.orders,
+    creds.Consumer.draft_create,
+    creds.Consumer.draft_update,
+    creds.Consumer.customer_update,
+    creds.Consumer.product_update,
+    creds.Consumer.design_lead_form,
+    creds.Consumer.sync_on_demand,
+    creds.Consumer.restart_services,
+]
+
+publisher = RabbitMQPublisher(
+    queues=queues,
+    host=creds.Consumer.host,
+    size=creds.Consumer.publisher_pool,
+    timeout=creds.Consumer.publisher_timeout,
+)
+
+webhook_archive = BufferedWriter(creds.Consumer.webhook_archive)
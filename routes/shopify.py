@@ -3,35 +3,32 @@ from integration.shopify_api import Shopify
 from integration.customers_api import Customer
 from flask import request, jsonify, Blueprint
 from setup.creds import API
-import pika
-from setup.utilities import verify_webhook, tb, convert_utc_to_local
+from setup.utilities import verify_webhook, tb, convert_utc_to_local, EventDedup
 from setup.error_handler import ProcessInErrorHandler, Logger, OutOfStockErrorHandler
 from setup import creds
 import json
 from shop.models.webhooks import CustomerWebhook
 from routes.limiter import limiter
+from routes.publisher import publisher, webhook_archive
 from product_tools.products import get_preorder_product_ids
+from product_tools.sort_order import SortOrderEngine
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 
-class EventID:
-    """Shopify Event ID class to prevent duplicate processing of webhooks."""
-
-    draft_update = 0
-    draft_create = 0
-    order_create = 0
-    customer_create = 0
-    customer_update = 0
-    product_update = 0
-    variant_out_of_stock = 0
-    collection_update = 0
-
-
 shopify_routes = Blueprint('shopify_routes', __name__, template_folder='routes')
 
 default_rate = creds.API.default_rate
 
+# Event ids of processed webhooks. Shopify retries a delivery until it gets a response, so one event can arrive
+# several times, out of order and across restarts. The store is loaded at server startup or on the first claim.
+webhook_events = EventDedup(
+    window=creds.API.webhook_dedup_window,
+    maxsize=creds.API.webhook_dedup_size,
+    store=Database.Shopify.Webhook.Event,
+    eh=ProcessInErrorHandler,
+)
+
 
 @shopify_routes.route(API.Route.Shopify.order_create, methods=['POST'])
 @limiter.limit(default_rate)
@@ -40,11 +37,6 @@ def orders():
     webhook_data = request.json
     headers = request.headers
 
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.order_create:
-        return jsonify({'success': True}), 200
-    EventID.order_create = event_id
-
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
     if not hmac_header:
@@ -52,34 +44,28 @@ def orders():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='order_create'):
+        return jsonify({'success': True}), 200
 
     if 'refund_line_items' in webhook_data:
         webhook_data['id'] = webhook_data['order_id']
 
-    with open('order_create.json', 'a') as f:
-        json.dump(webhook_data, f)
+    webhook_archive.write_json(webhook_data)
 
     order_id = webhook_data['id']
 
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-        channel = connection.channel()
-
-        channel.queue_declare(queue=creds.Consumer.orders, durable=True)
-
-        channel.basic_publish(
-            exchange='',
-            routing_key=creds.Consumer.orders,
-            body=str(order_id),
-            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
-        )
-        connection.close()
+        publisher.publish(creds.Consumer.orders, str(order_id))
     except Exception as e:
         ProcessInErrorHandler.error_handler.add_error_v(
             error=f'Error sending order {order_id} to RabbitMQ: {e}',
             origin=API.Route.Shopify.order_create,
             traceback=tb(),
         )
+        # Let Shopify retry the delivery
+        webhook_events.release(event_id)
+        return jsonify({'error': 'Internal server error'}), 500
 
     return jsonify({'success': True}), 200
 
@@ -91,11 +77,6 @@ def draft_create():
     webhook_data = request.json
     headers = request.headers
 
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.draft_create:
-        return jsonify({'success': True}), 200
-    EventID.draft_create = event_id
-
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
     print('DRAFT ORDER RECEIVED.')
@@ -104,27 +85,22 @@ def draft_create():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='draft_create'):
+        return jsonify({'success': True}), 200
     order_id = webhook_data['id']
 
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-        channel = connection.channel()
-
-        channel.queue_declare(queue=creds.Consumer.draft_create, durable=True)
-
-        channel.basic_publish(
-            exchange='',
-            routing_key=creds.Consumer.draft_create,
-            body=str(order_id),
-            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
-        )
-        connection.close()
+        publisher.publish(creds.Consumer.draft_create, str(order_id))
     except Exception as e:
         ProcessInErrorHandler.error_handler.add_error_v(
             error=f'Error sending order {order_id} to RabbitMQ: {e}',
             origin=API.Route.Shopify.draft_create,
             traceback=tb(),
         )
+        # Let Shopify retry the delivery
+        webhook_events.release(event_id)
+        return jsonify({'error': 'Internal server error'}), 500
 
     return jsonify({'success': True}), 200
 
@@ -136,11 +112,6 @@ def draft_update():
     webhook_data = request.json
     headers = request.headers
 
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.draft_update:
-        return jsonify({'success': True}), 200
-    EventID.draft_update = event_id
-
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
     if not hmac_header:
@@ -148,27 +119,22 @@ def draft_update():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='draft_update'):
+        return jsonify({'success': True}), 200
     order_id = webhook_data['id']
 
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-        channel = connection.channel()
-
-        channel.queue_declare(queue=creds.Consumer.draft_update, durable=True)
-
-        channel.basic_publish(
-            exchange='',
-            routing_key=creds.Consumer.draft_update,
-            body=str(order_id),
-            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
-        )
-        connection.close()
+        publisher.publish(creds.Consumer.draft_update, str(order_id))
     except Exception as e:
         ProcessInErrorHandler.error_handler.add_error_v(
             error=f'Error sending order {order_id} to RabbitMQ: {e}',
             origin=API.Route.Shopify.draft_update,
             traceback=tb(),
         )
+        # Let Shopify retry the delivery
+        webhook_events.release(event_id)
+        return jsonify({'error': 'Internal server error'}), 500
 
     return jsonify({'success': True}), 200
 
@@ -180,11 +146,6 @@ def customer_create():
     webhook_data = request.json
     headers = request.headers
 
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.customer_create:
-        return jsonify({'success': True}), 200
-    EventID.customer_create = event_id
-
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
 
@@ -193,6 +154,9 @@ def customer_create():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='customer_create'):
+        return jsonify({'success': True}), 200
 
     id = webhook_data['id']
 
@@ -244,10 +208,6 @@ def customer_update():
     headers = request.headers
     webhook_data = request.json
     # print(webhook_data)
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.customer_update:
-        return jsonify({'success': True}), 200
-    EventID.customer_update = event_id
 
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
@@ -256,6 +216,9 @@ def customer_update():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='customer_update'):
+        return jsonify({'success': True}), 200
 
     customer = CustomerWebhook(webhook_data)
     if customer.sms_consent_updated_at:
@@ -283,10 +246,6 @@ def product_update():
     webhook_data = request.json
     headers = request.headers
     logger = Logger(creds.Logs.webhooks_product_update)
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.product_update:
-        return jsonify({'success': True}), 200
-    EventID.product_update = event_id
 
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
@@ -295,182 +254,34 @@ def product_update():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='product_update'):
+        return jsonify({'success': True}), 200
 
-    # Get product data
     product_id = webhook_data['id']
-    title = webhook_data['title']
-    description = webhook_data['body_html']
-    status = webhook_data['status']
-    tags = webhook_data['tags']
-    item_no = Database.Shopify.Product.get_parent_item_no(product_id)
-
-    logger.log(f'Webhook: Product Update, SKU:{item_no}, Product ID: {product_id}, Web Title: {title}')
+    logger.log(f'Webhook: Product Update, Product ID: {product_id}, Web Title: {webhook_data["title"]}')
+
+    # Only the fields the consumer reads. SEO and metafields are fetched fresh when the update is processed.
+    payload = {
+        'id': product_id,
+        'title': webhook_data['title'],
+        'body_html': webhook_data['body_html'],
+        'status': webhook_data['status'],
+        'tags': webhook_data['tags'],
+        'media': webhook_data['media'],
+    }
 
-    if item_no and description:
-        Database.CP.Product.HTMLDescription.update(
-            item_no=item_no, html_descr=description, update_timestamp=False, eh=ProcessInErrorHandler
+    try:
+        publisher.publish(creds.Consumer.product_update, json.dumps(payload))
+    except Exception as e:
+        ProcessInErrorHandler.error_handler.add_error_v(
+            error=f'Error sending product {product_id} to RabbitMQ: {e}',
+            origin=API.Route.Shopify.product_update,
+            traceback=tb(),
         )
-
-    # Get SEO data
-    seo_data = Shopify.Product.SEO.get(product_id)
-    if seo_data:
-        meta_title = seo_data['title']
-        meta_description = seo_data['description']
-    else:
-        meta_title = None
-        meta_description = None
-
-    # Get product Metafields
-    metafields = Shopify.Product.Metafield.get(product_id)
-    features = None
-    botanical_name = None
-    plant_type = None
-    light_requirements = None
-    size = None
-    features = None
-    bloom_season = None
-    bloom_color = None
-    color = None
-    is_featured = None
-    is_in_store_only = None
-    is_preorder_item = None
-    preorder_message = None
-    preorder_release_date = None
-    is_new = None
-    is_back_in_stock = None
-
-    for i in metafields['product_specifications']:
-        if i['key'] == 'botanical_name':
-            botanical_name = i['value']
-
-        if i['key'] == 'plant_type':
-            plant_type = i['value']
-
-        if i['key'] == 'light_requirements':
-            light_requirements = i['value']
-
-        if i['key'] == 'size':
-            size = i['value']
-
-        if i['key'] == 'features':
-            features = i['value']
-
-        if i['key'] == 'bloom_season':
-            bloom_season = i['value']
-
-        if i['key'] == 'bloom_color':
-            bloom_color = i['value']
-
-        if i['key'] == 'color':
-            color = i['value']
-
-    # Product Status Metafields
-    is_featured = {'id': None, 'value': None}
-    is_in_store_only = {'id': None, 'value': None}
-    is_new = {'id': None, 'value': None}
-    is_back_in_stock = {'id': None, 'value': None}
-    is_preorder_item = {'id': None, 'value': None}
-    preorder_release_date = {'id': None, 'value': None}
-    preorder_message = {'id': None, 'value': None}
-    is_on_sale = {'id': None, 'value': None}
-    sale_description = {'id': None, 'value': None}
-
-    for i in metafields['product_status']:
-        if i['key'] == 'featured':  # never null boolean
-            is_featured = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
-
-        if i['key'] == 'in_store_only':  # never null boolean
-            is_in_store_only = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
-
-        if i['key'] == 'new':
-            is_new = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
-
-        if i['key'] == 'back_in_stock':
-            is_back_in_stock = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
-
-        if i['key'] == 'preorder_item':  # never null boolean
-            is_preorder_item = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
-
-        if i['key'] == 'preorder_message':
-            preorder_message = {'id': i['id'], 'value': i['value']}
-
-        if i['key'] == 'preorder_release_date':
-            preorder_release_dt = convert_utc_to_local(datetime.strptime(i['value'], '%Y-%m-%dT%H:%M:%S%z'))
-            preorder_release_date = {'id': i['id'], 'value': preorder_release_dt}
-
-        if i['key'] == 'on_sale':  # never null boolean
-            is_on_sale = {'id': i['id'], 'value': True if i['value'] == 'true' else False}
-
-        if i['key'] == 'on_sale_description':
-            if i['key'] == 'preorder_message':
-                sale_description = {'id': i['id'], 'value': i['value']}
-
-    # Get media data
-    media_payload = []
-    media = webhook_data['media']
-
-    if media:
-        for m in media:
-            id = m['id']
-            position = m['position']
-            alt_text = m['alt']
-            if alt_text and position < 4:  # First 4 images only at this time.
-                media_payload.append({'position': position, 'id': id, 'alt_text': alt_text})
-
-    if item_no:
-        update_payload = {'product_id': product_id, 'item_no': item_no}
-
-        if status:
-            update_payload['status'] = status
-        if title:
-            update_payload['title'] = title
-        if meta_title:
-            update_payload['meta_title'] = meta_title
-        if meta_description:
-            update_payload['meta_description'] = meta_description
-
-        if tags:
-            update_payload['tags'] = tags
-
-        if botanical_name:
-            update_payload['botanical_name'] = botanical_name
-        if plant_type:
-            update_payload['plant_type'] = plant_type
-        if light_requirements:
-            update_payload['light_requirements'] = light_requirements
-        if size:
-            update_payload['size'] = size
-        if features:
-            update_payload['features'] = features
-        if bloom_season:
-            update_payload['bloom_season'] = bloom_season
-        if bloom_color:
-            update_payload['bloom_color'] = bloom_color
-        if color:
-            update_payload['color'] = color
-        # Product Status
-        update_payload['is_featured'] = is_featured
-        update_payload['is_in_store_only'] = is_in_store_only
-        update_payload['is_preorder_item'] = is_preorder_item
-        update_payload['preorder_message'] = preorder_message
-        update_payload['preorder_release_date'] = preorder_release_date
-        update_payload['is_new'] = is_new
-        update_payload['is_back_in_stock'] = is_back_in_stock
-        update_payload['is_on_sale'] = is_on_sale
-        update_payload['sale_description'] = sale_description
-
-        if media_payload:
-            for m in media_payload:
-                position = m['position']
-                update_payload[f'alt_text_{position}'] = m['alt_text']
-        try:
-            Database.CP.Product.update(update_payload, eh=ProcessInErrorHandler)
-        except Exception as e:
-            ProcessInErrorHandler.error_handler.add_error_v(
-                error=f'Error updating product {item_no}: {e}',
-                origin=API.Route.Shopify.product_update,
-                traceback=tb(),
-            )
+        # Let Shopify retry the delivery
+        webhook_events.release(event_id)
+        return jsonify({'error': 'Internal server error'}), 500
 
     return jsonify({'success': True}), 200
 
@@ -482,10 +293,6 @@ def collection_update():
 
     webhook_data = request.json
     headers = request.headers
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.collection_update:
-        return jsonify({'success': True}), 200
-    EventID.collection_update = event_id
 
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
@@ -494,6 +301,9 @@ def collection_update():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='collection_update'):
+        return jsonify({'success': True}), 200
 
     return jsonify({'success': True}), 200
 
@@ -505,10 +315,6 @@ def variant_out_of_stock():
 
     webhook_data = request.json
     headers = request.headers
-    event_id = headers.get('X-Shopify-Event-Id')
-    if event_id == EventID.variant_out_of_stock:
-        return jsonify({'success': True}), 200
-    EventID.variant_out_of_stock = event_id
 
     data = request.get_data()
     hmac_header = headers.get('X-Shopify-Hmac-Sha256')
@@ -517,6 +323,9 @@ def variant_out_of_stock():
     verified = verify_webhook(data, hmac_header)
     if not verified:
         return jsonify({'error': 'Unauthorized'}), 401
+    event_id = headers.get('X-Shopify-Event-Id')
+    if not webhook_events.claim(event_id, topic='variant_out_of_stock'):
+        return jsonify({'success': True}), 200
 
     OutOfStockErrorHandler.logger.info(f'Variant Out of Stock: {webhook_data}')
     product_id = int(webhook_data['product_id'])
@@ -530,8 +339,11 @@ def variant_out_of_stock():
         if shopify_product['totalInventory'] < 1:
             collections = Shopify.Product.get_collection_ids(product_id=product_id)
             for collection in collections:
-                Shopify.Collection.move_to_bottom(
-                    collection_id=collection, product_id_list=[product_id], eh=OutOfStockErrorHandler
+                # Rank against the current order so only this product moves, below the in stock items
+                current = Shopify.Collection.get_manual_order(collection)
+                target = SortOrderEngine.rank(current=current, ranked=current, in_stock={product_id: False})
+                Shopify.Collection.apply_order(
+                    collection_id=collection, target=target, current=current, eh=OutOfStockErrorHandler
                 )
     except Exception as e:
         OutOfStockErrorHandler.error_handler.add_error_v(
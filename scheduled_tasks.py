@@ -7,14 +7,15 @@ from product_tools import stock_buffer
 from customer_tools import stock_notification
 from customer_tools.merge import Merge
 from setup.email_engine import Email
+from database import Database
 from setup import creds, date_presets, network, utilities
 from sms import sms_automations, sms_messages, sms_queries
 from setup import backups
 from setup.error_handler import ScheduledTasksErrorHandler
 from setup.sms_engine import SMSEngine
-import time
+from concurrent.futures import wait
 from traceback import format_exc as tb
-from setup.utilities import timer
+from setup.utilities import timer, CronScheduler
 import sys
 
 
@@ -26,302 +27,199 @@ class ScheduledTasks:
         self.error_handler = self.eh.error_handler
         self.logger = self.eh.logger
         self.verbose = False
+        self.scheduler = CronScheduler(
+            ledger_file=creds.Integrator.task_ledger, max_workers=creds.Integrator.task_workers, eh=self.eh
+        )
+        self.schedule()
 
-    def generate_reports(self):
-        """Generate and send reports to staff"""
-        # ADMINISTRATIVE REPORT - for administrative team and management
-        admin_report = creds.Reports.Administrative
-        if admin_report.enabled:
-            if admin_report.hour == self.dates.hour and admin_report.minute == self.dates.minute:
-                try:
-                    Email.Staff.AdminReport.send(recipients=admin_report.recipients)
-                except Exception as err:
-                    self.error_handler.add_error_v(error=err, origin='Administrative Report')
+    def task(self, origin, func, *args, **kwargs):
+        """Returns a job that runs func and logs its errors under origin"""
 
-        # ITEMS REPORT - for product management team
-        item_report = creds.Reports.Item
-        if item_report.enabled:
-            if item_report.hour == self.dates.hour and item_report.minute == self.dates.minute:
-                try:
-                    Email.Staff.ItemReport.send(recipients=item_report.recipients)
-                except Exception as err:
-                    self.error_handler.add_error_v(error=err, origin='Item Report')
-
-        # LOW STOCK REPORT - for product management team
-        low_stock_report = creds.Reports.LowStock
-        if low_stock_report.enabled:
-            if low_stock_report.hour == self.dates.hour and low_stock_report.minute == self.dates.minute:
-                try:
-                    Email.Staff.LowStockReport.send(recipients=low_stock_report.recipients)
-                except Exception as err:
-                    self.error_handler.add_error_v(error=err, origin='Low Stock Report')
-
-            # MARKETING LEAD NOTIFICATION EMAIL - for Sales team
-            design_leads = creds.Reports.MarketingLeads
-            if design_leads.enabled:
-                if design_leads.hour == self.dates.hour and design_leads.minute == self.dates.minute:
-                    try:
-                        Email.Staff.DesignLeadNotification.send(recipients=design_leads.recipients)
-                    except Exception as err:
-                        self.error_handler.add_error_v(error=err, origin='Lead Notification Email')
-
-    def twice_per_hour_tasks(self):
-        if self.dates.minute == 0 or self.dates.minute == 30:
-            # NETWORK CONNECTIVITY - Check server for internet connection. Restart if not connected.
-            network.restart_server_if_disconnected()
-
-            # Checks health of Web App API. Notifies system administrator if not running via SMS text.
-            try:
-                network.health_check()
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Health Check')
-
-            # SET CONTACT 1
-            # Concatenate First and Last name of non-business customer_tools and
-            # fill contact 1 field in counterpoint (if null)
-            try:
-                customers.set_contact_1()
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Set Contact 1')
-
-            # TIERED WHOLESALE PRICING LEVELS
-            # Reassessing tiered pricing for all customers based on current year
-            try:
-                tiered_pricing.reassess_tiered_pricing(
-                    start_date=date_presets.one_year_ago, end_date=date_presets.today, demote=False
-                )
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Tiered Pricing')
-
-    def every_other_hourly_tasks(self):
-        # Between 6 AM and 8 PM - Performed on even hours
-        if self.dates.minute == 0 and 20 >= self.dates.hour >= 6 and self.dates.hour % 2 == 0:
-            # ITEM STATUS CODES
-            # Move active product_tools with zero stock into inactive status
-            # unless they are on order, hold, quote
+        def job():
             try:
-                set_inactive_status.set_products_to_inactive(eh=self.eh)
+                func(*args, **kwargs)
             except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Inactive Status')
+                self.error_handler.add_error_v(error=err, origin=origin)
 
-            # BRANDS
-            # Set all items with no brand to the company brand
-            # Set all products with specific keywords to correct e-commerce brand
-            try:
-                brands.update_brands()
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Brands')
+        return job
 
-            # STOCK BUFFER
-            # Set stock buffers based on rules by vendor, category
-            try:
-                stock_buffer.stock_buffer_updates()
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Stock Buffer')
-
-    def once_per_day_tasks(self):
-        if self.dates.hour == 5 and self.dates.minute == 0:  # 5 AM
-            try:
-                customers.fix_first_and_last_sale_dates(dt=self.dates)
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Fix First and Last Sale Dates')
-
-        if self.dates.hour == 11 and self.dates.minute == 30:  # 11:30 AM
-            # STOCK NOTIFICATION EMAIL WITH COUPON GENERATION
-            # Read CSV file, check all items for stock, send auto generated emails to customer_tools
-            # with product photo, product description (if exists), coupon (if applicable), and
-            # direct purchase links. Generate coupon and send to big for e-comm use.
-            try:
-                stock_notification.send_stock_notifications()
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Stock Notification Email')
-
-        if self.dates.hour == 22 and self.dates.minute == 30:  # 10:30 PM
-            # Nightly Off-Site Backups
-            # Will copy selected files to off-site location
-            try:
-                backups.offsite_backups()
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Offsite Backups')
-
-            # MERGE CUSTOMERS
-            # Merge duplicate customers by email or phone. Skips customers with open orders.
-            try:
-                Merge(eh=self.eh)
-            except Exception as err:
-                self.error_handler.add_error_v(error=err, origin='Merge Customers')
-
-            # Delete Old Log Files
-            utilities.delete_old_files()
+    def refresh_dates(self):
+        self.dates = date_presets.Dates()
 
-    def sms_automations(self):
+    def schedule(self):
+        """Registers every enabled task with the scheduler. Cron specs are minute hour day month weekday."""
+        add = self.scheduler.add
+        grace = creds.Integrator.task_grace
+
+        # REPORTS - for administrative team, management, product management team and sales team
+        reports = [
+            ('Administrative Report', creds.Reports.Administrative, Email.Staff.AdminReport),
+            ('Item Report', creds.Reports.Item, Email.Staff.ItemReport),
+            ('Low Stock Report', creds.Reports.LowStock, Email.Staff.LowStockReport),
+            ('Lead Notification Email', creds.Reports.MarketingLeads, Email.Staff.DesignLeadNotification),
+        ]
+        for origin, report, email in reports:
+            if report.enabled:
+                job = self.task(origin, email.send, recipients=report.recipients)
+                add(origin, f'{report.minute} {report.hour} * * *', job, grace=grace)
+
+        # TWICE PER HOUR
+        # NETWORK CONNECTIVITY - Check server for internet connection. Restart if not connected.
+        add('Network', '0,30 * * * *', self.task('Network', network.restart_server_if_disconnected))
+        # Checks health of Web App API. Notifies system administrator if not running via SMS text.
+        add('Health Check', '0,30 * * * *', self.task('Health Check', network.health_check))
+        # SET CONTACT 1
+        # Concatenate First and Last name of non-business customer_tools and
+        # fill contact 1 field in counterpoint (if null)
+        add('Set Contact 1', '0,30 * * * *', self.task('Set Contact 1', customers.set_contact_1))
+        # TIERED WHOLESALE PRICING LEVELS
+        # Reassessing tiered pricing for all customers based on current year
+        add('Tiered Pricing', '0,30 * * * *', self.task('Tiered Pricing', self.reassess_tiered_pricing))
+
+        # HOURLY
+        # SALES HISTORY
+        # Re-aggregate recent posted tickets into the sales history table read by reports. This task is the only
+        # writer of the table. Builds it from all ticket history on the first run.
+        job = self.task('Sales History', Database.SalesHistory.refresh, build=True, eh=self.eh)
+        add('Sales History', '45 * * * *', job)
+
+        # EVERY OTHER HOUR - Between 6 AM and 8 PM, on even hours
+        # ITEM STATUS CODES
+        # Move active product_tools with zero stock into inactive status
+        # unless they are on order, hold, quote
+        job = self.task('Inactive Status', set_inactive_status.set_products_to_inactive, eh=self.eh)
+        add('Inactive Status', '0 6-20/2 * * *', job)
+        # BRANDS
+        # Set all items with no brand to the company brand
+        # Set all products with specific keywords to correct e-commerce brand
+        add('Brands', '0 6-20/2 * * *', self.task('Brands', brands.update_brands))
+        # STOCK BUFFER
+        # Set stock buffers based on rules by vendor, category
+        add('Stock Buffer', '0 6-20/2 * * *', self.task('Stock Buffer', stock_buffer.stock_buffer_updates))
+
+        # ONCE PER DAY
+        # FIRST AND LAST SALE DATES (5 AM)
+        job = self.task('Fix First and Last Sale Dates', self.fix_first_and_last_sale_dates)
+        add('Fix First and Last Sale Dates', '0 5 * * *', job)
+        # STOCK NOTIFICATION EMAIL WITH COUPON GENERATION (11:30 AM)
+        # Read CSV file, check all items for stock, send auto generated emails to customer_tools
+        # with product photo, product description (if exists), coupon (if applicable), and
+        # direct purchase links. Generate coupon and send to big for e-comm use.
+        job = self.task('Stock Notification Email', stock_notification.send_stock_notifications)
+        add('Stock Notification Email', '30 11 * * *', job, grace=grace)
+        # NIGHTLY (10:30 PM) - A missed run is only caught up overnight, never during business hours
+        night_grace = creds.Integrator.task_night_grace
+        # Nightly Off-Site Backups
+        # Will copy selected files to off-site location
+        job = self.task('Offsite Backups', backups.offsite_backups)
+        add('Offsite Backups', '30 22 * * *', job, grace=night_grace)
+        # MERGE CUSTOMERS
+        # Merge duplicate customers by email or phone. Skips customers with open orders.
+        add('Merge Customers', '30 22 * * *', self.task('Merge Customers', Merge, eh=self.eh), grace=night_grace)
+        # Delete Old Log Files
+        job = self.task('Delete Old Files', utilities.delete_old_files)
+        add('Delete Old Files', '30 22 * * *', job, grace=night_grace)
+
+        # SMS AUTOMATIONS
         sms = creds.SMSAutomations
-        origin = 'Automations'
-
         if not sms.enabled:
             self.logger.warn('SMS Automations are disabled.')
-        else:
-            messages = sms_messages.SMSMessages(self.dates)
-            birthday_queries = sms_queries.BirthdayQueries(self.dates)
-            wholesale_queries = sms_queries.WholesaleQueries(self.dates)
-            ftc_queries = sms_queries.FTCQueries(self.dates)
-            rc_queries = sms_queries.RCQueries(self.dates)
-
+            return
+
+        campaigns = sms.Campaigns
+        for campaign in [
+            campaigns.Birthday,
+            campaigns.Wholesale1,
+            campaigns.FTC1,
+            campaigns.FTC2,
+            campaigns.FTC3,
+            campaigns.RC1,
+            campaigns.RC2,
+            campaigns.RC3,
+        ]:
+            if campaign.enabled:
+                day = campaign.day if campaign is campaigns.Birthday else '*'
+                job = self.task(campaign.title, self.send_sms_campaign, campaign)
+                add(campaign.title, f'{campaign.minute} {campaign.hour} {day} * *', job, grace=grace)
+
+    def reassess_tiered_pricing(self):
+        tiered_pricing.reassess_tiered_pricing(
+            start_date=self.dates.one_year_ago, end_date=self.dates.today, demote=False
+        )
+
+    def fix_first_and_last_sale_dates(self):
+        customers.fix_first_and_last_sale_dates(dt=self.dates)
+
+    def send_sms_campaign(self, campaign):
+        """Sends one SMS automation campaign using queries built from the current dates"""
+        campaigns = creds.SMSAutomations.Campaigns
+        messages = sms_messages.SMSMessages(self.dates)
+        birthday_queries = sms_queries.BirthdayQueries(self.dates)
+        wholesale_queries = sms_queries.WholesaleQueries(self.dates)
+        ftc_queries = sms_queries.FTCQueries(self.dates)
+        rc_queries = sms_queries.RCQueries(self.dates)
+
+        texts = {
             #############################################################################################
             #################################### BIRTHDAY CUSTOMER AUTOMATIONS ##########################
             #############################################################################################
-
-            birthday_1 = sms.Campaigns.Birthday
-            if birthday_1.enabled:
-                if self.dates.day == birthday_1.day:
-                    if self.dates.hour == birthday_1.hour and self.dates.minute == birthday_1.minute:
-                        self.logger.info(f'SMS/MMS Automation: {birthday_1.title} - {datetime.now():%H:%M:%S}')
-                        try:
-                            sms_automations.create_customer_text(
-                                origin=origin,
-                                campaign=birthday_1.title,
-                                query=birthday_queries.text_1,
-                                msg=messages.birthday.coupon_1,
-                                image_url=creds.Coupon.birthday,
-                                send_rwd_bal=False,
-                            )
-
-                        except Exception as err:
-                            self.error_handler.add_error_v(error=err, origin=birthday_1.title)
-
+            campaigns.Birthday: {
+                'query': birthday_queries.text_1,
+                'msg': messages.birthday.coupon_1,
+                'image_url': creds.Coupon.birthday,
+                'send_rwd_bal': False,
+            },
             #############################################################################################
             ############################### Wholesale Customer Automations ##############################
             #############################################################################################
-
-            wholesale_1 = sms.Campaigns.Wholesale1
-            if wholesale_1.enabled:
-                if self.dates.hour == wholesale_1.hour and self.dates.minute == wholesale_1.minute:
-                    self.logger.info(f'SMS/MMS Automation: {wholesale_1.title} - {datetime.now():%H:%M:%S}')
-                    try:
-                        sms_automations.create_customer_text(
-                            origin=origin,
-                            campaign=wholesale_1.title,
-                            query=wholesale_queries.text_1,
-                            msg=messages.wholesale.message_1,
-                            msg_prefix=True,
-                            send_rwd_bal=False,
-                        )
-                    except Exception as err:
-                        self.error_handler.add_error_v(error=err, origin=wholesale_1.title)
-
+            campaigns.Wholesale1: {
+                'query': wholesale_queries.text_1,
+                'msg': messages.wholesale.message_1,
+                'msg_prefix': True,
+                'send_rwd_bal': False,
+            },
             #############################################################################################
             ############################## First-Time Customer Automations ##############################
             #############################################################################################
-
             # FIRST-TIME CUSTOMER TEXT MESSAGE 1 - WELCOME (SMS)
-            ftc1 = creds.SMSAutomations.Campaigns.FTC1
-            if ftc1.enabled:
-                if self.dates.hour == ftc1.hour and self.dates.minute == ftc1.minute:
-                    self.logger.info(f'SMS/MMS Automation: {ftc1.title} - {datetime.now():%H:%M:%S}')
-                    try:
-                        sms_automations.create_customer_text(
-                            origin=origin,
-                            campaign=ftc1.title,
-                            query=ftc_queries.text_1,
-                            msg=messages.ftc.ftc_1_body,
-                            send_rwd_bal=True,
-                        )
-                    except Exception as err:
-                        self.error_handler.add_error_v(error=err, origin=ftc1.title)
-
-            ftc2 = creds.SMSAutomations.Campaigns.FTC2
-            if ftc2.enabled:
-                if self.dates.hour == ftc2.hour and self.dates.minute == ftc2.minute:
-                    # FIRST-TIME CUSTOMER TEXT MESSAGE 2 - 5 OFF COUPON (MMS)
-                    self.logger.info(f'SMS/MMS Automation: {ftc2.title} - {datetime.now():%H:%M:%S}')
-                    try:
-                        sms_automations.create_customer_text(
-                            origin=origin,
-                            campaign=ftc2.title,
-                            query=ftc_queries.text_2,
-                            msg=messages.ftc.ftc_2_body,
-                            image_url=creds.Coupon.five_off,
-                            send_rwd_bal=True,
-                        )
-                    except Exception as err:
-                        self.error_handler.add_error_v(error=err, origin=ftc2.title)
-
+            campaigns.FTC1: {'query': ftc_queries.text_1, 'msg': messages.ftc.ftc_1_body, 'send_rwd_bal': True},
+            # FIRST-TIME CUSTOMER TEXT MESSAGE 2 - 5 OFF COUPON (MMS)
+            campaigns.FTC2: {
+                'query': ftc_queries.text_2,
+                'msg': messages.ftc.ftc_2_body,
+                'image_url': creds.Coupon.five_off,
+                'send_rwd_bal': True,
+            },
             # FIRST-TIME CUSTOMER TEXT MESSAGE 3 - ASK FOR GOOGLE REVIEW (SMS)
-
-            ftc3 = creds.SMSAutomations.Campaigns.FTC3
-            if ftc3.enabled:
-                if self.dates.hour == ftc3.hour and self.dates.minute == ftc3.minute:
-                    self.logger.info(f'SMS/MMS Automation: {ftc3.title} - {datetime.now():%H:%M:%S}')
-
-                    try:
-                        sms_automations.create_customer_text(
-                            origin=origin,
-                            campaign=ftc3.title,
-                            query=ftc_queries.text_3,
-                            msg=messages.ftc.ftc_3_body,
-                            send_rwd_bal=True,
-                        )
-                    except Exception as err:
-                        self.error_handler.add_error_v(error=err, origin=ftc3.title)
-
+            campaigns.FTC3: {'query': ftc_queries.text_3, 'msg': messages.ftc.ftc_3_body, 'send_rwd_bal': True},
             #############################################################################################
             ############################## Returning Customer Automations ###############################
             #############################################################################################
-
             # RETURNING CUSTOMER TEXT MESSAGE 1 - THANK YOU (SMS)
-            rc1 = sms.Campaigns.RC1
-            if rc1.enabled:
-                if self.dates.hour == rc1.hour and self.dates.minute == rc1.minute:
-                    self.logger.info(f'SMS/MMS Automation: {rc1.title} - {datetime.now():%H:%M:%S}')
-                    try:
-                        sms_automations.create_customer_text(
-                            origin=origin,
-                            campaign=rc1.title,
-                            query=rc_queries.text_1,
-                            msg=messages.rc.rc_1_body,
-                            send_rwd_bal=True,
-                        )
-                    except Exception as err:
-                        self.error_handler.add_error_v(error=err, origin=rc1.title)
-
+            campaigns.RC1: {'query': rc_queries.text_1, 'msg': messages.rc.rc_1_body, 'send_rwd_bal': True},
             # RETURNING CUSTOMER TEXT MESSAGE 2 - 5 OFF COUPON (MMS)
-            rc2 = sms.Campaigns.RC2
-            if rc2.enabled and self.dates.hour == rc2.hour and self.dates.minute == rc2.minute:
-                self.logger.info(f'SMS/MMS Automation: {rc2.title} - {datetime.now():%H:%M:%S}')
-                try:
-                    sms_automations.create_customer_text(
-                        origin=origin,
-                        campaign=rc2.title,
-                        query=rc_queries.text_2,
-                        msg=messages.rc.rc_2_body,
-                        image_url=creds.Coupon.five_off,
-                        send_rwd_bal=True,
-                    )
-                except Exception as err:
-                    self.error_handler.add_error_v(error=err, origin=rc2.title)
-
+            campaigns.RC2: {
+                'query': rc_queries.text_2,
+                'msg': messages.rc.rc_2_body,
+                'image_url': creds.Coupon.five_off,
+                'send_rwd_bal': True,
+            },
             # RETURNING CUSTOMER TEXT MESSAGE 3 - ASK FOR GOOGLE REVIEW (SMS)
-            rc3 = sms.Campaigns.RC3
-            if rc3.enabled and self.dates.hour == rc3.hour and self.dates.minute == rc3.minute:
-                self.logger.info(f'SMS/MMS Automation: {rc3.title} - {datetime.now():%H:%M:%S}')
-                try:
-                    sms_automations.create_customer_text(
-                        origin=origin,
-                        campaign=rc3.title,
-                        query=rc_queries.text_3,
-                        msg=messages.rc.rc_3_body,
-                        send_rwd_bal=True,
-                    )
-                except Exception as err:
-                    self.error_handler.add_error_v(error=err, origin=rc3.title)
+            campaigns.RC3: {'query': rc_queries.text_3, 'msg': messages.rc.rc_3_body, 'send_rwd_bal': True},
+        }
+
+        self.logger.info(f'SMS/MMS Automation: {campaign.title} - {datetime.now():%H:%M:%S}')
+        sms_automations.create_customer_text(origin='Automations', campaign=campaign.title, **texts[campaign])
 
     @timer
     def run(self):
-        self.generate_reports()
-        self.twice_per_hour_tasks()
-        self.every_other_hourly_tasks()
-        self.once_per_day_tasks()
-        self.sms_automations()
+        """Runs every task that is due now, or was missed since its last run, and waits for them to finish"""
+        wait(self.scheduler.tick())
+
+    def run_forever(self):
+        """Runs tasks at the start of every minute. Long tasks run in the background while others start."""
+        self.logger.info(f'Scheduled Tasks: Starting at {datetime.now():%H:%M:%S}{self.scheduler}')
+        self.scheduler.run(before_tick=self.refresh_dates)
 
 
 if __name__ == '__main__':
@@ -329,17 +227,13 @@ if __name__ == '__main__':
     if len(sys.argv) > 1:
         if '-v' in sys.argv:
             tasks.verbose = True
-        if '-l' in sys.argv:  # Run the integrator in a loop
-            while True:
-                try:
-                    tasks = ScheduledTasks()  # Reinitialize to reset dates
-                    tasks.run(eh=tasks.eh, operation='Scheduled Tasks')
-                except KeyboardInterrupt:
-                    tasks.logger.info(f'Process Terminated by User at {datetime.now():%H:%M:%S}')
-                except Exception as err:
-                    tasks.error_handler.add_error_v(error=err, origin='Scheduled Tasks', traceback=tb())
-                finally:
-                    time.sleep(60)
+        if '-l' in sys.argv:  # Run the scheduled tasks in a loop
+            try:
+                tasks.run_forever()
+            except KeyboardInterrupt:
+                tasks.logger.info(f'Process Terminated by User at {datetime.now():%H:%M:%S}')
+            except Exception as err:
+                tasks.error_handler.add_error_v(error=err, origin='Scheduled Tasks', traceback=tb())
 
     else:
         tasks.run(eh=tasks.eh, operation=tasks.module)
@@ -20,6 +20,7 @@ from routes import marketing
 from routes import inventory
 from routes import sms
 from routes.limiter import limiter
+from routes.publisher import publisher
 
 app = flask.Flask(__name__)
 
@@ -111,6 +112,15 @@ if __name__ == '__main__':
         app.run(debug=False, port=API.port)
 
     else:
+        try:
+            # Open the publishing connection and declare the queues before taking webhooks
+            publisher.start()
+        except Exception as e:
+            ProcessInErrorHandler.error_handler.add_error_v(
+                error=f'Error connecting to RabbitMQ: {e}', origin='server', traceback=tb()
+            )
+        # Load recent webhook event ids. Failures are logged and retried on later webhooks.
+        shopify.webhook_events.start()
         running = True
         while running:
             try:
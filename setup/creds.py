@@ -35,6 +35,8 @@ class API:
 
     port: int = Config.api['port']
     default_rate: int = '100/second'
+    webhook_dedup_window: int = Config.api.get('webhook_dedup_window', 172800)  # Seconds. Shopify retries for 48h
+    webhook_dedup_size: int = Config.api.get('webhook_dedup_size', 100000)  # Event ids kept in memory
 
     class Route:
         """API Routes"""
@@ -84,12 +86,20 @@ class Integrator:
     authors = Config.integrator['authors']
     version = Config.integrator['version']
     max_workers: int = Config.integrator['max_workers']  # Thread Pool
+    bulk_threshold: int = Config.integrator.get('bulk_threshold', 500)  # Queue size that switches to bulk mutations
+    change_tracking: bool = Config.integrator.get('change_tracking', False)  # Use SQL Server Change Tracking queues
     day_start: int = Config.integrator['day_start']
     day_end: int = Config.integrator['day_end']
     int_day_run_interval: int = Config.integrator['integrator_day_run_interval']  # Minutes
     int_night_run_interval = Config.integrator['integrator_night_run_interval']  # Minutes
     inv_day_run_interval: int = Config.integrator['inventory_day_run_interval']  # Seconds
     inv_night_run_interval: int = Config.integrator['inventory_night_run_interval']  # Seconds
+    inv_min_run_interval: int = Config.integrator.get('inventory_min_run_interval', 2)  # Seconds, while busy
+    inv_upload_interval: int = Config.integrator.get('inventory_upload_interval', 600)  # Seconds between CSV uploads
+    task_workers: int = Config.integrator.get('task_workers', 4)  # Scheduled tasks that may run at once
+    task_grace: int = Config.integrator.get('task_grace', 7200)  # Seconds a missed report or text is still sent
+    task_night_grace: int = Config.integrator.get('task_night_grace', 27000)  # Nightly jobs catch up until 6 AM
+    task_ledger: str = Config.integrator.get('task_ledger', './scheduled_tasks_ledger.json')  # Last runs
     promotion_sync: bool = Config.integrator['promotion_sync']
     customer_sync: bool = Config.integrator['customer_sync']
     subscriber_sync: bool = Config.integrator['subscriber_sync']
@@ -110,6 +120,14 @@ class SQL:
     PORT: int = Config.sql['port']
     USERNAME: str = Config.sql['db_username']
     PASSWORD: str = Config.sql['db_password']
+    POOL_SIZE: int = Config.sql.get('pool_size', Integrator.max_workers + 4)  # Max open connections
+    POOL_TIMEOUT: int = Config.sql.get('pool_timeout', 30)  # Seconds to wait for a free connection
+    POOL_MAX_LIFETIME: int = Config.sql.get('pool_max_lifetime', 1800)  # Seconds before a connection is recycled
+    POOL_HEALTH_CHECK: int = Config.sql.get('pool_health_check', 60)  # Idle seconds before a connection is pinged
+    ID_CACHE_SIZE: int = Config.sql.get('id_cache_size', 20000)  # Cached middleware ID lookups
+    ID_CACHE_TTL: int = Config.sql.get('id_cache_ttl', 300)  # Seconds before a cached ID lookup is reloaded
+    SALES_HISTORY_START: str = Config.sql.get('sales_history_start', '2020-01-01')  # First day of the sales cube
+    SALES_HISTORY_LOOKBACK: int = Config.sql.get('sales_history_lookback', 3)  # Days re-aggregated on each refresh
 
 
 # Company
@@ -274,6 +292,9 @@ class Table:
         discounts_view = Config.site['tables']['discounts_view']
         metafields = Config.site['tables']['metafields']
         webhooks = Config.site['tables']['webhooks']
+        product_fingerprints = Config.site['tables'].get('product_fingerprints', 'SN_SHOP_PROD_HASH')
+        sales_history = Config.site['tables'].get('sales_history', 'SN_SALES_HIST')
+        webhook_events = Config.site['tables'].get('webhook_events', 'SN_SHOP_WEBHOOK_EVT')
 
 
 class Twilio:
@@ -297,6 +318,9 @@ class Shopify:
     admin_token = Config.site['token']
     secret_key = Config.site['secret_key']
     location_1387 = Config.site['locations']['1387']
+    # GraphQL cost bucket. Initial values only - refreshed from extensions.cost.throttleStatus on every response.
+    bucket_size = Config.site.get('bucket_size', 1000)
+    restore_rate = Config.site.get('restore_rate', 50)
 
     class SalesChannel:
         online_store = Config.site['channels']['online_store']
@@ -361,6 +385,11 @@ class Consumer:
     design_lead_form = Config.consumers['design_info']
     sync_on_demand = Config.consumers['sync_on_demand']
     restart_services = Config.consumers['restart_services']
+    host: str = Config.consumers.get('host', 'localhost')
+    publisher_pool: int = Config.consumers.get('publisher_pool', 8)  # Publishing connections, one per server thread
+    publisher_timeout: int = Config.consumers.get('publisher_timeout', 5)  # Seconds to wait for a connection
+    webhook_archive: str = Config.consumers.get('webhook_archive', 'order_create.json')  # Raw order payloads
+    product_update_window: int = Config.consumers.get('product_update_window', 10)  # Seconds to coalesce
 
 
 class BatchFiles:
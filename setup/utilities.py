@@ -12,9 +12,13 @@ import pytz
 from traceback import format_exc as tb
 import secrets
 import string
-from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import threading
 import hmac
+import queue
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
 
 
 def is_after_hours() -> bool:
@@ -180,24 +184,712 @@ def get_product_images(eh=ProcessOutErrorHandler, verbose=False):
     if verbose:
         eh.logger.info('Getting product images.')
 
-    product_images = []
+    product_images = [[name, entry['size']] for name, entry in ImageIndex.scan().items()]
 
-    def task(filename):
-        if filename not in ['Thumbs.db', 'desktop.ini', '.DS_Store']:
-            # filter out trailing filenames
-            if '^' in filename:
-                if filename.split('.')[0].split('^')[1].isdigit():
-                    product_images.append([filename, os.path.getsize(f'{creds.Company.product_images}/{filename}')])
-            else:
-                product_images.append([filename, os.path.getsize(f'{creds.Company.product_images}/{filename}')])
-
-    with ThreadPoolExecutor(max_workers=creds.Integrator.max_workers) as executor:
-        executor.map(task, os.listdir(creds.Company.product_images))
     if verbose:
         eh.logger.info(f'Found {len(product_images)} images.')
     return product_images
 
 
+class ImageIndex:
+    """Persistent index of the product image folder keyed by filename with size, mtime and content hash.
+
+    refresh() makes a single os.scandir pass and compares it with the last saved index. Only new files and
+    files whose size or mtime moved are hashed. Call save() once the changes have been processed so a failed
+    cycle picks them up again next time."""
+
+    file = './integration/image_index.json'
+    ignore = ['Thumbs.db', 'desktop.ini', '.DS_Store']
+    lock = threading.Lock()
+    entries: dict[str, dict] = None  # Last saved index
+    pending: dict[str, dict] = None  # Result of the last refresh, written by save()
+    current: dict[str, dict] = None  # Result of the last scan
+    scanned_at: float = 0
+    max_age = 60  # Seconds files() reuses the last scan before reading the folder again
+
+    class Changes:
+        """Image changes since the last saved index. Images are [filename, size] pairs."""
+
+        def __init__(self, images: list, added: list, changed: list, removed: list, initial: bool):
+            self.images = images
+            self.added = added
+            self.changed = changed  # (old, new) pairs
+            self.removed = removed
+            self.initial = initial  # No saved index yet. Callers should reconcile against the full list.
+
+        def __str__(self):
+            return f'added: {len(self.added)}, changed: {len(self.changed)}, removed: {len(self.removed)}'
+
+        def __bool__(self):
+            return bool(self.added or self.changed or self.removed)
+
+    @staticmethod
+    def load() -> dict:
+        if ImageIndex.entries is None:
+            try:
+                with open(ImageIndex.file) as f:
+                    ImageIndex.entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                ImageIndex.entries = {}
+        return ImageIndex.entries
+
+    @staticmethod
+    def is_product_image(filename: str) -> bool:
+        if filename in ImageIndex.ignore:
+            return False
+        # filter out trailing filenames
+        if '^' in filename:
+            return filename.split('.')[0].split('^')[1].isdigit()
+        return True
+
+    @staticmethod
+    def hash(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'md5').hexdigest()
+
+    @staticmethod
+    def scan() -> dict:
+        """Read the image folder in one pass. Content hashes are reused for files that have not moved."""
+        with ImageIndex.lock:
+            previous = ImageIndex.current if ImageIndex.current is not None else ImageIndex.load()
+            result = {}
+            with os.scandir(creds.Company.product_images) as folder:
+                for entry in folder:
+                    if not entry.is_file() or not ImageIndex.is_product_image(entry.name):
+                        continue
+                    stat = entry.stat()
+                    known = previous.get(entry.name)
+                    if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                        result[entry.name] = known
+                    else:
+                        result[entry.name] = {
+                            'size': stat.st_size,
+                            'mtime': stat.st_mtime,
+                            'hash': ImageIndex.hash(entry.path),
+                        }
+            ImageIndex.current = result
+            ImageIndex.scanned_at = time.monotonic()
+            return result
+
+    @staticmethod
+    def files() -> list[str]:
+        """Filenames in the image folder. Reuses the last scan if it is under max_age seconds old, so lookups during
+        a sync cycle share one folder read."""
+        current = ImageIndex.current
+        if current is None or time.monotonic() - ImageIndex.scanned_at > ImageIndex.max_age:
+            current = ImageIndex.scan()
+        return list(current)
+
+    @staticmethod
+    def refresh() -> 'ImageIndex.Changes':
+        current = ImageIndex.scan()
+        with ImageIndex.lock:
+            # A later scan by files() must not move the baseline past changes this refresh has not processed
+            ImageIndex.pending = current
+            saved = ImageIndex.load()
+            initial = not os.path.exists(ImageIndex.file)
+            added, changed, removed = [], [], []
+            for name, entry in current.items():
+                old = saved.get(name)
+                if old is None:
+                    added.append([name, entry['size']])
+                elif old['hash'] != entry['hash']:
+                    changed.append(([name, old['size']], [name, entry['size']]))
+            for name, entry in saved.items():
+                if name not in current:
+                    removed.append([name, entry['size']])
+
+        images = [[name, entry['size']] for name, entry in current.items()]
+        return ImageIndex.Changes(images, added, changed, removed, initial)
+
+    @staticmethod
+    def save():
+        """Persist the last refresh as the new baseline."""
+        with ImageIndex.lock:
+            if ImageIndex.pending is None:
+                return
+            temp = f'{ImageIndex.file}.tmp'
+            with open(temp, 'w') as f:
+                json.dump(ImageIndex.pending, f)
+            os.replace(temp, ImageIndex.file)
+            ImageIndex.entries = ImageIndex.pending
+
+
+class Diff:
+    """Hash-indexed comparison of a source of truth against a copy of it (e.g. Counterpoint vs Middleware).
+
+    Both sides are indexed once by key, so adds, deletes and changes come out of a single linear pass.
+    key and value are functions of an element. By default the whole element is the key, so an element
+    is either present on both sides or it is not. Pass a value function (e.g. size and modified time for
+    files keyed on name) to report elements present on both sides with a different value as changes.
+
+    adds: source elements whose key is missing from target
+    deletes: target elements whose key is missing from source
+    changes: (source, target) element pairs with the same key and a different value"""
+
+    def __init__(self, source, target, key=None, value=None):
+        self.key = key or Diff.hashable
+        self.value = value
+        self.source_index = self.index(source)
+        self.target_index = self.index(target)
+        self.adds = []
+        self.deletes = []
+        self.changes = []
+
+        for k, items in self.source_index.items():
+            if k not in self.target_index:
+                self.adds += items
+            elif self.value is not None:
+                target_values = set(Diff.hashable(self.value(x)) for x in self.target_index[k])
+                source_values = set(Diff.hashable(self.value(x)) for x in items)
+                if source_values != target_values:
+                    self.changes += [(s, t) for s in items for t in self.target_index[k]]
+
+        for k, items in self.target_index.items():
+            if k not in self.source_index:
+                self.deletes += items
+
+    def __str__(self):
+        return f'adds: {len(self.adds)}, deletes: {len(self.deletes)}, changes: {len(self.changes)}'
+
+    def __bool__(self):
+        return bool(self.adds or self.deletes or self.changes)
+
+    def index(self, elements) -> dict:
+        result = {}
+        for x in elements or []:
+            result.setdefault(Diff.hashable(self.key(x)), []).append(x)
+        return result
+
+    @staticmethod
+    def hashable(element):
+        """Lists (e.g. database rows converted with list()) are indexed as tuples."""
+        if isinstance(element, list):
+            return tuple(Diff.hashable(x) for x in element)
+        return element
+
+
+class EventDedup:
+    """Remembers event ids for window seconds so a retried or duplicated delivery is processed once. Ids are held
+    in insertion order, so expiring the oldest and evicting past maxsize are O(1), as is each lookup.
+
+    store, if given, makes the ids survive a restart. It needs create_table(), get(since), insert(events),
+    delete(event_id) and purge(before), like Database.Shopify.Webhook.Event. New ids are written to it in batches
+    from a background thread."""
+
+    def __init__(self, window=172800, maxsize=100000, store=None, interval=1.0, eh=ProcessOutErrorHandler):
+        self.window = window
+        self.maxsize = maxsize
+        self.store = store
+        self.interval = interval
+        self.eh = eh
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.store_lock = threading.Lock()  # Orders writes to the store. Taken before lock.
+        self.events: OrderedDict = OrderedDict()  # {event_id: received}
+        self.unsaved: list[tuple] = []
+        self.duplicates = 0
+        self.last_purge = 0
+        self.started = False
+        self.retry_start = 0
+
+    def __str__(self):
+        return f'EventDedup: size: {len(self.events)}/{self.maxsize}, duplicates dropped: {self.duplicates}'
+
+    def start(self):
+        """Loads the ids held by the store and starts the writer thread. Called at startup, or by the first
+        claim(). While the store cannot be read, ids are kept in memory only and loading is retried each minute."""
+        if self.started or not self.store or time.monotonic() < self.retry_start:
+            return
+        with self.start_lock:
+            if self.started:
+                return
+            try:
+                self.store.create_table()
+                loaded = self.store.get(since=datetime.now() - timedelta(seconds=self.window))
+            except Exception as e:
+                self.retry_start = time.monotonic() + 60
+                self.eh.error_handler.add_error_v(
+                    error=f'Could not load event ids: {e}', origin='EventDedup.start', traceback=tb()
+                )
+                return
+
+            with self.lock:
+                # Loaded ids are older than any claimed since the process started
+                events = OrderedDict(loaded)
+                for event_id, received in self.events.items():
+                    events.pop(event_id, None)
+                    events[event_id] = received
+                while len(events) > self.maxsize:
+                    events.popitem(last=False)
+                self.events = events
+
+            threading.Thread(target=self.run, daemon=True).start()
+            atexit.register(self.save)
+            self.started = True
+
+    def claim(self, event_id: str, topic: str = None) -> bool:
+        """Returns True the first time an event id is seen within the window and False for a duplicate.
+        An event without an id is always processed."""
+        if not event_id:
+            return True
+        self.start()
+        now = datetime.now()
+        with self.lock:
+            expired = now - timedelta(seconds=self.window)
+            while self.events and next(iter(self.events.values())) < expired:
+                self.events.popitem(last=False)
+            if event_id in self.events:
+                self.duplicates += 1
+                return False
+            self.events[event_id] = now
+            if len(self.events) > self.maxsize:
+                self.events.popitem(last=False)
+            if self.store:
+                self.unsaved.append((event_id, topic, now))
+            return True
+
+    def release(self, event_id: str):
+        """Forgets an event that could not be processed, so its retry is accepted"""
+        # store_lock waits out a save() that already took the id, so the delete lands after its insert
+        with self.store_lock:
+            with self.lock:
+                self.events.pop(event_id, None)
+                self.unsaved = [x for x in self.unsaved if x[0] != event_id]
+            if self.store:
+                try:
+                    self.store.delete(event_id)
+                except Exception as e:
+                    self.eh.error_handler.add_error_v(
+                        error=f'Could not release event {event_id}: {e}', origin='EventDedup.release'
+                    )
+
+    def save(self):
+        with self.store_lock:
+            with self.lock:
+                unsaved, self.unsaved = self.unsaved, []
+            if not unsaved:
+                return
+            try:
+                self.store.insert(unsaved)
+            except Exception as e:
+                self.eh.error_handler.add_error_v(
+                    error=f'Could not save {len(unsaved)} event ids: {e}', origin='EventDedup.save', traceback=tb()
+                )
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+            if time.monotonic() - self.last_purge > 3600:
+                self.last_purge = time.monotonic()
+                try:
+                    self.store.purge(before=datetime.now() - timedelta(seconds=self.window))
+                except Exception as e:
+                    self.eh.error_handler.add_error_v(
+                        error=f'Could not purge event ids: {e}', origin='EventDedup.run', traceback=tb()
+                    )
+
+
+class LRUCache:
+    """Thread-safe read-through cache bounded to maxsize entries with least-recently-used eviction.
+
+    Entries are tagged with the keys they were derived from (e.g. 'item:10338', 'product:8123') so a write can
+    invalidate every cached lookup involving that key without clearing the rest of the cache. ttl (seconds) bounds
+    how long an entry can miss writes made by other processes."""
+
+    def __init__(self, maxsize=10000, name='Cache', ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()  # {key: (value, expires)}
+        self.entry_tags: dict[tuple, set] = {}
+        self.tags: dict[str, set] = {}  # {tag: keys}
+        self.generation = 0  # Bumped by every invalidation so in-flight loads are not stored stale
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups * 100 if lookups else 0
+        return (
+            f'{self.name}: size: {len(self.entries)}/{self.maxsize}, hits: {self.hits}, misses: {self.misses}, '
+            f'hit rate: {rate:.1f}%, evictions: {self.evictions}, invalidations: {self.invalidations}'
+        )
+
+    def get(self, key, load, tags=None):
+        """Returns the cached value for key, calling load() on a miss. tags(value) returns the tags to store the
+        value under."""
+        with self.lock:
+            if key in self.entries:
+                value, expires = self.entries[key]
+                if expires is None or time.monotonic() < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.remove(key)
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+
+        with self.lock:
+            if generation == self.generation:
+                self.remove(key)
+                self.entries[key] = (value, time.monotonic() + self.ttl if self.ttl else None)
+                self.entry_tags[key] = set(tags(value)) if tags else set()
+                for tag in self.entry_tags[key]:
+                    self.tags.setdefault(tag, set()).add(key)
+                while len(self.entries) > self.maxsize:
+                    self.remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return value
+
+    def remove(self, key):
+        """Drops a single entry. Caller holds the lock."""
+        self.entries.pop(key, None)
+        for tag in self.entry_tags.pop(key, ()):
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, *tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self.remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.entry_tags.clear()
+            self.tags.clear()
+
+
+class StageScheduler:
+    """Runs the stages of a sync concurrently, starting each one as soon as the stages it depends on have
+    finished. Stages only orchestrate; the work items they fan out are wrapped with StageScheduler.budget so
+    every stage draws from one worker budget of creds.Integrator.max_workers, and the Shopify requests they
+    make share the cost throttler, so running stages side by side does not raise either budget.
+
+    A failed stage is logged and its dependents still run, since dependencies order the stages rather than
+    pass data between them."""
+
+    workers = threading.BoundedSemaphore(creds.Integrator.max_workers)
+
+    @staticmethod
+    def budget(func):
+        """Wrap a work item so it runs only while holding a slot of the shared worker budget. Budgeted items
+        must not wait on other budgeted items, or the stages can exhaust the budget and deadlock."""
+
+        def wrapper(*args, **kwargs):
+            with StageScheduler.workers:
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    class Stage:
+        def __init__(self, name, func, after=()):
+            self.name = name
+            self.func = func
+            self.after = set(after)
+            self.start = None
+            self.elapsed = None
+            self.error = None
+
+    def __init__(self, eh=ProcessOutErrorHandler):
+        self.eh = eh
+        self.stages: dict[str, StageScheduler.Stage] = {}
+
+    def __str__(self):
+        result = ''
+        for stage in sorted(self.stages.values(), key=lambda x: x.start or 0):
+            if stage.elapsed is None:
+                status = 'not run'
+            else:
+                status = f'{stage.elapsed:.2f}s' + (' (failed)' if stage.error else '')
+            result += f'\n{stage.name}: {status}'
+        return result
+
+    def add(self, name, func, after=()):
+        """Add a stage. after lists the names of stages that must finish first."""
+        self.stages[name] = StageScheduler.Stage(name, func, after)
+
+    def run_stage(self, stage: 'StageScheduler.Stage'):
+        stage.start = time.monotonic()
+        try:
+            stage.func()
+        except Exception as e:
+            stage.error = e
+            self.eh.error_handler.add_error_v(
+                error=f'Stage {stage.name} failed: {e}', origin='StageScheduler', traceback=tb()
+            )
+        finally:
+            stage.elapsed = time.monotonic() - stage.start
+
+    def run(self):
+        """Runs every stage and returns once all have finished."""
+        # Dependencies on stages that were not added (e.g. disabled syncs) are already satisfied.
+        pending = {name: stage.after & self.stages.keys() for name, stage in self.stages.items()}
+        done = set()
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            running = {}
+            while pending or running:
+                for name in [x for x, after in pending.items() if after <= done]:
+                    del pending[name]
+                    running[executor.submit(self.run_stage, self.stages[name])] = name
+                if not running:
+                    raise ValueError(f'Circular stage dependencies: {sorted(pending)}')
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done.add(running.pop(future))
+
+
+class CronSpec:
+    """A five field cron expression: minute hour day-of-month month day-of-week. Each field accepts *, numbers,
+    ranges (a-b), lists (a,b) and steps (*/n, a-b/n, a/n). Day of week is 0-6 from Sunday, and 7 is also Sunday.
+    As in cron, when both day fields are restricted a day matches either of them."""
+
+    fields = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f'Cron spec needs 5 fields: {expression}')
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            CronSpec.parse(part, low, high) for part, (low, high) in zip(parts, CronSpec.fields)
+        )
+        self.weekdays = {x % 7 for x in weekdays}
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def __str__(self):
+        return self.expression
+
+    @staticmethod
+    def parse(field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(','):
+            value, _, step = part.partition('/')
+            if value == '*':
+                start, end = low, high
+            elif '-' in value:
+                start, end = (int(x) for x in value.split('-', 1))
+            else:
+                start = end = int(value)
+                if step:
+                    end = high
+            if start < low or end > high or start > end:
+                raise ValueError(f'Cron field out of range: {field}')
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def matches_day(self, dt: datetime) -> bool:
+        day = dt.day in self.days
+        weekday = dt.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt: datetime) -> datetime:
+        """Returns the first matching minute strictly after dt"""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.matches_day(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f'Cron spec never fires: {self.expression}')
+
+
+class CronScheduler:
+    """Runs jobs on cron specs in a worker pool. The scheduled time of each job's last run is kept in a JSON
+    ledger, so a run that was missed while the process was busy or down is caught up on the next tick. Several
+    missed runs of the same job are caught up once. A job never overlaps itself, and a slow job never delays
+    the others.
+
+    A run is recorded in the ledger when it starts, so a run that crashes the process is not repeated."""
+
+    class Job:
+        def __init__(self, name: str, spec: CronSpec, func, grace: int = None):
+            self.name = name
+            self.spec = spec
+            self.func = func
+            self.grace = grace
+            self.future = None
+
+    def __init__(self, ledger_file: str, max_workers=4, eh=ScheduledTasksErrorHandler):
+        self.ledger_file = ledger_file
+        self.eh = eh
+        self.jobs: dict[str, CronScheduler.Job] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.ledger: dict[str, str] = self.load()
+
+    def __str__(self):
+        result = ''
+        for job in self.jobs.values():
+            last = self.ledger.get(job.name)
+            running = ' (running)' if job.future and not job.future.done() else ''
+            result += f'\n{job.name} [{job.spec}]: last run {last or "never"}{running}'
+        return result
+
+    def add(self, name: str, spec: str, func, grace: int = None):
+        """Add a job. grace is how many seconds after its scheduled time a missed run is still caught up.
+        None always catches up."""
+        self.jobs[name] = CronScheduler.Job(name, CronSpec(spec), func, grace)
+
+    def load(self) -> dict:
+        try:
+            with open(self.ledger_file) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.eh.error_handler.add_error_v(
+                error=f'Could not read task ledger {self.ledger_file}: {e}', origin='CronScheduler.load'
+            )
+            return {}
+
+    def record(self, job: 'CronScheduler.Job', slot: datetime):
+        with self.lock:
+            self.ledger[job.name] = slot.isoformat()
+            temp_file = f'{self.ledger_file}.tmp'
+            with open(temp_file, 'w') as file:
+                json.dump(self.ledger, file, indent=4)
+            os.replace(temp_file, self.ledger_file)
+
+    def due(self, job: 'CronScheduler.Job', now: datetime) -> datetime | None:
+        """Returns the latest scheduled time at or before now that has not run, or None"""
+        last = self.ledger.get(job.name)
+        # A job new to the ledger starts with the current minute rather than replaying its history.
+        last = datetime.fromisoformat(last) if last else now.replace(second=0, microsecond=0) - timedelta(minutes=1)
+        slot = None
+        t = job.spec.next_after(last)
+        while t <= now:
+            slot = t
+            t = job.spec.next_after(t)
+        return slot
+
+    def run_job(self, job: 'CronScheduler.Job', slot: datetime):
+        start = time.monotonic()
+        try:
+            job.func()
+        except Exception as e:
+            self.eh.error_handler.add_error_v(
+                error=f'Task {job.name} scheduled for {slot:%m/%d %H:%M} failed: {e}',
+                origin='CronScheduler',
+                traceback=tb(),
+            )
+        finally:
+            elapsed = time.monotonic() - start
+            if elapsed > 60:
+                self.eh.logger.info(f'Task {job.name}: completed in {elapsed // 60:.0f}m {elapsed % 60:.0f}s')
+
+    def tick(self, now: datetime = None) -> list:
+        """Starts every job that is due and not already running. Returns the futures started."""
+        now = now or datetime.now()
+        started = []
+        for job in self.jobs.values():
+            if job.future and not job.future.done():
+                continue
+            slot = self.due(job, now)
+            if slot is None:
+                continue
+            late = (now - slot).total_seconds()
+            self.record(job, slot)
+            if job.grace is not None and late > job.grace:
+                self.eh.logger.warn(f'Task {job.name}: skipping run missed at {slot:%m/%d %H:%M}')
+                continue
+            if late >= 60:
+                self.eh.logger.info(f'Task {job.name}: catching up run missed at {slot:%m/%d %H:%M}')
+            job.future = self.executor.submit(self.run_job, job, slot)
+            started.append(job.future)
+        return started
+
+    def run(self, before_tick=None):
+        """Ticks at the start of every minute until interrupted. before_tick is called before each tick."""
+        try:
+            while True:
+                try:
+                    if before_tick:
+                        before_tick()
+                    self.tick()
+                except Exception as e:
+                    self.eh.error_handler.add_error_v(
+                        error=f'Tick failed: {e}', origin='CronScheduler', traceback=tb()
+                    )
+                now = datetime.now()
+                time.sleep(60 - now.second - now.microsecond / 1_000_000)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BufferedWriter:
+    """Appends lines to a file from a background thread so callers never wait on disk. Lines are written in
+    batches every interval seconds, or sooner once batch_size lines are waiting. flush() blocks until
+    everything written so far is on disk."""
+
+    def __init__(self, file_path: str, interval=1.0, batch_size=500, eh=ProcessOutErrorHandler):
+        self.file_path = file_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.eh = eh
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def write(self, line: str):
+        self.queue.put(line)
+
+    def write_json(self, data):
+        self.queue.put(json.dumps(data))
+
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with open(self.file_path, 'a') as file:
+                    file.write(''.join(f'{line}\n' for line in batch))
+            except Exception as e:
+                self.eh.error_handler.add_error_v(
+                    error=f'Could not write {len(batch)} lines to {self.file_path}: {e}', origin='BufferedWriter'
+                )
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
 def convert_to_rfc2822(date: datetime):
     return formatdate(int(date.timestamp()))
 
@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pyodbc
+import pytest
+
+from database import ConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query):
+        if not self.connection.alive:
+            raise pyodbc.Error('08S01', 'Communication link failure')
+        return self
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class Pool(ConnectionPool):
+    """ConnectionPool that opens fake connections instead of connecting to SQL Server"""
+
+    def __init__(self, size=2, timeout=0.1, max_lifetime=3600, health_check=60, fail=False):
+        super().__init__('', size=size, timeout=timeout, max_lifetime=max_lifetime, health_check=health_check)
+        self.fail = fail
+
+    def connect(self):
+        if self.fail:
+            raise pyodbc.Error('08001', 'Unable to connect')
+        with self.lock:
+            self.opens += 1
+        return ConnectionPool.Connection(FakeConnection())
+
+
+def test_released_connections_are_reused():
+    pool = Pool()
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert (pool.opens, pool.hits) == (1, 1)
+
+
+def test_pool_is_bounded():
+    pool = Pool(size=2)
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    assert pool.waits == 1
+    assert pool.open_count == 2
+
+
+def test_waiters_get_released_connections():
+    pool = Pool(size=1, timeout=1)
+    conn = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.release(conn)
+    waiter.join(timeout=1)
+    assert acquired == [conn]
+
+
+def test_broken_connections_are_discarded():
+    pool = Pool(size=1)
+    conn = pool.acquire()
+    pool.release(conn, broken=True)
+    assert conn.connection.closed
+    assert (pool.open_count, pool.discarded) == (0, 1)
+    assert pool.acquire() is not conn
+
+
+def test_old_connections_are_recycled():
+    pool = Pool(max_lifetime=10)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.created -= 11
+    assert pool.acquire() is not conn
+    assert conn.connection.closed
+    assert pool.recycled == 1
+    assert pool.open_count == 1
+
+
+def test_idle_connections_are_pinged():
+    pool = Pool(health_check=10)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.last_used -= 11
+    conn.connection.alive = False
+    assert pool.acquire() is not conn
+    assert pool.open_count == 1
+
+
+def test_failed_connects_free_their_slot():
+    pool = Pool(size=1, fail=True)
+    with pytest.raises(pyodbc.Error):
+        pool.acquire()
+    assert pool.open_count == 0
+
+
+def test_close_all_closes_idle_connections():
+    pool = Pool()
+    idle = pool.acquire()
+    busy = pool.acquire()
+    pool.release(idle)
+    pool.close_all()
+    assert idle.connection.closed and not busy.connection.closed
+    assert pool.open_count == 1
+
+
+def test_is_broken():
+    assert ConnectionPool.is_broken(pyodbc.Error('08S01', 'Communication link failure'))
+    assert ConnectionPool.is_broken(pyodbc.Error('HYT00', 'Timeout expired'))
+    assert not ConnectionPool.is_broken(pyodbc.Error('42000', 'Syntax error'))
+    assert not ConnectionPool.is_broken(pyodbc.Error())
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from integration.shopify_api import CostThrottler
+
+
+def response(available, requested=None, maximum=1000, restore_rate=50):
+    status = {'maximumAvailable': maximum, 'currentlyAvailable': available, 'restoreRate': restore_rate}
+    cost = {'throttleStatus': status}
+    if requested is not None:
+        cost['requestedQueryCost'] = requested
+    return {'data': {}, 'extensions': {'cost': cost}}
+
+
+def test_reserve_takes_the_default_cost():
+    throttler = CostThrottler(maximum=1000, restore_rate=50)
+    assert throttler.reserve('products') == CostThrottler.default_cost
+    assert throttler.available == 1000 - CostThrottler.default_cost
+    assert throttler.in_flight == CostThrottler.default_cost
+
+
+def test_update_learns_costs_and_resyncs():
+    throttler = CostThrottler(maximum=1000, restore_rate=50)
+    reserved = throttler.reserve('products')
+    throttler.update('products', reserved, response(available=900, requested=52, maximum=2000, restore_rate=100))
+    assert throttler.in_flight == 0
+    assert throttler.available == 900
+    assert (throttler.maximum, throttler.restore_rate) == (2000, 100)
+    assert throttler.reserve('products') == 52
+
+
+def test_requests_in_flight_are_not_counted_twice():
+    throttler = CostThrottler(maximum=1000, restore_rate=50)
+    first = throttler.reserve('a')
+    throttler.reserve('b')
+    throttler.update('a', first, response(available=990))
+    # b is still in flight and may not be reflected by the server yet
+    assert throttler.available == 990 - CostThrottler.default_cost
+
+
+def test_costs_are_capped_at_the_bucket_size():
+    throttler = CostThrottler(maximum=100, restore_rate=50)
+    throttler.costs['huge'] = 5000
+    assert throttler.reserve('huge') == 100
+
+
+def test_reserve_waits_for_the_bucket_to_restore():
+    throttler = CostThrottler(maximum=100, restore_rate=1000)
+    throttler.costs['query'] = 100
+    throttler.reserve('query')
+    start = time.monotonic()
+    throttler.reserve('query')
+    assert time.monotonic() - start >= 0.09
+    assert throttler.waits == 1
+
+
+def test_reservations_are_returned_without_a_cost():
+    throttler = CostThrottler(maximum=1000, restore_rate=0)
+    reserved = throttler.reserve('query')
+    throttler.update('query', reserved)
+    assert throttler.available == 1000
+
+    reserved = throttler.reserve('query')
+    throttler.update('query', reserved, {'errors': [{'message': 'Internal error'}]})
+    assert throttler.available == 1000
+    assert throttler.in_flight == 0
+
+
+def test_throttled_responses_are_counted():
+    throttler = CostThrottler(maximum=1000, restore_rate=50)
+    reserved = throttler.reserve('query')
+    throttler.update('query', reserved, {'errors': [{'message': 'Throttled'}]})
+    assert throttler.throttled == 1
+
+
+def test_zero_restore_rate_with_nothing_in_flight_does_not_block():
+    throttler = CostThrottler(maximum=100, restore_rate=0)
+    throttler.available = 0
+    assert throttler.reserve('query') == CostThrottler.default_cost
+
+
+def test_zero_restore_rate_waits_for_a_response():
+    throttler = CostThrottler(maximum=100, restore_rate=0)
+    throttler.costs['query'] = 100
+    first = throttler.reserve('query')
+    reserved = []
+    waiter = threading.Thread(target=lambda: reserved.append(throttler.reserve('query')))
+    waiter.start()
+    time.sleep(0.05)
+    assert not reserved
+
+    throttler.update('query', first, response(available=100, maximum=100, restore_rate=0))
+    waiter.join(timeout=1)
+    assert reserved == [100]
@@ -0,0 +1,149 @@
+import threading
+from datetime import datetime
+
+import pytest
+
+from setup.utilities import CronScheduler, CronSpec
+
+
+class Recorder:
+    """Stands in for an error handler module and records what was logged"""
+
+    def __init__(self):
+        self.errors = []
+        self.messages = []
+        self.error_handler = self
+        self.logger = self
+
+    def add_error_v(self, error, origin=None, traceback=None):
+        self.errors.append(error)
+
+    def info(self, message):
+        self.messages.append(message)
+
+    def warn(self, message):
+        self.messages.append(message)
+
+
+def next_after(expression, dt):
+    return CronSpec(expression).next_after(datetime.fromisoformat(dt))
+
+
+def test_next_after_steps():
+    assert next_after('*/15 * * * *', '2026-10-19 10:07:30') == datetime(2026, 10, 19, 10, 15)
+    assert next_after('*/15 * * * *', '2026-10-19 10:45') == datetime(2026, 10, 19, 11, 0)
+
+
+def test_next_after_is_strictly_after():
+    assert next_after('30 2 * * *', '2026-10-19 02:30') == datetime(2026, 10, 20, 2, 30)
+
+
+def test_next_after_rolls_over_months_and_years():
+    assert next_after('0 0 1 * *', '2026-01-31 12:00') == datetime(2026, 2, 1)
+    assert next_after('0 0 1 1 *', '2026-10-19 00:00') == datetime(2027, 1, 1)
+
+
+def test_next_after_weekdays():
+    # 2026-10-17 is a Saturday
+    assert next_after('0 9 * * 1-5', '2026-10-17 08:00') == datetime(2026, 10, 19, 9, 0)
+    assert next_after('0 9 * * 7', '2026-10-17 08:00') == next_after('0 9 * * 0', '2026-10-17 08:00')
+    assert next_after('0 9 * * 0', '2026-10-17 08:00') == datetime(2026, 10, 18, 9, 0)
+
+
+def test_next_after_day_fields_match_either():
+    # The 13th or any Friday. 2026-10-02 is a Friday.
+    assert next_after('0 0 13 * 5', '2026-10-01 00:00') == datetime(2026, 10, 2)
+    assert next_after('0 0 13 * 5', '2026-10-09 00:00') == datetime(2026, 10, 13)
+
+
+def test_parse_lists_ranges_and_steps():
+    spec = CronSpec('0,30 8-17/3 * * *')
+    assert spec.minutes == {0, 30}
+    assert spec.hours == {8, 11, 14, 17}
+    assert CronSpec('5/20 * * * *').minutes == {5, 25, 45}
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '* 24 * * *', '10-5 * * * *', '* * 0 * *'])
+def test_invalid_specs(expression):
+    with pytest.raises(ValueError):
+        CronSpec(expression)
+
+
+def test_spec_that_never_fires():
+    with pytest.raises(ValueError):
+        next_after('0 0 31 2 *', '2026-10-19 00:00')
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    scheduler = CronScheduler(ledger_file=str(tmp_path / 'ledger.json'), max_workers=2, eh=Recorder())
+    yield scheduler
+    scheduler.executor.shutdown(wait=True)
+
+
+def test_new_job_does_not_replay_history(scheduler):
+    scheduler.add('job', '0 * * * *', lambda: None)
+    assert scheduler.due(scheduler.jobs['job'], datetime(2026, 10, 19, 10, 30)) is None
+    assert scheduler.due(scheduler.jobs['job'], datetime(2026, 10, 19, 11, 0, 5)) == datetime(2026, 10, 19, 11, 0)
+
+
+def test_tick_runs_due_jobs_and_records_them(scheduler, tmp_path):
+    runs = []
+    scheduler.add('job', '0 * * * *', lambda: runs.append(1))
+    scheduler.ledger['job'] = datetime(2026, 10, 19, 10, 0).isoformat()
+
+    futures = scheduler.tick(datetime(2026, 10, 19, 11, 0, 5))
+    for future in futures:
+        future.result()
+    assert runs == [1]
+    assert scheduler.ledger['job'] == datetime(2026, 10, 19, 11, 0).isoformat()
+    assert CronScheduler(ledger_file=str(tmp_path / 'ledger.json')).ledger == scheduler.ledger
+
+    assert scheduler.tick(datetime(2026, 10, 19, 11, 30)) == []
+
+
+def test_missed_runs_are_caught_up_once(scheduler):
+    runs = []
+    scheduler.add('job', '0 * * * *', lambda: runs.append(1))
+    scheduler.ledger['job'] = datetime(2026, 10, 19, 6, 0).isoformat()
+
+    for future in scheduler.tick(datetime(2026, 10, 19, 11, 20)):
+        future.result()
+    assert runs == [1]
+    assert scheduler.ledger['job'] == datetime(2026, 10, 19, 11, 0).isoformat()
+
+
+def test_runs_missed_past_their_grace_are_skipped(scheduler):
+    runs = []
+    scheduler.add('job', '0 2 * * *', lambda: runs.append(1), grace=3600)
+    scheduler.ledger['job'] = datetime(2026, 10, 18, 2, 0).isoformat()
+
+    assert scheduler.tick(datetime(2026, 10, 19, 9, 0)) == []
+    assert runs == []
+    # The skipped run is still recorded so it is not retried on the next tick
+    assert scheduler.ledger['job'] == datetime(2026, 10, 19, 2, 0).isoformat()
+
+
+def test_jobs_do_not_overlap(scheduler):
+
+    release = threading.Event()
+    scheduler.add('job', '* * * * *', release.wait)
+    scheduler.ledger['job'] = datetime(2026, 10, 19, 10, 0).isoformat()
+
+    first = scheduler.tick(datetime(2026, 10, 19, 10, 1))
+    assert len(first) == 1
+    assert scheduler.tick(datetime(2026, 10, 19, 10, 2)) == []
+    release.set()
+    first[0].result()
+    assert len(scheduler.tick(datetime(2026, 10, 19, 10, 3))) == 1
+
+
+def test_failed_jobs_are_logged(scheduler):
+    def fail():
+        raise RuntimeError('boom')
+
+    scheduler.add('job', '* * * * *', fail)
+    scheduler.ledger['job'] = datetime(2026, 10, 19, 10, 0).isoformat()
+    for future in scheduler.tick(datetime(2026, 10, 19, 10, 1)):
+        future.result()
+    assert any('boom' in x for x in scheduler.eh.errors)
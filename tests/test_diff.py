@@ -0,0 +1,45 @@
+from setup.utilities import Diff
+
+
+def test_adds_and_deletes():
+    diff = Diff(source=['a', 'b', 'c'], target=['b', 'c', 'd'])
+    assert diff.adds == ['a']
+    assert diff.deletes == ['d']
+    assert diff.changes == []
+    assert diff
+
+
+def test_identical_sides_have_no_differences():
+    diff = Diff(source=[1, 2, 3], target=[3, 2, 1])
+    assert not diff
+    assert str(diff) == 'adds: 0, deletes: 0, changes: 0'
+
+
+def test_missing_sides_are_empty():
+    assert Diff(source=None, target=['x']).deletes == ['x']
+    assert Diff(source=['x'], target=None).adds == ['x']
+
+
+def test_rows_as_lists_are_compared_by_value():
+    diff = Diff(source=[['ITEM1', 1], ['ITEM2', 2]], target=[['ITEM1', 1], ['ITEM3', 3]])
+    assert diff.adds == [['ITEM2', 2]]
+    assert diff.deletes == [['ITEM3', 3]]
+
+
+def test_duplicates_are_kept():
+    diff = Diff(source=['a', 'a'], target=[])
+    assert diff.adds == ['a', 'a']
+
+
+def test_changes_by_value():
+    source = [{'name': 'a.jpg', 'size': 10}, {'name': 'b.jpg', 'size': 20}]
+    target = [{'name': 'a.jpg', 'size': 10}, {'name': 'b.jpg', 'size': 25}, {'name': 'c.jpg', 'size': 5}]
+    diff = Diff(source, target, key=lambda x: x['name'], value=lambda x: x['size'])
+    assert diff.adds == []
+    assert diff.deletes == [{'name': 'c.jpg', 'size': 5}]
+    assert diff.changes == [({'name': 'b.jpg', 'size': 20}, {'name': 'b.jpg', 'size': 25})]
+
+
+def test_values_are_ignored_without_a_value_function():
+    diff = Diff([{'name': 'a', 'size': 1}], [{'name': 'a', 'size': 2}], key=lambda x: x['name'])
+    assert not diff
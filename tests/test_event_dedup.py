@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from setup.utilities import EventDedup
+
+
+class Store:
+    """In-memory stand-in for Database.Shopify.Webhook.Event"""
+
+    def __init__(self, events=None, fail=False):
+        self.events = dict(events or {})
+        self.fail = fail
+        self.deleted = []
+
+    def create_table(self):
+        if self.fail:
+            raise ConnectionError('database unavailable')
+
+    def get(self, since):
+        return [(event_id, received) for event_id, received in self.events.items() if received >= since]
+
+    def insert(self, events):
+        for event_id, topic, received in events:
+            self.events[event_id] = received
+
+    def delete(self, event_id):
+        self.deleted.append(event_id)
+        self.events.pop(event_id, None)
+
+    def purge(self, before):
+        self.events = {k: v for k, v in self.events.items() if v >= before}
+
+
+def dedup(**kwargs):
+    return EventDedup(interval=3600, eh=MagicMock(), **kwargs)
+
+
+def test_duplicates_are_dropped():
+    events = dedup()
+    assert events.claim('a')
+    assert not events.claim('a')
+    assert events.claim('b')
+    assert events.duplicates == 1
+
+
+def test_events_without_an_id_are_always_processed():
+    events = dedup()
+    assert events.claim(None)
+    assert events.claim(None)
+    assert events.duplicates == 0
+
+
+def test_ids_expire_after_the_window():
+    events = dedup(window=60)
+    events.claim('a')
+    events.events['a'] = datetime.now() - timedelta(seconds=61)
+    assert events.claim('a')
+
+
+def test_oldest_ids_are_evicted_past_maxsize():
+    events = dedup(maxsize=2)
+    for event_id in ('a', 'b', 'c'):
+        events.claim(event_id)
+    assert list(events.events) == ['b', 'c']
+    assert events.claim('a')
+
+
+def test_released_events_are_accepted_again():
+    store = Store()
+    events = dedup(store=store)
+    events.claim('a')
+    events.release('a')
+    assert store.deleted == ['a']
+    assert events.unsaved == []
+    assert events.claim('a')
+
+
+def test_ids_survive_a_restart():
+    store = Store()
+    events = dedup(store=store)
+    events.claim('a', topic='orders/create')
+    events.save()
+    assert 'a' in store.events
+
+    restarted = dedup(store=store)
+    assert not restarted.claim('a')
+
+
+def test_ids_outside_the_window_are_not_loaded():
+    store = Store({'old': datetime.now() - timedelta(days=3), 'new': datetime.now()})
+    events = dedup(store=store, window=86400)
+    events.start()
+    assert list(events.events) == ['new']
+
+
+def test_ids_claimed_before_loading_are_kept():
+    store = Store({'a': datetime.now() - timedelta(minutes=5)})
+    events = dedup(store=store)
+    events.started = True  # Claim before the store is loaded
+    events.claim('b')
+    events.started = False
+    events.start()
+    assert list(events.events) == ['a', 'b']
+
+
+def test_unreadable_store_falls_back_to_memory():
+    store = Store(fail=True)
+    events = dedup(store=store)
+    assert events.claim('a')
+    assert not events.claim('a')
+    assert not events.started
+    assert events.eh.error_handler.add_error_v.called
@@ -0,0 +1,86 @@
+import time
+
+from setup.utilities import LRUCache
+
+
+class Loader:
+    def __init__(self, value=None):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_read_through():
+    cache = LRUCache()
+    load = Loader('a')
+    assert cache.get('key', load) == 'a'
+    assert cache.get('key', load) == 'a'
+    assert load.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.get(1, Loader('one'))
+    cache.get(2, Loader('two'))
+    cache.get(1, Loader())  # 1 is now the most recently used
+    cache.get(3, Loader('three'))
+    assert list(cache.entries) == [1, 3]
+    assert cache.evictions == 1
+
+
+def test_none_is_cached():
+    cache = LRUCache()
+    load = Loader(None)
+    cache.get('missing', load)
+    cache.get('missing', load)
+    assert load.calls == 1
+
+
+def test_invalidate_by_tag():
+    cache = LRUCache()
+    cache.get('product:1', Loader(['10338', '10339']), tags=lambda skus: [f'item:{x}' for x in skus])
+    cache.get('product:2', Loader(['20000']), tags=lambda skus: [f'item:{x}' for x in skus])
+
+    cache.invalidate('item:10339')
+    assert 'product:1' not in cache.entries
+    assert 'product:2' in cache.entries
+    assert 'item:10338' not in cache.tags
+    assert cache.invalidations == 1
+
+    cache.invalidate('item:unknown')
+    assert cache.invalidations == 1
+
+
+def test_invalidation_during_a_load_is_not_overwritten():
+    cache = LRUCache()
+
+    def load():
+        # A write lands while the value is being read from the database
+        cache.invalidate('item:1')
+        return 'stale'
+
+    assert cache.get('key', load, tags=lambda x: ['item:1']) == 'stale'
+    assert 'key' not in cache.entries
+    assert cache.get('key', Loader('fresh')) == 'fresh'
+    assert cache.entries['key'][0] == 'fresh'
+
+
+def test_clear():
+    cache = LRUCache()
+    cache.get('key', Loader('a'), tags=lambda x: ['tag'])
+    cache.clear()
+    assert not cache.entries and not cache.tags and not cache.entry_tags
+    assert cache.invalidations == 1
+
+
+def test_expired_entries_are_reloaded():
+    cache = LRUCache(ttl=0.01)
+    load = Loader('a')
+    cache.get('key', load)
+    time.sleep(0.02)
+    cache.get('key', load)
+    assert load.calls == 2
@@ -0,0 +1,66 @@
+import random
+
+from integration.shopify_api import MovesCollection
+
+
+def apply(current, moves):
+    """Apply moves the way Shopify does: in order, each against the order left by the previous one"""
+    order = list(current)
+    for move in moves:
+        product_id = int(move['id'].rsplit('/', 1)[1])
+        order.remove(product_id)
+        order.insert(int(move['newPosition']), product_id)
+    return order
+
+
+def moves(collection):
+    return [move.get() for batch in collection.moves for move in batch.get()]
+
+
+def test_stable_positions_is_a_longest_increasing_subsequence():
+    sequence = [3, 1, 4, 1, 5, 9, 2, 6]
+    positions = sorted(MovesCollection.stable_positions(sequence))
+    values = [sequence[i] for i in positions]
+    assert len(positions) == 4
+    assert values == sorted(values) and len(set(values)) == len(values)
+    assert MovesCollection.stable_positions([]) == set()
+
+
+def test_no_moves_when_already_in_order():
+    assert len(MovesCollection.from_diff([1, 2, 3], [1, 2, 3])) == 0
+
+
+def test_single_product_moved():
+    current = [1, 2, 3, 4, 5]
+    target = [1, 5, 2, 3, 4]
+    result = moves(MovesCollection.from_diff(current, target))
+    assert result == [{'id': 'gid://shopify/Product/5', 'newPosition': '1'}]
+    assert apply(current, result) == target
+
+
+def test_reversed_order():
+    current = [1, 2, 3, 4]
+    target = [4, 3, 2, 1]
+    result = MovesCollection.from_diff(current, target)
+    assert len(result) == 3
+    assert apply(current, moves(result)) == target
+
+
+def test_random_orders_are_reached_with_the_fewest_moves():
+    rng = random.Random(0)
+    for _ in range(200):
+        current = rng.sample(range(1000), rng.randint(0, 60))
+        target = rng.sample(current, len(current))
+        result = MovesCollection.from_diff(current, target)
+        index = {product_id: i for i, product_id in enumerate(current)}
+        stable = MovesCollection.stable_positions([index[x] for x in target])
+        assert len(result) == len(target) - len(stable)
+        assert apply(current, moves(result)) == target
+
+
+def test_moves_are_batched_by_250():
+    current = list(range(600))
+    target = current[::-1]
+    result = MovesCollection.from_diff(current, target)
+    assert [len(batch.get()) for batch in result.moves] == [250, 250, 99]
+    assert apply(current, moves(result)) == target
@@ -0,0 +1,81 @@
+from integration.shopify_api import QueryDocuments
+
+DOCUMENT = '''
+# Products with their variants
+query product($id: ID!) {
+    product(id: $id) {
+        ...ProductFields
+        variants(first: 10) { nodes { ...VariantFields } }
+    }
+}
+
+mutation productUpdate($input: ProductInput!) {
+    productUpdate(input: $input) { product { id } userErrors { field message } }
+}
+
+fragment ProductFields on Product {
+    id
+    title
+    # Braces in comments { are ignored
+    description(truncateAt: "{")
+    ...MediaFields
+}
+
+fragment VariantFields on ProductVariant {
+    id
+    sku
+}
+
+fragment MediaFields on Product {
+    media(first: 5) { nodes { alt } }
+}
+
+fragment UnusedFields on Product {
+    handle
+}
+'''
+
+
+def test_parse_splits_definitions():
+    doc = QueryDocuments.parse(DOCUMENT)
+    assert set(doc.operations) == {'product', 'productUpdate'}
+    assert set(doc.fragments) == {'ProductFields', 'VariantFields', 'MediaFields', 'UnusedFields'}
+    assert doc.operations['productUpdate'].startswith('mutation productUpdate')
+    assert doc.operations['productUpdate'].endswith('}')
+
+
+def test_braces_in_strings_and_comments_are_ignored():
+    doc = QueryDocuments.parse(DOCUMENT)
+    fragment = doc.fragments['ProductFields']
+    assert fragment.startswith('fragment ProductFields')
+    assert fragment.rstrip().endswith('...MediaFields\n}')
+
+
+def test_block_strings_and_escaped_quotes():
+    doc = QueryDocuments.parse('query a { f(x: "\\"}") }\nquery b { g(y: """ } """) }')
+    assert set(doc.operations) == {'a', 'b'}
+
+
+def test_compile_includes_only_referenced_fragments():
+    doc = QueryDocuments.parse(DOCUMENT)
+    compiled = QueryDocuments.compile(doc, 'product')
+    assert compiled.startswith('query product')
+    for name in ('ProductFields', 'VariantFields', 'MediaFields'):
+        assert f'fragment {name} ' in compiled
+    assert 'UnusedFields' not in compiled
+    assert 'productUpdate' not in compiled
+    assert QueryDocuments.compile(doc, 'productUpdate') == doc.operations['productUpdate']
+
+
+def test_get_caches_documents_and_falls_back_to_the_full_text(tmp_path):
+    path = tmp_path / 'products.graphql'
+    path.write_text(DOCUMENT)
+
+    operations = QueryDocuments.parse(DOCUMENT).operations
+    assert QueryDocuments.get(str(path), 'productUpdate') == operations['productUpdate']
+    assert QueryDocuments.get(str(path)) == DOCUMENT
+    assert QueryDocuments.get(str(path), 'missing') == DOCUMENT
+
+    # The file is read once per process
+    path.write_text('query changed { shop { id } }')
+    assert QueryDocuments.get(str(path)) == DOCUMENT
@@ -0,0 +1,67 @@
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from setup.utilities import StageScheduler
+
+
+def test_stages_run_after_their_dependencies():
+    order = []
+    scheduler = StageScheduler(eh=MagicMock())
+    scheduler.add('catalog', lambda: order.append('catalog'), after=['promotions'])
+    scheduler.add('promotions', lambda: order.append('promotions'))
+    scheduler.add('subscribers', lambda: order.append('subscribers'), after=['customers'])
+    scheduler.add('customers', lambda: order.append('customers'))
+    scheduler.run()
+    assert order.index('promotions') < order.index('catalog')
+    assert order.index('customers') < order.index('subscribers')
+
+
+def test_independent_stages_run_concurrently():
+    # Each stage waits for the other, so this only finishes if both run at once
+    barrier = threading.Barrier(2, timeout=1)
+    scheduler = StageScheduler(eh=MagicMock())
+    scheduler.add('customers', barrier.wait)
+    scheduler.add('promotions', barrier.wait)
+    scheduler.run()
+    assert not any(stage.error for stage in scheduler.stages.values())
+
+
+def test_missing_dependencies_are_satisfied():
+    ran = []
+    scheduler = StageScheduler(eh=MagicMock())
+    scheduler.add('catalog', lambda: ran.append('catalog'), after=['promotions'])
+    scheduler.run()
+    assert ran == ['catalog']
+
+
+def test_failed_stages_are_logged_and_dependents_still_run():
+    ran = []
+    scheduler = StageScheduler(eh=MagicMock())
+    scheduler.add('promotions', lambda: 1 / 0)
+    scheduler.add('catalog', lambda: ran.append('catalog'), after=['promotions'])
+    scheduler.run()
+    assert isinstance(scheduler.stages['promotions'].error, ZeroDivisionError)
+    assert ran == ['catalog']
+    assert scheduler.eh.error_handler.add_error_v.called
+
+
+def test_circular_dependencies_raise():
+    scheduler = StageScheduler(eh=MagicMock())
+    scheduler.add('a', lambda: None, after=['b'])
+    scheduler.add('b', lambda: None, after=['a'])
+    with pytest.raises(ValueError):
+        scheduler.run()
+
+
+def test_budget_holds_a_shared_worker_slot():
+    held = []
+
+    def work():
+        held.append(StageScheduler.workers._value)
+
+    before = StageScheduler.workers._value
+    StageScheduler.budget(work)()
+    assert held == [before - 1]
+    assert StageScheduler.workers._value == before